@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Measure fitabase.Project throughput against the local stand-in API.
+
+For each concurrency level, every profile's Sync/Latest is fetched the way
+get_all_tracker_sync_data does it, and requests/sec plus p50/p99 latency per
+call (including any retries) are reported. For example:
+
+    ./bench_fitabase_client.py --profiles 500 --latency 0.05 -c 1 4 16
+
+The stand-in's latency, error rate and throttling are set with --latency,
+--error-rate and --throttle-rate, so that the retry and backoff machinery
+can be timed as well. With --tls, the stand-in serves HTTPS with a throwaway
+self-signed certificate (made with the openssl command), and --no-reuse
+closes every connection after its request, which shows what keep-alive
+connections save:
+
+    ./bench_fitabase_client.py --tls --latency 0 -c 1
+    ./bench_fitabase_client.py --tls --latency 0 -c 1 --no-reuse
+"""
+import argparse
+from multiprocessing.pool import ThreadPool
+import shutil
+import sys
+import tempfile
+import time
+
+import fitabase
+from fitabase.standin import StandInServer, make_certificate
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles', type=int, default=200,
+            help="Number of synthetic profiles (= requests per run)")
+    parser.add_argument('--concurrency', '-c', type=int, nargs='+',
+            default=[1, 2, 4, 8, 16],
+            help="Concurrency levels to measure")
+    parser.add_argument('--latency', type=float, default=0.02,
+            help="Mean server-side delay per request, in seconds")
+    parser.add_argument('--error-rate', type=float, default=0,
+            help="Fraction of requests the stand-in fails with a 503")
+    parser.add_argument('--throttle-rate', type=float, default=None,
+            help="Requests per second above which the stand-in returns 429")
+    parser.add_argument('--transport', choices=['curl', 'requests'],
+            default='curl', help="Which fitabase.transport the client uses")
+    parser.add_argument('--tls', action='store_true',
+            help="Serve HTTPS instead of HTTP")
+    parser.add_argument('--no-reuse', action='store_true',
+            help="Close each connection after its request (curl only)")
+    parser.add_argument('--output', '-o', default=None,
+            help="Also append the results to this file")
+    args = parser.parse_args()
+    if args.no_reuse and args.transport != 'curl':
+        parser.error('--no-reuse needs --transport curl')
+    return args
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(server, concurrency, transport='curl', ca_file=None, reuse=True):
+    """
+    Fetch every profile's sync data with `concurrency` workers; return the
+    wall time, per-call latencies and the number of failed calls.
+    """
+    if transport == 'requests':
+        transport = fitabase.RequestsTransport(max_idle=concurrency,
+                                               ca_file=ca_file)
+    else:
+        transport = fitabase.CurlTransport(
+                max_idle=concurrency if reuse else 0, ca_file=ca_file)
+    api = fitabase.Project(server.token, url=server.url,
+            max_concurrency=concurrency,
+            retry=fitabase.RetryPolicy(backoff=0.05, max_backoff=1),
+            transport=transport)
+    profile_ids = [profile['ProfileId'] for profile in server.data.profiles]
+
+    def fetch(profile_id):
+        start = time.time()
+        try:
+            api.get_tracker_sync_data(profile_id, device_name='Charge 2',
+                    parse_dates=False)
+            failed = False
+        except IOError:
+            failed = True
+        return time.time() - start, failed
+
+    start = time.time()
+    pool = ThreadPool(concurrency)
+    try:
+        results = pool.map(fetch, profile_ids)
+    finally:
+        pool.close()
+        pool.join()
+        api.close()
+    wall = time.time() - start
+    return wall, [latency for latency, _ in results], \
+        sum(failed for _, failed in results)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    cert_dir = tempfile.mkdtemp() if args.tls else None
+    certfile, keyfile = (make_certificate(cert_dir) if cert_dir
+                         else (None, None))
+    lines = ['transport=%s profiles=%d latency=%.3fs error_rate=%.3f '
+             'throttle_rate=%s tls=%s reuse=%s'
+             % (args.transport, args.profiles, args.latency, args.error_rate,
+                args.throttle_rate, args.tls, not args.no_reuse),
+             '%11s %10s %9s %9s %7s %9s'
+             % ('concurrency', 'req/s', 'p50 (ms)', 'p99 (ms)', 'failed',
+                'served')]
+    for concurrency in args.concurrency:
+        with StandInServer(n_profiles=args.profiles, latency=args.latency,
+                error_rate=args.error_rate,
+                throttle_rate=args.throttle_rate,
+                certfile=certfile, keyfile=keyfile) as server:
+            wall, latencies, failed = run(server, concurrency,
+                    args.transport, ca_file=certfile,
+                    reuse=not args.no_reuse)
+            served = server.requests
+        lines.append('%11d %10.1f %9.1f %9.1f %7d %9d'
+                     % (concurrency, len(latencies) / wall,
+                        1000 * percentile(latencies, 0.5),
+                        1000 * percentile(latencies, 0.99), failed, served))
+        print(lines[-1] if len(lines) > 3 else '\n'.join(lines))
+        sys.stdout.flush()
+
+    if cert_dir:
+        shutil.rmtree(cert_dir)
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write('\n'.join(lines) + '\n\n')
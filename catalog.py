@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+"""
+Persistent catalog of the data files under the data root.
+
+Instead of walking the whole tree and comparing every file's mtime with the
+time of the last run, concat.py --catalog and old_score.py --catalog ask a
+SQLite catalog (by default ROOT_DIR/.catalog.sqlite) which files are new
+or changed since their last checkpoint. For every data file, the catalog
+keeps its site, subject and measure (from ROOT/SITE/SUBJECT/MEASURE/FILE),
+the date range in its name, its size, mtime, inode and SHA-1. A change is
+noticed by any difference in size, mtime or inode, even if the mtime went
+backwards (as when a file is unzipped with its original time), and counts
+only if the content differs too.
+
+ingest_latest_export.py updates the catalog for the files it writes, so that
+consumers need not walk the tree. scan picks up everything else (files copied
+in by hand, or written before the catalog existed), using os.scandir and
+hashing only the files whose size, mtime or inode changed; concat.py and
+old_score.py only run it when given --rescan. Every update that changes something gets a
+new version number, and consumers keep the version they have processed (per
+site, if they read only some sites' files):
+
+```python
+catalog = Catalog('/fitabase/fitabase-data/.catalog.sqlite', '/fitabase/fitabase-data')
+entries = catalog.pending('concat')
+...  # process the folders of the entries
+catalog.acknowledge('concat', entries)
+```
+
+Run as a script, it scans the data root:
+
+    ./catalog.py /fitabase/fitabase-data
+"""
+from __future__ import print_function
+import argparse
+from collections import namedtuple
+from contextlib import closing, contextmanager
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir  # Python 2 backport
+
+from compressed_csv import is_csv, strip_csv_suffix
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    site TEXT,
+    subject TEXT,
+    measure TEXT,
+    first_day TEXT,
+    last_day TEXT,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    inode INTEGER NOT NULL,
+    sha1 TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    removed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS files_version ON files (version);
+CREATE TABLE IF NOT EXISTS site_checkpoints (
+    consumer TEXT NOT NULL,
+    site TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (consumer, site)
+);
+"""
+
+Entry = namedtuple('Entry', ['path', 'site', 'subject', 'measure',
+                             'first_day', 'last_day', 'size', 'mtime',
+                             'inode', 'sha1', 'version', 'removed'])
+
+DATE_RANGE_PATTERN = re.compile(r'_(\d{8})_(\d{8})$')
+
+# Read buffer for hashing
+BUFFER_SIZE = 1024 * 1024
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(BUFFER_SIZE)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def describe(relative_path):
+    """
+    (site, subject, measure, first day, last day) of a data file, from its
+    path relative to the root and its name; unknown parts are None.
+    """
+    parts = relative_path.split(os.sep)
+    site, subject, measure = (parts[:-1] + [None] * 3)[:3]
+    found = DATE_RANGE_PATTERN.search(strip_csv_suffix(parts[-1]))
+    first_day, last_day = found.groups() if found else (None, None)
+    return site, subject, measure, first_day, last_day
+
+
+def _checkpoint_site(site):
+    # The checkpoint of a consumer that reads every site's files
+    return '' if site is None else site
+
+
+class Catalog(object):
+    """
+    The catalog in the SQLite database at `path` of the data files under
+    `root`. Every call uses its own connection, so a Catalog can be shared
+    by threads; concurrent writers wait up to `timeout` seconds.
+    """
+
+    def __init__(self, path, root, timeout=60):
+        self.path = path
+        self.root = os.path.abspath(root)
+        self.timeout = timeout
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _connect(self):
+        # Autocommit; writes go through _transaction
+        connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                     isolation_level=None)
+        # Creating the tables from several connections at once fails with
+        # "database schema has changed". Threads sharing this catalog create
+        # them once; other processes wait for the write lock.
+        with self._schema_lock:
+            if not self._schema_ready:
+                connection.executescript('BEGIN IMMEDIATE;' + SCHEMA +
+                                         'COMMIT;')
+                self._schema_ready = True
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """
+        A connection in a transaction that holds the write lock from the
+        start, so that concurrent writers don't hand out the same version.
+        """
+        with closing(self._connect()) as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def _relative(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root)
+
+    def _walk(self, directory):
+        """
+        Yield (relative path, stat) of the data files under directory,
+        skipping hidden directories and the output of concat.py.
+        """
+        for entry in scandir(directory):
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name != 'merged':
+                    for found in self._walk(entry.path):
+                        yield found
+            elif entry.is_file() and is_csv(entry.name):
+                yield self._relative(entry.path), entry.stat()
+
+    def _apply(self, connection, found, known, removed=()):
+        """
+        Record the files in `found` (relative path -> stat) whose size,
+        mtime or inode differ from `known` (relative path -> Entry), and
+        mark `removed` as such. Returns the number of files changed.
+        """
+        version = connection.execute(
+            'SELECT COALESCE(MAX(version), 0) + 1 FROM files').fetchone()[0]
+        changed = 0
+        for relative_path, st in found.items():
+            entry = known.get(relative_path)
+            if (entry is not None and not entry.removed
+                    and (entry.size, entry.mtime, entry.inode)
+                    == (st.st_size, st.st_mtime, st.st_ino)):
+                continue
+            sha1 = file_sha1(os.path.join(self.root, relative_path))
+            # Content unchanged (e.g. only touched): not a new version
+            new = entry is None or entry.removed or entry.sha1 != sha1
+            connection.execute(
+                'INSERT OR REPLACE INTO files VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)',
+                (relative_path,) + describe(relative_path) +
+                (st.st_size, st.st_mtime, st.st_ino, sha1,
+                 version if new else entry.version))
+            changed += new
+        for relative_path in removed:
+            connection.execute(
+                'UPDATE files SET removed = 1, version = ? WHERE path = ?',
+                (version, relative_path))
+            changed += 1
+        return changed
+
+    def _known(self, connection, prefix=None):
+        query = 'SELECT * FROM files'
+        parameters = ()
+        if prefix:
+            query += ' WHERE substr(path, 1, ?) = ?'
+            parameters = (len(prefix) + 1, prefix + os.sep)
+        return dict((row[0], Entry(*row))
+                    for row in connection.execute(query, parameters))
+
+    def scan(self, directory=None):
+        """
+        Bring the catalog up to date with the files under directory (by
+        default, the whole root). Returns the number of files that are new,
+        changed or gone.
+        """
+        directory = os.path.abspath(directory or self.root)
+        prefix = self._relative(directory)
+        prefix = None if prefix == os.curdir else prefix
+        found = dict(self._walk(directory))
+        with self._transaction() as connection:
+            known = self._known(connection, prefix)
+            gone = [path for path, entry in known.items()
+                    if path not in found and not entry.removed]
+            return self._apply(connection, found, known, gone)
+
+    def update(self, paths):
+        """
+        Record the given files (e.g. just written by ingest); like scan, it
+        ignores all but data files. Returns the number of files that are new
+        or changed.
+        """
+        found = dict((self._relative(path), os.stat(path)) for path in paths
+                     if is_csv(os.path.basename(path)))
+        if not found:
+            return 0
+        with self._transaction() as connection:
+            known = {}
+            for relative_path in found:
+                row = connection.execute('SELECT * FROM files WHERE path = ?',
+                                         (relative_path,)).fetchone()
+                if row:
+                    known[relative_path] = Entry(*row)
+            return self._apply(connection, found, known)
+
+    def pending(self, consumer, site=None):
+        """
+        List the Entries of the files that are new or changed (or removed)
+        since `consumer`'s checkpoint, in the order they were recorded;
+        optionally, only those of one site.
+        """
+        query = ('SELECT * FROM files WHERE version > COALESCE('
+                 '(SELECT version FROM site_checkpoints WHERE consumer = ? '
+                 'AND site = ?), 0)')
+        parameters = [consumer, _checkpoint_site(site)]
+        if site is not None:
+            query += ' AND site = ?'
+            parameters.append(site)
+        with closing(self._connect()) as connection:
+            return [Entry(*row) for row in
+                    connection.execute(query + ' ORDER BY version, path',
+                                       parameters)]
+
+    def acknowledge(self, consumer, entries, site=None):
+        """
+        Move the consumer's checkpoint past `entries` (as returned by
+        pending); `site` is the one that pending was given, if any.
+        """
+        if not entries:
+            return
+        version = max(entry.version for entry in entries)
+        with self._transaction() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO site_checkpoints (consumer, site, '
+                'version) VALUES (?, ?, MAX(?, COALESCE((SELECT version FROM '
+                'site_checkpoints WHERE consumer = ? AND site = ?), 0)))',
+                (consumer, _checkpoint_site(site), version, consumer,
+                 _checkpoint_site(site)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Update the catalog of the data files under a root.")
+    parser.add_argument('root_dir')
+    parser.add_argument('--catalog', default=None,
+            help="Catalog database (default: ROOT_DIR/.catalog.sqlite)")
+    args = parser.parse_args()
+    catalog = Catalog(args.catalog or
+                      os.path.join(args.root_dir, '.catalog.sqlite'),
+                      args.root_dir)
+    print('%d files new, changed or removed' % catalog.scan())
@@ -0,0 +1,134 @@
+"""
+Feed of the subjects and measures that got new data from each ingest.
+
+ingest_latest_export.py publishes a row per changed (site, subject,
+measure) of every batch to a SQLite table, by default in
+ROOT_DIR/.change_feed.sqlite. Downstream steps read the rows they have not
+consumed yet, do their work for just those subjects, and then move their
+cursor past them:
+
+```python
+feed = ChangeFeed('/fitabase/fitabase-data/.change_feed.sqlite')
+changes = feed.pending('score/UCSD', site='UCSD')
+...  # score set(change.subject for change in changes)
+feed.acknowledge('score/UCSD', changes, site='UCSD')
+```
+
+Every consumer (e.g. concat.py, or the scorer of one site) has its own
+cursor, and one per site if it reads only some sites' changes. min_time and max_time are ISO 8601 strings, and bound the times of
+the new data as far as ingest knows them.
+"""
+from collections import namedtuple
+from contextlib import closing
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS changes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    site TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    measure TEXT NOT NULL,
+    min_time TEXT,
+    max_time TEXT,
+    batch_id TEXT,
+    ingested_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cursors (
+    consumer TEXT NOT NULL,
+    site TEXT NOT NULL,
+    last_id INTEGER NOT NULL,
+    PRIMARY KEY (consumer, site)
+);
+"""
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+Change = namedtuple('Change', ['id', 'site', 'subject', 'measure', 'min_time',
+                               'max_time', 'batch_id', 'ingested_at'])
+
+
+def _format_time(value):
+    return value.strftime(TIME_FORMAT) if value is not None else None
+
+
+def _cursor_site(site):
+    # The cursor of a consumer that reads every site's changes
+    return '' if site is None else site
+
+
+class ChangeFeed(object):
+    """
+    The feed in the SQLite database at `path` (created if needed). Every
+    call uses its own connection, so one ChangeFeed can be shared by the
+    site worker threads; concurrent writers wait up to `timeout` seconds
+    for each other.
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.timeout)
+        # Creating the tables from several connections at once fails with
+        # "database schema has changed". Threads sharing this feed create
+        # them once; other processes wait for the write lock.
+        with self._schema_lock:
+            if not self._schema_ready:
+                connection.executescript('BEGIN IMMEDIATE;' + SCHEMA +
+                                         'COMMIT;')
+                self._schema_ready = True
+        return connection
+
+    def publish(self, site, batch_id, changes):
+        """
+        Add (subject, measure, min_time, max_time) changes, the times being
+        datetimes or None.
+        """
+        now = time.time()
+        rows = [(site, subject, measure, _format_time(min_time),
+                 _format_time(max_time), batch_id, now)
+                for subject, measure, min_time, max_time in changes]
+        if not rows:
+            return
+        with closing(self._connect()) as connection, connection:
+            connection.executemany(
+                'INSERT INTO changes (site, subject, measure, min_time, '
+                'max_time, batch_id, ingested_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows)
+
+    def pending(self, consumer, site=None):
+        """
+        List the Changes that `consumer` has not acknowledged yet, oldest
+        first; optionally, only those of one site.
+        """
+        query = ('SELECT * FROM changes WHERE id > COALESCE('
+                 '(SELECT last_id FROM cursors WHERE consumer = ? '
+                 'AND site = ?), 0)')
+        parameters = [consumer, _cursor_site(site)]
+        if site is not None:
+            query += ' AND site = ?'
+            parameters.append(site)
+        with closing(self._connect()) as connection:
+            return [Change(*row) for row in
+                    connection.execute(query + ' ORDER BY id', parameters)]
+
+    def acknowledge(self, consumer, changes, site=None):
+        """
+        Move the consumer's cursor past `changes` (as returned by pending);
+        `site` is the one that pending was given, if any.
+        """
+        if not changes:
+            return
+        last_id = max(change.id for change in changes)
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO cursors (consumer, site, last_id) '
+                'VALUES (?, ?, MAX(?, COALESCE((SELECT last_id FROM cursors '
+                'WHERE consumer = ? AND site = ?), 0)))',
+                (consumer, _cursor_site(site), last_id, consumer,
+                 _cursor_site(site)))
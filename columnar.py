@@ -0,0 +1,147 @@
+"""
+Typed, columnar copies of the members of a Fitabase batch export.
+
+Every night each site's export yields thousands of small CSVs, which
+concat.py and score/ then parse from text (dates included) over and over.
+ingest_latest_export.py --columnar-dir instead streams each member through
+convert_members, which parses it once, with the time columns typed as
+datetimes, and writes it as Parquet (or Arrow/Feather) into a directory
+partitioned by site, measure and subject (the dtypes and time formats come
+from measures.py):
+
+    COLUMNAR_DIR/site=UCSD/measure=heartrate_1min/subject=NDAR_INVXXX/
+        NDAR_INVXXX_heartrate_1min_20181101_20181114.parquet
+
+The key=value directory names are the "hive" layout, so the tree can also
+be read as one dataset with pyarrow.dataset or Spark. read_measure is the
+simple way to get a measure back as one DataFrame:
+
+```python
+hr = read_measure('/fitabase/columnar', 'heartrate_1min', site='UCSD')
+```
+
+pyarrow is only needed when columnar files are written or read; on Python 2,
+that means pyarrow 0.16 or older (see requirements.txt).
+"""
+import glob
+import io
+import os
+import tempfile
+import zipfile
+
+import pandas as pd
+
+import measures
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Output format -> file extension
+FORMATS = {'parquet': '.parquet', 'feather': '.arrow'}
+
+
+def require_pyarrow():
+    if pyarrow is None:
+        raise ImportError("Columnar files need pyarrow (pip install pyarrow)")
+
+
+def parse_member(fileobj, measure=None):
+    """
+    Read one exported CSV (a path or an open file) of `measure` into a
+    DataFrame typed as given by measures.py, its time index as datetimes.
+    """
+    return measures.read_csv(fileobj, measure)
+
+
+def columnar_path(root, site, measure, subject, member_name,
+                  columnar_format='parquet'):
+    """
+    Where the columnar copy of the export member `member_name` goes.
+    """
+    base = os.path.splitext(os.path.basename(member_name))[0]
+    return os.path.join(root, 'site=%s' % site, 'measure=%s' % measure,
+                        'subject=%s' % subject,
+                        base + FORMATS[columnar_format])
+
+
+def write_frame(frame, path):
+    """
+    Write a DataFrame to `path` (atomically, via a rename), in the format
+    given by the path's extension. Returns the number of bytes written.
+    """
+    require_pyarrow()
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    try:
+        if path.endswith(FORMATS['feather']):
+            # pyarrow <= 0.16 (the last release for Python 2) only writes 
+            # DataFrames to feather, not Tables
+            pyarrow.feather.write_feather(frame.reset_index(drop=True),
+                                          tmp_path)
+        else:
+            pyarrow.parquet.write_table(
+                pyarrow.Table.from_pandas(frame, preserve_index=False),
+                tmp_path)
+        os.rename(tmp_path, path)
+    except Exception:
+        # A failed write_feather removes the file itself
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return os.path.getsize(path)
+
+
+def read_frame(path):
+    require_pyarrow()
+    if path.endswith(FORMATS['feather']):
+        return pyarrow.feather.read_table(path).to_pandas()
+    return pyarrow.parquet.read_table(path).to_pandas()
+
+
+def convert_members(zip_path, members):
+    """
+    Convert (member name, destination path) pairs from the archive at
+    zip_path into columnar files; the destination directories must already
+    exist. Returns the number of bytes written.
+
+    Has the same signature as ingest_latest_export.extract_members, so that
+    it can be run by extract_members_parallel.
+    """
+    written = 0
+    with zipfile.ZipFile(zip_path) as site_zip:
+        for name, dest in members:
+            # In memory, so that it can be read again if it doesn't fit
+            # the measure's dtypes
+            with site_zip.open(name) as src:
+                data = io.BytesIO(src.read())
+            frame = parse_member(data, measures.measure_of(name))
+            written += write_frame(frame, dest)
+    return written
+
+
+def read_measure(root, measure, site=None, subject=None):
+    """
+    Read all columnar files of a measure (optionally, of one site and/or
+    subject) into one DataFrame, with `site` and `subject` columns added.
+    Returns None if there are none.
+    """
+    pattern = os.path.join(root, 'site=%s' % (site or '*'),
+                           'measure=%s' % measure,
+                           'subject=%s' % (subject or '*'), '*')
+    frames = []
+    for path in sorted(glob.glob(pattern)):
+        if os.path.splitext(path)[1] not in FORMATS.values():
+            continue
+        frame = read_frame(path)
+        subject_dir = os.path.dirname(path)
+        site_dir = os.path.dirname(os.path.dirname(subject_dir))
+        frame['site'] = os.path.basename(site_dir).split('=', 1)[1]
+        frame['subject'] = os.path.basename(subject_dir).split('=', 1)[1]
+        frames.append(frame)
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,89 @@
+"""
+Reading and writing the extracted CSVs either plain or compressed.
+
+Minute-level and heartrate files compress 10x or more, so with
+ingest_latest_export.py --compress the members are written as NAME.csv.gz
+(gzip) or NAME.csv.zst (zstd). concat.py and score/old_score.py use
+read_csv and the name helpers here, so that they take either form:
+
+```python
+if is_csv(name):
+    data = read_csv(os.path.join(folder, name))
+    start, end = strip_csv_suffix(name).split('_')[-2:]
+```
+
+zstd needs the zstandard package, but only when such files are written or
+read.
+"""
+import gzip
+import shutil
+
+import pandas as pd
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compression -> suffix appended to ".csv"
+COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+CSV_SUFFIXES = tuple(['.csv'] + ['.csv' + suffix
+                                 for suffix in sorted(COMPRESSIONS.values())])
+
+# Read / write buffer
+BUFFER_SIZE = 1024 * 1024
+
+
+def require_zstandard():
+    if zstandard is None:
+        raise ImportError("zstd-compressed CSVs need zstandard "
+                          "(pip install zstandard)")
+
+
+def is_csv(name):
+    return name.endswith(CSV_SUFFIXES)
+
+
+def strip_csv_suffix(name):
+    """
+    NAME.csv, NAME.csv.gz or NAME.csv.zst -> NAME (other names unchanged).
+    """
+    for suffix in sorted(CSV_SUFFIXES, key=len, reverse=True):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def read_csv(path, **kwargs):
+    """
+    pandas.read_csv of a plain or compressed CSV file.
+    """
+    if path.endswith(COMPRESSIONS['zstd']):
+        require_zstandard()
+        with open(path, 'rb') as f:
+            reader = zstandard.ZstdDecompressor().stream_reader(f)
+            return pd.read_csv(reader, **kwargs)
+    # pandas recognizes .gz by itself
+    return pd.read_csv(path, **kwargs)
+
+
+def write_compressed(src, dst, compression):
+    """
+    Copy the open file src into the open binary file dst, compressed with
+    `compression` (a COMPRESSIONS key). The gzip header carries no time
+    stamp, so that the same content always compresses to the same bytes
+    (which keeps content_store.py deduplicating).
+    """
+    if compression == 'gzip':
+        compressed = gzip.GzipFile(filename='', mode='wb', fileobj=dst,
+                                   mtime=0)
+        shutil.copyfileobj(src, compressed, BUFFER_SIZE)
+        compressed.close()
+    elif compression == 'zstd':
+        require_zstandard()
+        compressed = zstandard.ZstdCompressor().stream_writer(dst)
+        shutil.copyfileobj(src, compressed, BUFFER_SIZE)
+        compressed.flush(zstandard.FLUSH_FRAME)
+    else:
+        raise ValueError('Unknown compression: %s' % compression)
@@ -5,18 +5,38 @@ Concatenate all csv files within a measurement type folder and place resulting
 csv into a folder named `merged` within the NDAR folder.
 This script requires 2 arguments, the root directory for all site data, and a
 location to store a file containing the last time this script was runself.
+If a third argument gives the change feed of ingest_latest_export.py, only the
+folders with changes since the last run are processed (see change_feed.py).
+With --catalog, only the files that the catalog of the data root has as new
+since the last run are processed (see catalog.py). ingest_latest_export.py
+keeps the catalog up to date; --rescan also has the whole root scanned first,
+for files that got there some other way.
+With --partition-by-month, each measure is merged into `merged/<measure>/`, one
+YYYY-MM.csv file per month, and only the months with new data are rewritten;
+read_merged reads either form as one data frame.
 
-Usage: python concat.py <root dir containing sites> <timestamp location>
+Folders are processed in parallel with --jobs N; a folder that fails doesn't
+stop the others, but the timestamp is then not recorded. Folders not named for
+a known measure (see measures.py) are skipped.
+
+Usage: python concat.py [--partition-by-month] [--jobs N] [--catalog [--rescan]] <root dir containing sites> <timestamp location> [<change feed>]
 eg: python concat.py /external_data/fitabase-data /external_data/fitabase-data/last_process.txt
 """
 
 from __future__ import print_function
+import argparse
 import csv
 import sys
 import os
 import math
+import traceback
 import pandas as pd
+from multiprocessing import Pool
 from time import time
+from catalog import Catalog
+from change_feed import ChangeFeed
+from compressed_csv import is_csv
+import measures
 
 
 def get_timestamp(file):
@@ -44,65 +64,204 @@ def find_dirs(root_dir, timestamp, ignore_dirs):
         for root, dirs, files in os.walk(folder):
             if not dirs and os.path.basename(root) != "merged":
                 folders.add(root)
+            # Don't descend into hidden dirs, like the content store of
+            # `ingest_latest_export.py --dedup`, or into the merged partitions
+            dirs[:] = [d for d in dirs if not d.startswith(".") and d != "merged"]
     return folders
 
-def column_to_index(folder_name):
-    """Helper function to determine which column
-    to use as index for combining dataframes.
+def changed_since(path, timestamp):
+    """Whether the file was written, or linked into place, after timestamp.
+    (A new hardlink to a deduplicated file keeps the old modification time,
+    but its inode change time is updated.)
+    """
+    st = os.stat(path)
+    return max(st.st_mtime, st.st_ctime) > timestamp
+
+def merge_frames(frames, index_key):
+    """Merge data frames, ordered oldest to newest, on their index_key column
+    (or list of columns).
+    This gives what folding them with combine_first does (for each key, the
+    newest non-empty value of each column wins, and rows are sorted by key),
+    but in one pass: the frames are concatenated once, then grouped by key.
+    Rows without a key (say, a missing time) can't be merged, and come after
+    the others, each distinct row once.
+    """
+    combined = pd.concat(frames, ignore_index=True, sort=False)
+    unkeyed = combined[index_key].isnull()
+    if isinstance(unkeyed, pd.DataFrame):
+        unkeyed = unkeyed.any(axis=1)
+    # groupby leaves out the rows with missing keys
+    merged = combined[~unkeyed].groupby(index_key, sort=True).last().reset_index()
+    merged = merged[combined.columns]
+    if unkeyed.any():
+        merged = pd.concat([merged, combined[unkeyed].drop_duplicates()], ignore_index=True, sort=False)
+    return merged
+
+def month_partitions(frame, index_key):
+    """Month (YYYY-MM, or "unknown" if the time can't be parsed) of each row.
+    """
+    times = measures.parse_times(frame[index_key])
+    # (Older pandas formats NaT as "NaT", rather than leaving it missing)
+    return times.dt.strftime("%Y-%m").where(times.notnull(), "unknown").values
+
+def write_month_partitions(partition_dir, frame, measure):
+    """Merge the rows of frame, a measure's data, into the monthly partitions
+    of partition_dir (YYYY-MM.csv), rewriting only the months that the rows
+    fall in.
+    """
+    schema = measures.get(measure)
+    for month, rows in frame.groupby(month_partitions(frame, schema.index)):
+        partition_loc = os.path.join(partition_dir, month + ".csv")
+        if os.path.isfile(partition_loc):
+            rows = merge_frames([measures.read_csv(partition_loc, measure, parse_index=False), rows], list(schema.key))
+        # Write next to the partition, then rename, so readers never see half of it
+        measures.write_csv(rows, partition_loc + ".tmp", measure)
+        os.rename(partition_loc + ".tmp", partition_loc)
+
+def read_merged(path, measure=None):
+    """Read a merged measure, whether `merged/<measure>.csv` or the monthly
+    partitions in `merged/<measure>/`, as one data frame (partitions in
+    month order), typed as given by measures.py. Other paths are read as a
+    CSV file, of the measure their name tells if it isn't given.
     """
-    if folder_name in {"30secondSleepStages", "heartrate_1min", "heartrate"}:
-        return "Time"
-    elif folder_name in {"minuteCaloriesNarrow", "minuteIntensitiesNarrow", "minuteMETsNarrow", "minuteStepsNarrow"}:
-        return "ActivityMinute"
-    elif folder_name == "minuteSleep":
-        return "date"
-    elif folder_name in {"sleepDay", "sleepStagesDay"}:
-        return "SleepDay"
-    elif folder_name in {"activitylogs", "sleepLogInfo", "sleepStageLogInfo"}:
-        return "StartTime"
-    elif folder_name == "battery":
-        return "DateTime"
-    elif folder_name == "dailyActivity":
-        return "ActivityDate"
-    elif folder_name == "dailySteps":
-        return "ActivityDay"
-
-def process_concat(folders, timestamp):
-    """Find which data files were created since last job
-    and concatenate them into 'merged.csv' within that folder.
+    if not os.path.isdir(path):
+        return measures.read_csv(path, measure)
+    measure = measure or measures.measure_of(os.path.basename(os.path.normpath(path)))
+    partitions = sorted(file for file in os.listdir(path) if is_csv(file))
+    return pd.concat([measures.read_csv(os.path.join(path, file), measure) for file in partitions], ignore_index = True, sort = False)
+
+def concat_folder(folder, timestamp, partition_by_month=False, new_files=None):
+    """Find which data files in one measurement type folder were created
+    since last job (or take the names in new_files, if given) and concatenate
+    them into 'merged.csv' within that folder (or into its monthly partitions,
+    with partition_by_month).
     """
-    for folder in folders:
-        # Merged folder:
-        ndar_folder = os.path.dirname(folder)
-        merged_folder = os.path.join(ndar_folder, "merged")
-        folder_name = os.path.basename(folder)
-        merged_file_loc = os.path.join(merged_folder, folder_name + ".csv")
+    # Merged folder:
+    ndar_folder = os.path.dirname(folder)
+    merged_folder = os.path.join(ndar_folder, "merged")
+    folder_name = os.path.basename(folder)
+    merged_file_loc = os.path.join(merged_folder, folder_name + ".csv")
+    partition_dir = os.path.join(merged_folder, folder_name)
+    if partition_by_month:
+        if not os.path.isdir(partition_dir):
+            os.makedirs(partition_dir)
+        already_merged = any(is_csv(file) for file in os.listdir(partition_dir))
+    else:
         if not os.path.isdir(merged_folder):
             os.makedirs(merged_folder)
+        already_merged = os.path.isfile(merged_file_loc)
+
+    # Find which files to process - do all if merged file not found
+    if already_merged and new_files is not None:
+        files_to_process = [file for file in new_files if os.path.isfile(os.path.join(folder, file))]
+    elif already_merged:
+        files_to_process = [file for file in os.listdir(folder) if changed_since(os.path.join(folder, file), timestamp)]
+    else:
+        files_to_process = [file for file in os.listdir(folder)]
+    files_to_process.sort()
+    # Stop if no new files
+    if len(files_to_process) < 1:
+        return
 
-        # Find which files to process - do all if merged file not found
-        if os.path.isfile(merged_file_loc):
-            files_to_process = [file for file in os.listdir(folder) if os.path.getmtime(os.path.join(folder, file)) > timestamp]
-        else:
-            files_to_process = [file for file in os.listdir(folder)]
-        files_to_process.sort()
-        # Stop if no new files
-        if len(files_to_process) < 1:
+    # Oldest first: the current merged file, then the new files in order
+    # (the partitions are merged with the new data month by month)
+    if already_merged and not partition_by_month:
+        frames = [measures.read_csv(merged_file_loc, folder_name, parse_index=False)]
+    else:
+        frames = []
+    # Files hardlinked to the same content need only be merged once
+    seen = set()
+    for file in files_to_process:
+        st = os.stat(os.path.join(folder, file))
+        if (st.st_dev, st.st_ino) in seen:
             continue
+        seen.add((st.st_dev, st.st_ino))
+        frames.append(measures.read_csv(os.path.join(folder, file), folder_name, parse_index=False))
+    # Get the columns to merge on (the times as exported, so that they are
+    # written back exactly as they were, in the same order as before)
+    merged_df = merge_frames(frames, list(measures.get(folder_name).key))
 
-        if os.path.isfile(merged_file_loc):
-            merged_df = pd.read_csv(merged_file_loc)
-        else:
-            merged_df = pd.read_csv(os.path.join(folder, files_to_process[0]))
-        # Get column name to merge on
-        index_key = column_to_index(folder_name)
-        for file in files_to_process:
-            file_df = pd.read_csv(os.path.join(folder, file))
-            merged_df = file_df.set_index(index_key, drop = False).combine_first(merged_df.set_index(index_key, drop = False))
+    # Don't actually create the file if there is no data
+    if merged_df.empty:
+        return
+    if partition_by_month:
+        write_month_partitions(partition_dir, merged_df, folder_name)
+    else:
+        measures.write_csv(merged_df, merged_file_loc, folder_name)
 
-        # Don't actually create the file if there is no data
-        if not merged_df.empty:
-            merged_df.to_csv(merged_file_loc, index = False)
+def folder_size(folder):
+    """Total size of the data files in a folder."""
+    return sum(os.path.getsize(os.path.join(folder, file)) for file in os.listdir(folder))
+
+def _concat_folder_safely(job):
+    """Run concat_folder, returning (folder, traceback of the error or None)
+    rather than raising, so that one bad folder doesn't stop the others.
+    """
+    folder = job[0]
+    try:
+        concat_folder(*job)
+        return folder, None
+    except Exception:
+        return folder, traceback.format_exc()
+
+def process_concat(folders, timestamp, partition_by_month=False, jobs=1, new_files=None):
+    """Run concat_folder for each of the folders, in a pool of `jobs`
+    processes if jobs > 1. The largest folders go first, so that no big one
+    is left running alone at the end. An error in one folder is printed and
+    the other folders still processed; returns the folders that failed.
+    new_files, if given, maps each folder to the names of its new files.
+    """
+    folders = sorted(folders, key=folder_size, reverse=True)
+    work = [(folder, timestamp, partition_by_month, new_files and new_files.get(folder, [])) for folder in folders]
+    if jobs > 1 and len(work) > 1:
+        pool = Pool(jobs)
+        try:
+            results = list(pool.imap_unordered(_concat_folder_safely, work))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_concat_folder_safely(job) for job in work]
+
+    failed = []
+    for folder, error in results:
+        if error is not None:
+            print("Error! Could not process %s:\n%s" % (folder, error), file = sys.stderr)
+            failed.append(folder)
+    return failed
+
+def changed_dirs(root_dir, changes):
+    """Find the measurement type folders (SITE/SUBJECT/MEASURE) that have
+    changes from the change feed.
+    """
+    folders = set()
+    for change in changes:
+        folder = os.path.join(root_dir, change.site, change.subject, change.measure)
+        if os.path.isdir(folder):
+            folders.add(folder)
+    return folders
+
+def catalog_dirs(root_dir, entries):
+    """Map the measurement type folders with new or changed files in the
+    catalog entries to the names of those files.
+    """
+    new_files = {}
+    for entry in entries:
+        if entry.removed:
+            continue
+        path = os.path.join(root_dir, entry.path)
+        new_files.setdefault(os.path.dirname(path), []).append(os.path.basename(path))
+    return new_files
+
+def measure_dirs(folders):
+    """Leave out the folders that are not named for a known measure, such as
+    the date folders of `ingest_latest_export.py --no-subject-subdirs`; they
+    would fail again on every run, so they are only reported.
+    """
+    skipped = {folder for folder in folders if os.path.basename(folder) not in measures.MEASURES}
+    for folder in sorted(skipped):
+        print("Skipping %s: not a measurement type folder." % folder, file = sys.stderr)
+    return set(folders) - skipped
 
 def log_timestamp(file, start_time):
     """Output the time this processing job began
@@ -116,21 +275,53 @@ def main():
     """Main function to collate all the other functions into one call.
     """
     # Housekeeping
-    if len(sys.argv) != 3:
-        print("Error! Please specify the root location of sites and a file location to store processing timestamp. \nUsage: concatenate_data.py <root directory of fitabase data> <timestamp file location>", file = sys.stderr)
-        exit(-1)
+    parser = argparse.ArgumentParser(description = "Concatenate each measurement type folder into the `merged` folder of its NDAR folder.")
+    parser.add_argument("root_dir", help = "root directory of fitabase data (containing the sites)")
+    parser.add_argument("timestamp_file", help = "file that stores the time of the last processing job")
+    parser.add_argument("change_feed", nargs = "?", default = None, help = "only process the folders listed in this change feed (see change_feed.py)")
+    parser.add_argument("--partition-by-month", action = "store_true", help = "merge into merged/<measure>/YYYY-MM.csv")
+    parser.add_argument("--jobs", "-j", type = int, default = 1, help = "number of folders processed in parallel")
+    parser.add_argument("--catalog", action = "store_true", help = "process the files that the catalog in <root dir>/.catalog.sqlite lists as new since the last run with --catalog (see catalog.py)")
+    parser.add_argument("--rescan", action = "store_true", help = "with --catalog, scan the whole root directory into the catalog first")
+    args = parser.parse_args()
+    if args.catalog and args.change_feed:
+        parser.error("use either a change feed or --catalog")
+    if args.rescan and not args.catalog:
+        parser.error("--rescan needs --catalog")
     # Set up varialbes for functions from system arguements
-    root_dir = sys.argv[1]
-    timestamp_file_loc = sys.argv[2]
+    root_dir = args.root_dir
+    timestamp_file_loc = args.timestamp_file
     # Sub-folders to ignore
     pilot_studies = {"2018-Q2-pilot", "2018-Q3-testing"}
     # Record when this job started
     start_time = time()
     # Start job
     timestamp = get_timestamp(timestamp_file_loc)
-    folders_to_process = find_dirs(root_dir, timestamp, pilot_studies)
-    process_concat(folders_to_process, timestamp)
+    new_files = None
+    if args.change_feed:
+        feed = ChangeFeed(args.change_feed)
+        changes = feed.pending("concat")
+        folders_to_process = changed_dirs(root_dir, [change for change in changes if change.site not in pilot_studies])
+    elif args.catalog:
+        # The catalog answers "what's new" just like a change feed
+        feed = Catalog(os.path.join(root_dir, ".catalog.sqlite"), root_dir)
+        if args.rescan:
+            feed.scan()
+        changes = feed.pending("concat")
+        new_files = catalog_dirs(root_dir, [entry for entry in changes if entry.site not in pilot_studies])
+        folders_to_process = set(new_files)
+    else:
+        feed = None
+        folders_to_process = find_dirs(root_dir, timestamp, pilot_studies)
+    folders_to_process = measure_dirs(folders_to_process)
+    failed = process_concat(folders_to_process, timestamp, args.partition_by_month, args.jobs, new_files)
+    # If any folder failed, its files must be picked up again next time
+    if failed:
+        print("Error! %d of %d folders failed; not recording the timestamp." % (len(failed), len(folders_to_process)), file = sys.stderr)
+        exit(1)
     log_timestamp(timestamp_file_loc, start_time)
+    if feed is not None:
+        feed.acknowledge("concat", changes)
 
 if __name__ == "__main__":
     main()
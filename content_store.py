@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+Content-addressed store for extracted batch export members.
+
+Each nightly_past14d export repeats most of the previous night's files, so
+ingest_latest_export.py --dedup writes every member into the store under
+the SHA-1 of its content, once, and hardlinks it to its place in the data
+tree. Identical members, whatever their name or subject folder, then take
+up the disk space of one file. (The store must be on the same filesystem as
+the data tree, so by default it is TARGET_DIR/.objects.)
+
+Imagined use:
+
+```python
+store = ContentStore(os.path.join(target_dir, '.objects'))
+with site_zip.open(name) as src:
+    digest, new = store.put(src, os.path.join(subject_dir, name))
+print(store.report())
+```
+
+Run as a script, it prints the space saved by a store:
+
+    ./content_store.py /fitabase/fitabase-data/UCSD/.objects
+"""
+from __future__ import print_function
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+
+# Read / write buffer when storing members
+BUFFER_SIZE = 1024 * 1024
+
+
+class ContentStore(object):
+    """
+    Files stored as ROOT/ab/cdef... by the SHA-1 (ab + cdef...) of their
+    content. An object's link count tells how many files in the data tree
+    refer to it.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def object_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def put(self, src, dest):
+        """
+        Copy the open file src into the store, and hardlink dest (replacing
+        any existing file) to the stored object. Returns the SHA-1 and
+        whether the content was new to the store.
+
+        If dest cannot be hardlinked (say, it is on another filesystem), it
+        is written as a plain copy instead.
+        """
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                if not os.path.isdir(self.root):
+                    raise
+        sha1 = hashlib.sha1()
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                while True:
+                    chunk = src.read(BUFFER_SIZE)
+                    if not chunk:
+                        break
+                    sha1.update(chunk)
+                    tmp.write(chunk)
+            digest = sha1.hexdigest()
+            path = self.object_path(digest)
+            new = not os.path.isfile(path)
+            if new:
+                directory = os.path.dirname(path)
+                if not os.path.isdir(directory):
+                    try:
+                        os.mkdir(directory)
+                    except OSError:  # Created by another worker meanwhile
+                        if not os.path.isdir(directory):
+                            raise
+                # Another worker storing the same content just replaces it
+                os.rename(tmp_path, path)
+            else:
+                os.remove(tmp_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if os.path.lexists(dest):
+            os.remove(dest)
+        try:
+            os.link(path, dest)
+        except OSError:
+            shutil.copyfile(path, dest)
+        return digest, new
+
+    def objects(self):
+        """
+        Yield (path, os.stat result) of every stored object.
+        """
+        if not os.path.isdir(self.root):
+            return
+        for prefix in sorted(os.listdir(self.root)):
+            directory = os.path.join(self.root, prefix)
+            if len(prefix) != 2 or not os.path.isdir(directory):
+                continue
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                yield path, os.stat(path)
+
+    def report(self):
+        """
+        Return a dict of the number of objects and of references to them,
+        the bytes those references would take up as separate files
+        (`logical_bytes`), the bytes actually stored, and the difference.
+        """
+        stats = dict(objects=0, references=0, logical_bytes=0,
+                     stored_bytes=0)
+        for _, st in self.objects():
+            references = st.st_nlink - 1
+            stats['objects'] += 1
+            stats['references'] += references
+            stats['logical_bytes'] += st.st_size * references
+            stats['stored_bytes'] += st.st_size
+        stats['saved_bytes'] = stats['logical_bytes'] - stats['stored_bytes']
+        return stats
+
+    def prune(self):
+        """
+        Remove objects that no file in the data tree refers to any more.
+        Returns the number removed.
+        """
+        removed = 0
+        for path, st in list(self.objects()):
+            if st.st_nlink < 2:
+                os.remove(path)
+                removed += 1
+        return removed
+
+
+def format_report(stats):
+    mb = 1024.0 * 1024
+    return ('%d objects, %d references: %.1f MB stored for %.1f MB of files '
+            '(%.1f MB saved)' % (stats['objects'], stats['references'],
+                                 stats['stored_bytes'] / mb,
+                                 stats['logical_bytes'] / mb,
+                                 stats['saved_bytes'] / mb))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Report the space saved by content stores.")
+    parser.add_argument('store_dir', nargs='+')
+    parser.add_argument('--prune', action='store_true',
+            help="First remove objects no longer referred to (only while "
+                 "no ingest is running)")
+    args = parser.parse_args()
+    for store_dir in args.store_dir:
+        store = ContentStore(store_dir)
+        if args.prune:
+            print('%s: pruned %d objects' % (store_dir, store.prune()))
+        print('%s: %s' % (store_dir, format_report(store.report())))
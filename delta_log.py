@@ -0,0 +1,117 @@
+"""
+Row-level deltas of the nightly batch exports.
+
+A nightly_past14d export repeats 13 days that were already ingested the
+night before. ingest_latest_export.py --delta-dir keeps, per subject and
+measure, a high-water mark (the last time seen), and appends only the rows
+after it, less a look-back window for rows Fitabase revised late, to an
+append log per subject and measure:
+
+    DELTA_DIR/SITE/SUBJECT/MEASURE.csv
+
+The logs have the columns of the exported files. Because of the look-back,
+a row can appear more than once; the last copy is the current one.
+
+Imagined use:
+
+```python
+marks = HighWaterMarks(os.path.join(delta_dir, 'UCSD', '.high_water_marks.json'))
+since = marks.since(subject, measure, lookback=datetime.timedelta(hours=24))
+rows, first, last = append_new_rows(site_zip.open(name), measure,
+                                    log_path, since)
+marks.update(subject, measure, last)
+marks.save()
+```
+"""
+# Imported up front: the first strptime imports it lazily, and on Python 2 
+# doing that from several site threads at once can fail with AttributeError
+import _strptime  # noqa: F401
+import datetime
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+import measures
+
+MARK_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class HighWaterMarks(object):
+    """
+    The last time seen for each subject and measure, persisted as JSON in
+    `path`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.marks = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.marks = json.load(f)
+
+    @staticmethod
+    def _key(subject, measure):
+        return '%s/%s' % (subject, measure)
+
+    def get(self, subject, measure):
+        mark = self.marks.get(self._key(subject, measure))
+        return mark and datetime.datetime.strptime(mark, MARK_FORMAT)
+
+    def since(self, subject, measure, lookback=datetime.timedelta(0)):
+        """
+        The time after which rows are new (None if all of them are).
+        """
+        mark = self.get(subject, measure)
+        return mark and mark - lookback
+
+    def update(self, subject, measure, time):
+        if time is None:
+            return
+        mark = self.get(subject, measure)
+        if mark is None or time > mark:
+            self.marks[self._key(subject, measure)] = time.strftime(MARK_FORMAT)
+
+    def save(self):
+        """
+        Write the marks (atomically, via a rename).
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.marks, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+def append_new_rows(src, measure, log_path, since=None):
+    """
+    Append the rows of the exported CSV src (a path or an open file) whose
+    time is after `since` to the CSV at log_path, which gets a header if it
+    is new. Rows whose time cannot be parsed are always appended.
+
+    Returns the number of rows appended, and the first and last time among
+    them (None if there are none). Raises ValueError if the measure's time
+    column is not known.
+    """
+    # Read as text, so that the rows are written back exactly as exported
+    frame = pd.read_csv(src, dtype=str, keep_default_na=False)
+    schema = measures.MEASURES.get(measure)
+    if schema is None or schema.index not in frame.columns:
+        raise ValueError('No time column known for %s' % measure)
+    times = measures.parse_times(frame[schema.index], schema.time_format)
+    if since is not None:
+        keep = (times.isnull() | (times > since)).values
+        frame = frame[keep]
+        times = times[keep]
+    if frame.empty:
+        return 0, None, None
+
+    write_header = not os.path.isfile(log_path)
+    with open(log_path, 'a') as f:
+        frame.to_csv(f, header=write_header, index=False)
+    times = times.dropna()
+    if times.empty:
+        return len(frame), None, None
+    return (len(frame), times.min().to_pydatetime(),
+            times.max().to_pydatetime())
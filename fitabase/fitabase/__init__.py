@@ -11,4 +11,9 @@ At this time, the Fitabase API is read-only.
 
 """
 
+from .cache import ResponseCache
+from .metrics import RequestMetrics
 from .project import Project
+from .retry import DeadlineExceeded, FitabaseAPIError, RetryPolicy
+from .transport import CurlTransport, RecordingTransport, ReplayTransport, \
+        RequestsTransport, cassette_transport
@@ -0,0 +1,86 @@
+"""
+Optional on-disk cache for slow-changing API responses (e.g. Profiles/).
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+DEFAULT_CACHE_DIR = os.environ.get('FITABASE_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'fitabase'))
+
+
+class ResponseCache(object):
+    """
+    Store decoded JSON responses as files, one per (token, endpoint) pair.
+
+    Entries older than `ttl` seconds are treated as missing. Once the cache
+    directory holds more than `max_bytes`, the least recently written entries
+    are evicted. The token itself is never written to disk; entries are keyed
+    by a hash of it, so sites sharing a cache directory never see each other's
+    responses.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, ttl=3600,
+            max_bytes=32 * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, token, endpoint):
+        token_hash = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        key = hashlib.sha256(
+                ('%s\n%s' % (token_hash, endpoint)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, token, endpoint):
+        """
+        Return the cached response, or None if it is absent or expired.
+        """
+        path = self._path(token, endpoint)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, token, endpoint, data):
+        """
+        Store a response, then evict old entries if over the size limit.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, self._path(token, endpoint))
+        self._evict()
+
+    def invalidate(self, token, endpoint):
+        try:
+            os.remove(self._path(token, endpoint))
+        except OSError:
+            pass
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:  # removed by a concurrent process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,197 @@
+"""
+Resumable, multi-connection download of large files (batch export archives).
+
+The file is fetched in fixed-size byte ranges over several connections where
+the server honours HTTP Range requests, and as a single stream where it does
+not. Progress is kept next to the partial file, so an interrupted download
+picks up where it left off the next time it is started with the same path.
+"""
+import json
+import os
+import re
+import threading
+from multiprocessing.pool import ThreadPool
+from zipfile import BadZipfile, ZipFile
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+CONTENT_RANGE = re.compile(r'^content-range:\s*bytes\s+(\d+)-(\d+)/(\d+)',
+                           re.IGNORECASE)
+
+
+class RangedDownloader(object):
+    """
+    Download one resource to `path`, in parallel byte ranges when possible.
+
+    `perform(extra_headers, buf, on_head)` makes the request with the given
+    extra header lines, writing the body into buf (after rewinding it, as
+    for every retry), and returns its (status, header lines). on_head is as
+    for transport.CurlTransport.perform. (A Project supplies it, so that the
+    download shares its transport, rate limiter and retries.)
+
+    While in progress, data lives in `path + '.part'` and the set of finished
+    chunks in `path + '.progress'`. Only a completed download is moved to
+    `path`.
+    """
+
+    def __init__(self, perform, connections=4, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.perform = perform
+        self.connections = max(1, connections)
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+
+    def download(self, path, validate=None):
+        """
+        Fetch the resource to path and return path.
+
+        If given, validate(part_path) is called on the finished partial file
+        before it is moved into place; if it raises, the partial file and its
+        progress are discarded so that the next attempt starts from scratch.
+        """
+        part_path = path + '.part'
+        progress_path = path + '.progress'
+        progress = self._load_progress(part_path, progress_path)
+
+        if progress is None:
+            # Fetching the first chunk also tells us whether ranges are
+            # supported and how large the whole file is
+            with open(part_path, 'wb') as f:
+                pass
+            total = self._fetch_range(part_path, 0, self.chunk_size - 1)
+            if total is None:
+                # Server sent the whole body in one go; nothing to resume
+                return self._finish(path, part_path, progress_path, validate)
+            progress = {'size': total, 'chunk_size': self.chunk_size,
+                        'done': [0]}
+            self._save_progress(progress_path, progress)
+
+        chunks = [i for i in range(self._chunk_count(progress))
+                  if i not in set(progress['done'])]
+
+        def fetch_chunk(index):
+            start = index * self.chunk_size
+            end = min(start + self.chunk_size, progress['size']) - 1
+            self._fetch_range(part_path, start, end, expect_partial=True)
+            with self._lock:
+                progress['done'].append(index)
+                self._save_progress(progress_path, progress)
+
+        if chunks:
+            pool = ThreadPool(min(self.connections, len(chunks)))
+            try:
+                pool.map(fetch_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+
+        return self._finish(path, part_path, progress_path, validate)
+
+    def _chunk_count(self, progress):
+        return (progress['size'] + self.chunk_size - 1) // self.chunk_size
+
+    def _load_progress(self, part_path, progress_path):
+        """
+        Return saved progress if it belongs to a usable partial file.
+        """
+        if not (os.path.isfile(part_path) and os.path.isfile(progress_path)):
+            return None
+        try:
+            with open(progress_path) as f:
+                progress = json.load(f)
+        except ValueError:
+            return None
+        if (progress.get('chunk_size') != self.chunk_size
+                or os.path.getsize(part_path) > progress.get('size', -1)):
+            return None
+        return progress
+
+    def _save_progress(self, progress_path, progress):
+        tmp_path = progress_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(progress, f)
+        os.rename(tmp_path, progress_path)
+
+    def _fetch_range(self, part_path, start, end, expect_partial=False):
+        """
+        Write bytes start..end of the resource into part_path at offset start.
+
+        Returns the total size of the resource as reported by the server, or
+        None if the server ignored the range and sent the full body (which is
+        then what ends up in part_path).
+        """
+        def on_head(status, headers):
+            # An error body must not end up in the file. And a server
+            # ignoring the range would otherwise overwrite other chunks from
+            # this offset on; refuse the body instead
+            if not 200 <= status < 300:
+                return False
+            return not expect_partial or status == 206
+
+        # (The Range option of curl is only honoured for GET, and the API
+        # wants POST)
+        with open(part_path, 'r+b') as f:
+            status, headers = self.perform(
+                    ['Range: bytes=%d-%d' % (start, end)],
+                    _RangeBuffer(f, start), on_head)
+            if status == 200 and not expect_partial:
+                f.truncate()
+                return None
+
+        if status != 206:
+            raise IOError('Range request %d-%d failed with HTTP status %d'
+                          % (start, end, status))
+        for line in headers:
+            match = CONTENT_RANGE.match(line.strip())
+            if match:
+                return int(match.group(3))
+        raise IOError('Range request %d-%d returned no Content-Range'
+                      % (start, end))
+
+    def _finish(self, path, part_path, progress_path, validate):
+        if validate is not None:
+            try:
+                validate(part_path)
+            except Exception:
+                os.remove(part_path)
+                if os.path.exists(progress_path):
+                    os.remove(progress_path)
+                raise
+        os.rename(part_path, path)
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+        return path
+
+
+class _RangeBuffer(object):
+    """
+    The partial file seen from `offset` on, as the buffer of one range
+    request. Rewinding it for a retry goes back to `offset`; the retry then
+    overwrites the range, so truncating it does nothing (the file beyond
+    the range belongs to other chunks).
+    """
+
+    def __init__(self, f, offset):
+        self.f = f
+        self.offset = offset
+        f.seek(offset)
+
+    def seek(self, position):
+        self.f.seek(self.offset + position)
+
+    def truncate(self):
+        pass
+
+    def write(self, data):
+        self.f.write(data)
+
+
+def verify_zipfile(path):
+    """
+    Check that path is an intact zip archive: the central directory must be
+    readable and every member must match its stored CRC. Raises BadZipfile
+    otherwise.
+    """
+    with ZipFile(path) as zf:
+        bad_member = zf.testzip()
+    if bad_member is not None:
+        raise BadZipfile('CRC mismatch in %s of %s' % (bad_member, path))
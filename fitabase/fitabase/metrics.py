@@ -0,0 +1,169 @@
+"""
+In-process instrumentation of Fitabase API requests.
+
+A RequestMetrics instance is handed to one or more Projects, which report
+every request to it; at the end of a run it can be dumped as JSON or as a
+Prometheus textfile (for node_exporter's textfile collector).
+"""
+from collections import defaultdict
+import json
+import os
+import re
+import tempfile
+import threading
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+ID_SEGMENT = re.compile(r'^[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?'
+                        r'[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}$')
+DATE_SEGMENT = re.compile(r'^\d{1,4}-\d{1,2}-\d{1,4}$')
+
+
+def endpoint_template(api_path):
+    """
+    Replace the variable parts of an API path, so that requests can be
+    grouped: 'Sync/Latest/5822ade8-...' becomes 'Sync/Latest/{id}'.
+    """
+    segments = []
+    for segment in api_path.split('/'):
+        if ID_SEGMENT.match(segment):
+            segment = '{id}'
+        elif DATE_SEGMENT.match(segment):
+            segment = '{date}'
+        segments.append(segment)
+    return '/'.join(segments)
+
+
+class RequestMetrics(object):
+    """
+    Thread-safe counters and latency histograms, per endpoint template.
+
+    `record` is called once per API call (after any retries); `record_wait`
+    whenever a caller sleeps instead of using the network.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._requests = defaultdict(int)  # (endpoint, status) -> count
+        self._latency = {}  # endpoint -> [bucket counts..., +Inf count, sum]
+        self._bytes = defaultdict(int)
+        self._retries = defaultdict(int)
+        self._waits = defaultdict(float)
+
+    def record(self, api_path, status, latency, bytes_received=0, retries=0):
+        """
+        Account for one API call. status is None if no response was received;
+        latency is the time spent on the network, across all attempts.
+        """
+        endpoint = endpoint_template(api_path)
+        with self._lock:
+            self._requests[(endpoint, str(status or 'error'))] += 1
+            histogram = self._latency.setdefault(
+                    endpoint, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if latency <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += latency
+            self._bytes[endpoint] += bytes_received
+            self._retries[endpoint] += retries
+
+    def record_wait(self, reason, seconds):
+        """
+        Account for time spent sleeping, e.g. reason='rate_limit' or 'backoff'.
+        """
+        if seconds > 0:
+            with self._lock:
+                self._waits[reason] += seconds
+
+    def summary(self):
+        """
+        Return all metrics as a JSON-serializable dict.
+        """
+        with self._lock:
+            endpoints = {}
+            for endpoint, histogram in self._latency.items():
+                endpoints[endpoint] = {
+                    'requests': dict((status, n) for (ep, status), n
+                                     in self._requests.items()
+                                     if ep == endpoint),
+                    'latency_seconds': {
+                        'count': histogram[-2],
+                        'sum': histogram[-1],
+                        'buckets': dict(zip([str(b) for b in self.buckets],
+                                            histogram[:-2])),
+                    },
+                    'bytes_received': self._bytes[endpoint],
+                    'retries': self._retries[endpoint],
+                }
+            return {'endpoints': endpoints, 'wait_seconds': dict(self._waits)}
+
+    def to_prometheus(self, prefix='fitabase'):
+        """
+        Render the metrics in the Prometheus text exposition format.
+        """
+        summary = self.summary()
+        lines = [
+            '# HELP %s_requests_total Fitabase API calls by final status.'
+            % prefix,
+            '# TYPE %s_requests_total counter' % prefix]
+        for endpoint, data in sorted(summary['endpoints'].items()):
+            for status, n in sorted(data['requests'].items()):
+                lines.append('%s_requests_total{endpoint="%s",status="%s"} %d'
+                             % (prefix, endpoint, status, n))
+
+        lines += [
+            '# HELP %s_request_duration_seconds Network time per API call.'
+            % prefix,
+            '# TYPE %s_request_duration_seconds histogram' % prefix]
+        for endpoint, data in sorted(summary['endpoints'].items()):
+            latency = data['latency_seconds']
+            for bound in self.buckets:
+                lines.append('%s_request_duration_seconds_bucket'
+                             '{endpoint="%s",le="%s"} %d'
+                             % (prefix, endpoint, bound,
+                                latency['buckets'][str(bound)]))
+            lines.append('%s_request_duration_seconds_bucket'
+                         '{endpoint="%s",le="+Inf"} %d'
+                         % (prefix, endpoint, latency['count']))
+            lines.append('%s_request_duration_seconds_sum{endpoint="%s"} %f'
+                         % (prefix, endpoint, latency['sum']))
+            lines.append('%s_request_duration_seconds_count{endpoint="%s"} %d'
+                         % (prefix, endpoint, latency['count']))
+
+        for name, key, help_text in (
+                ('response_bytes_total', 'bytes_received',
+                 'Response bytes received.'),
+                ('request_retries_total', 'retries',
+                 'Retried attempts.')):
+            lines += ['# HELP %s_%s %s' % (prefix, name, help_text),
+                      '# TYPE %s_%s counter' % (prefix, name)]
+            for endpoint, data in sorted(summary['endpoints'].items()):
+                lines.append('%s_%s{endpoint="%s"} %d'
+                             % (prefix, name, endpoint, data[key]))
+
+        lines += ['# HELP %s_wait_seconds_total Time spent sleeping.' % prefix,
+                  '# TYPE %s_wait_seconds_total counter' % prefix]
+        for reason, seconds in sorted(summary['wait_seconds'].items()):
+            lines.append('%s_wait_seconds_total{reason="%s"} %f'
+                         % (prefix, reason, seconds))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """
+        Write the metrics to path: as a Prometheus textfile if it ends in
+        .prom, as JSON otherwise. The file is replaced atomically, so that a
+        collector never reads it half-written.
+        """
+        if path.endswith('.prom'):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.summary(), indent=2, sort_keys=True)
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
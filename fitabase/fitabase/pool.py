@@ -0,0 +1,92 @@
+"""
+Reusable pycurl handles, so that consecutive API calls can ride the same
+keep-alive connection instead of paying for a new TCP + TLS handshake.
+"""
+import pycurl
+import threading
+try:
+    from queue import LifoQueue, Empty
+except ImportError:
+    from Queue import LifoQueue, Empty
+
+
+class CurlHandlePool(object):
+    """
+    Thread-safe pool of pycurl.Curl handles sharing one DNS and SSL session
+    cache.
+
+    A handle is checked out for the duration of one request and handed back
+    afterwards; libcurl keeps the handle's connection open, so the next
+    request to the same host reuses it. Up to `max_idle` handles are kept;
+    extra ones (e.g. after a burst of concurrent requests) are closed.
+    """
+
+    def __init__(self, max_idle=8):
+        self.max_idle = max_idle
+        self._idle = LifoQueue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._checked_out = 0
+        self._share = pycurl.CurlShare()
+        self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+
+    def _configure(self, ch):
+        """
+        Options every handle needs; re-applied after each reset(). (The share 
+        is attached once, in acquire, as reset() leaves it in place.)
+        """
+        ch.setopt(pycurl.TCP_KEEPALIVE, 1)
+        ch.setopt(pycurl.NOSIGNAL, 1)  # required for use from threads
+
+    def acquire(self):
+        """
+        Return an idle handle, or a fresh one if none is available.
+        """
+        if self._closed:
+            raise ValueError('CurlHandlePool is closed')
+        with self._lock:
+            self._checked_out += 1
+        try:
+            ch = self._idle.get_nowait()
+        except Empty:
+            ch = pycurl.Curl()
+            ch.setopt(pycurl.SHARE, self._share)
+        self._configure(ch)
+        return ch
+
+    def release(self, ch, broken=False):
+        """
+        Hand a handle back after use. Pass broken=True if the transfer failed,
+        so that the handle (and its possibly wedged connection) is dropped.
+        """
+        with self._lock:
+            self._checked_out -= 1
+            keep = (not broken and not self._closed
+                    and self._idle.qsize() < self.max_idle)
+            close_share = self._closed and self._checked_out == 0
+        if keep:
+            ch.reset()
+            self._idle.put(ch)
+        else:
+            ch.close()
+        if close_share:
+            self._share.close()
+
+    def close(self):
+        """
+        Close all idle handles and the shared cache. Handles still checked out
+        are closed when they are released.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            close_share = self._checked_out == 0
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                break
+        if close_share:
+            self._share.close()
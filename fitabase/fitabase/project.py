@@ -1,58 +1,170 @@
-import cStringIO
 import dateutil
+import io
 import json
+from multiprocessing.pool import ThreadPool
+import os
 import pandas as pd
-import pycurl
-from StringIO import StringIO
+from .download import DEFAULT_CHUNK_SIZE, RangedDownloader, verify_zipfile
+from .metrics import RequestMetrics
+from .retry import Deadline, DeadlineExceeded, FitabaseAPIError, RetryPolicy, \
+        parse_retry_after
+from .throttle import AdaptiveConcurrencyLimit, RateLimiter
+import tempfile
+import time
 from time import sleep
-try:
-    from urllib.parse import urlencode
-except ImportError:
-    from urllib import urlencode
+from .transport import CurlTransport, Request, TransportError
 from zipfile import ZipFile
 
+# Raw downloads are buffered in memory up to this size, then spill to disk
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+# Sync/Latest timestamps look like 2018-11-15T21:42:48 (sometimes with
+# fractional seconds, which are ignored)
+SYNC_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+SYNC_DATE_LENGTH = len('2018-11-15T21:42:48')
+
+BATTERY_LEVELS = ['Empty', 'Low', 'Medium', 'High']
+
+
+def parse_sync_dates(values):
+    """
+    Convert a Series of Sync/Latest timestamp strings to datetimes in one 
+    vectorized pass; anything not in SYNC_DATE_FORMAT goes through dateutil 
+    (dropping any time zone, so that the column stays datetime64).
+    """
+    parsed = pd.to_datetime(values.str.slice(0, SYNC_DATE_LENGTH),
+            format=SYNC_DATE_FORMAT, errors='coerce')
+    unparsed = parsed.isnull() & values.notnull()
+    if unparsed.any():
+        parsed.loc[unparsed] = pd.to_datetime(values.loc[unparsed].apply(
+            lambda value: dateutil.parser.parse(value).replace(tzinfo=None)))
+    return parsed
+
+
+def battery_levels_to_categorical(values):
+    """
+    Store battery levels as a categorical; levels outside BATTERY_LEVELS are 
+    kept as extra categories rather than dropped.
+    """
+    extra = sorted(set(values.dropna()) - set(BATTERY_LEVELS))
+    return pd.Categorical(values, categories=BATTERY_LEVELS + extra)
+
 class Project(object):
     """
     Project exposes the API actions for a specific Fitabase profile.
-    """
-    # FIXME: Need to read up on resource freeing with StringIO + ZipFile etc., 
-    # and figure out how that works with resources that are returned to an 
-    # external scope.
 
-    def __init__(self, token, url='https://api.fitabase.com/v1/'):
+    A Project keeps its HTTP connections open between calls; release them with 
+    `close()`, or use the Project as a context manager:
+
+        with Project(token) as api:
+            devices = api.get_device_ids()
+    """
+    # FIXME: Need to read up on resource freeing with temporary files + ZipFile 
+    # etc., and figure out how that works with resources that are returned to 
+    # an external scope.
+
+    def __init__(self, token, url='https://api.fitabase.com/v1/',
+            rate_limit=None, max_idle_connections=8, cache=None,
+            max_concurrency=8, retry=None, connect_timeout=10, read_timeout=60,
+            deadline=None, metrics=None, transport=None):
         """
         Initialize the object with info underlying all API calls.
 
         Each site has separate unique API token. 
+
+        If rate_limit (requests per second) is given, every request made 
+        through this object - from any thread - draws from one shared token 
+        bucket.
+
+        Up to max_idle_connections keep-alive connections are retained for 
+        reuse; concurrent callers beyond that open short-lived ones.
+
+        If cache (a fitabase.ResponseCache) is given, responses that rarely 
+        change - currently Profiles/ - are served from it while fresh.
+
+        Failed API calls (no response, 429 or 5xx) are retried according to 
+        retry, a fitabase.RetryPolicy; pass RetryPolicy(max_retries=0) to 
+        disable. At most max_concurrency calls are in flight at once, and 
+        that limit is lowered automatically while calls keep failing.
+
+        A connection attempt is abandoned after connect_timeout seconds, and 
+        a transfer after read_timeout seconds without receiving any data. If 
+        deadline (in seconds) is given, no request or retry is started once 
+        that much time has passed since the Project was created; 
+        fitabase.DeadlineExceeded is raised instead.
+
+        Every request is reported to metrics (a fitabase.RequestMetrics, 
+        which may be shared between Projects); by default each Project keeps 
+        its own, available as self.metrics.
+
+        Requests go out through transport (see fitabase.transport), by 
+        default a CurlTransport keeping max_idle_connections open. Wrapping 
+        it in a RecordingTransport, or replacing it with a ReplayTransport, 
+        records or replays the API's responses.
         """
         self.token = token
         self.url = url
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.transport = (transport if transport is not None
+                else CurlTransport(max_idle=max_idle_connections))
+        self.cache = cache
+        self.concurrency = AdaptiveConcurrencyLimit(max_concurrency)
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = Deadline(deadline) if deadline else None
+        self.metrics = metrics if metrics is not None else RequestMetrics()
+
+
+    def close(self):
+        """
+        Release all pooled connections (and save any recording). The Project 
+        cannot be used afterwards.
+        """
+        self.transport.close()
+
 
+    def __enter__(self):
+        return self
 
-    def get_device_ids(self, format='df'):
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def get_device_ids(self, format='df', refresh=False):
         """
         For the site identified by the token, return all available Device IDs,
         names, and creation dates.
 
         In Fitabase API terminology, "profile" is shorthand for Connected
         Device Profile.
+
+        If the Project has a cache, a fresh cached list is returned unless 
+        refresh=True, in which case the API is queried and the cache updated.
         """
-        devices = self._make_request('Profiles/', format=format)
+        devices = self._cached_request('Profiles/', format=format,
+                refresh=refresh)
         return devices
 
 
-    def get_tracker_sync_data(self, device_id, device_name=None, format='json', sleep_interval=0):
+    def get_tracker_sync_data(self, device_id, device_name=None, format='json',
+            sleep_interval=0, parse_dates=True):
         """
         For a single tracker ID, return its last sync and battery level.
 
         If device_name is given, then it grabs the latest sync for *that* 
         tracker. (The case where multiple trackers of the same type are 
         associated with the account is not considered.)
+
+        With parse_dates=False, SyncDateTracker is left as the API's string, 
+        for callers that convert many results at once.
         """
         # => {'SyncDateTracker': iso8601 or None,
         #     'LatestBatteryLevelTracker': 'High', 'Medium', 'Low', 'Empty', or 
         #     None}
         sleep(sleep_interval)
+        self.metrics.record_wait('sleep', sleep_interval)
         data = self._make_request('Sync/Latest/%s' % device_id, format="json")
         if device_name:
             try:
@@ -68,7 +180,7 @@ class Project(object):
         # Only subset to expected keys
         keys_of_interest = ['SyncDateTracker', 'LatestBatteryLevelTracker']  
         data = {k: data[k] for k in keys_of_interest}
-        if data['SyncDateTracker']:
+        if parse_dates and data['SyncDateTracker']:
             data['SyncDateTracker'] = dateutil.parser.parse(data['SyncDateTracker'])
 
         if format == 'json':
@@ -77,15 +189,22 @@ class Project(object):
             return pd.Series(data)
 
 
-    def get_all_tracker_sync_data(self, device_ids=None, device_name=None, sleep_interval=0.1):
+    def get_all_tracker_sync_data(self, device_ids=None, device_name=None,
+            sleep_interval=0.1, max_workers=1):
         """
         For all device IDs passed in the DataFrame, retrieve the last sync time 
-        and battery level and return in an equally-indexed DataFrame.
+        and battery level and return in an equally-indexed DataFrame. 
+        (SyncDateTracker is datetime64, LatestBatteryLevelTracker categorical.)
 
         (Equal indexing means that you can extend the existing DataFrame with 
         something like `df.join(api.get_all_tracker_sync_data(device_ids=df))`, 
         thus easily combining the input and output.)
 
+        With max_workers > 1, up to that many requests are kept in flight at 
+        once. Either way, requests are paced by a token bucket shared across 
+        the workers: the Project's own rate_limiter if it has one, otherwise 
+        one admitting a request every sleep_interval seconds.
+
         Warning: This queries each device ID individually, so consider pruning 
         device_ids in order to avoid flooding the API.
         """
@@ -94,11 +213,38 @@ class Project(object):
                     "returned by get_device_ids(format='df').")
         if device_ids is None:
             device_ids = self.get_device_ids(format='df')
-        return device_ids['ProfileId'].apply(
-                self.get_tracker_sync_data,
-                device_name=device_name,
-                sleep_interval=sleep_interval,
-                format='df')
+
+        # Project-wide limiter is already applied in _make_request
+        limiter = None
+        if self.rate_limiter is None:
+            limiter = RateLimiter.from_interval(sleep_interval)
+
+        def fetch(device_id):
+            if limiter:
+                self.metrics.record_wait('rate_limit', limiter.acquire())
+            return self.get_tracker_sync_data(device_id,
+                    device_name=device_name, format='json', parse_dates=False)
+
+        profile_ids = device_ids['ProfileId'].tolist()
+        if max_workers > 1 and len(profile_ids) > 1:
+            pool = ThreadPool(min(max_workers, len(profile_ids)))
+            try:
+                # map preserves input order, so results line up with the index
+                results = pool.map(fetch, profile_ids)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [fetch(device_id) for device_id in profile_ids]
+
+        # Assemble the raw payloads once, then convert whole columns
+        sync_data = pd.DataFrame(results, index=device_ids.index,
+                columns=['SyncDateTracker', 'LatestBatteryLevelTracker'])
+        sync_data['SyncDateTracker'] = parse_sync_dates(
+                sync_data['SyncDateTracker'])
+        sync_data['LatestBatteryLevelTracker'] = battery_levels_to_categorical(
+                sync_data['LatestBatteryLevelTracker'])
+        return sync_data
 
 
     def get_device_last_sync(self, device_id, sleep_interval=0):
@@ -139,9 +285,14 @@ class Project(object):
         return device_ids
 
 
-    def export_batch(self, batch_id):
+    def export_batch(self, batch_id, out_file=None):
         """
         Given a valid batch ID, get the raw stream of the zip file containing the batched export
+
+        The archive is streamed to out_file (a path or a writable binary file 
+        object) or, by default, to a spooled temporary file, so that memory 
+        use stays bounded regardless of the archive size. The returned file 
+        object is rewound to the start.
         """
         # TODO: Instead of get_batch_export_zipfile, it might make sense to 
         # have a format parameter here?
@@ -149,11 +300,40 @@ class Project(object):
         batch_stream = self._make_request(
                 'BatchExport/Download/%s' % batch_id,
                 method="post",
-                format='raw')
+                format='raw',
+                out_file=out_file)
         # This exports the full raw stream of a zipfile
         return batch_stream
 
 
+    def download_batch(self, batch_id, path, connections=4, verify=True,
+            chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Download the batch export archive to path, and return path.
+
+        Where the API honours Range requests, the archive is fetched in 
+        parallel byte ranges over up to `connections` connections. An 
+        interrupted download leaves `path + '.part'` behind, and calling 
+        download_batch again with the same path (and chunk_size) resumes it.
+
+        With verify=True, the archive's central directory and member CRCs are 
+        checked before it is moved to path; a corrupt archive is deleted and 
+        zipfile.BadZipfile is raised.
+        """
+        assert isinstance(batch_id, basestring)
+        api_path = 'BatchExport/Download/%s' % batch_id
+        # Each range goes through the same retries, rate limit and 
+        # concurrency limit (and into the metrics) as any other request
+        downloader = RangedDownloader(
+                lambda headers, buf, on_head: self._perform_with_retries(
+                    api_path, "post", buf, {}, extra_headers=headers,
+                    on_head=on_head),
+                connections=connections,
+                chunk_size=chunk_size)
+        downloader.download(path, validate=verify_zipfile if verify else None)
+        return path
+
+
     def get_last_batch_export_info(self, format='json'):
         """
         Extract all info about the latest batch export.
@@ -177,13 +357,16 @@ class Project(object):
             return batch_id
 
 
-    def get_batch_export_zipfile(self, batch_id=None):
+    def get_batch_export_zipfile(self, batch_id=None, out_file=None):
         """
         Return the result of self.export_batch as a ZipFile object.
+
+        See export_batch for out_file. (Closing the ZipFile does not close the 
+        underlying file if it was passed in as a file object.)
         """
         if not batch_id:
             batch_id = self.get_last_batch_export_id()
-        batch_stream = self.export_batch(batch_id=batch_id)
+        batch_stream = self.export_batch(batch_id=batch_id, out_file=out_file)
         if not batch_stream:
             raise IOError('FitabaseSite.export_batch did not return a zip stream')
             return None
@@ -203,45 +386,178 @@ class Project(object):
         batch_zip.extractall(path=path)
 
 
-    def _make_request(self, api_path, method="get", format="json", **header_data):
+    def _cached_request(self, api_path, format="json", refresh=False):
+        """
+        Like _make_request for a GET returning JSON, but going through 
+        self.cache (if any). With refresh=True, the cached copy is ignored.
         """
-        Helper function for all API requests. Outputs raw StringIO, JSON, or DataFrame.
+        data = None
+        if self.cache is not None and not refresh:
+            data = self.cache.get(self.token, api_path)
+        if data is None:
+            data = self._make_request(api_path, format="json")
+            if self.cache is not None:
+                self.cache.set(self.token, api_path, data)
+
+        assert format in ("json", "df")
+        if format == "df":
+            return pd.DataFrame(data)
+        return data
+
+
+    def _make_request(self, api_path, method="get", format="json",
+            out_file=None, **header_data):
+        """
+        Helper function for all API requests. Outputs raw file object, JSON, or DataFrame.
         
         In general, each request will specify a URL subpath; the subpath will
         typically include any parameters, so header_data will typically be
         empty, except for site API token.
 
-        Currently, there are no safeguards if jsonification is not successful.
+        With format="raw", the body is written straight to out_file - a path, 
+        or an open binary file object - or else to a spooled temporary file. 
+        Either way, the file object is returned rewound to its start. If the 
+        request fails, a file created at the out_file path is removed again, 
+        so that an error body is never left behind looking like a download.
+
+        Failures are retried per self.retry; once retries are exhausted, or 
+        for a non-retryable error status, FitabaseAPIError is raised. It is 
+        also raised if the body of a JSON request does not parse.
         """
-        # Buffer to save the curl output into
-        buf = cStringIO.StringIO()
+        # File to save the curl output into
+        if format != "raw":
+            buf = io.BytesIO()
+        elif out_file is None:
+            buf = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        elif isinstance(out_file, basestring):
+            buf = open(out_file, 'w+b')
+        else:
+            buf = out_file
+
+        try:
+            status, _ = self._perform_with_retries(api_path, method, buf,
+                    header_data)
+        except Exception:
+            if buf is not out_file:
+                buf.close()
+            if isinstance(out_file, basestring):
+                os.remove(out_file)
+            raise
+        buf.seek(0)
+
+        assert format in ("raw", "json", "df")
+        if format == "raw":
+            return buf
+        try:
+            data = json.load(buf)
+        except ValueError as e:
+            raise FitabaseAPIError('%s returned invalid JSON: %s' % (api_path, e),
+                    status=status)
+        if format == "df":
+            return pd.DataFrame(data)
+        return data
+
+
+    def _perform_with_retries(self, api_path, method, buf, header_data,
+            extra_headers=(), on_head=None):
+        """
+        Run the request, retrying per self.retry, and return the final HTTP 
+        status and response header lines. The body of the successful attempt 
+        is left in buf.
+
+        extra_headers are as for _request, on_head as for the transport's 
+        perform.
+        """
+        attempt = 0
+        status = None
+        size = 0
+        latency = 0.0
+        try:
+            while True:
+                status, headers, error, elapsed, size = self._perform(
+                        api_path, method, buf, header_data, extra_headers,
+                        on_head)
+                latency += elapsed
+                if error is None:
+                    return status, headers
+                if not self.retry.should_retry(attempt, status):
+                    raise error
+                wait = self.retry.delay(attempt, parse_retry_after(headers))
+                if (self.deadline is not None
+                        and wait >= self.deadline.remaining()):
+                    raise DeadlineExceeded('%s: deadline reached while '
+                            'retrying after: %s' % (api_path, error),
+                            status=status)
+                sleep(wait)
+                self.metrics.record_wait('backoff', wait)
+                attempt += 1
+        finally:
+            self.metrics.record(api_path, status, latency, size,
+                    retries=attempt)
+
+
+    def _perform(self, api_path, method, buf, header_data, extra_headers=(),
+            on_head=None):
+        """
+        Make a single attempt at the request, writing the body into buf 
+        (which is emptied first).
+
+        Returns (status, header lines, error, seconds on the network, bytes 
+        received); status is None and error is set if no response was 
+        received, and error is set for any status of 400 and above.
+        """
+        buf.seek(0)
+        buf.truncate()
+        request = self._request(api_path, method=method,
+                extra_headers=extra_headers, **header_data)
+
+        self.concurrency.acquire()
+        start = time.time()
+        failed = True
+        try:
+            response = self.transport.perform(request, buf.write, on_head)
+            # Only overload signals (429, 5xx) should slow everyone down
+            failed = response.status in self.retry.retry_statuses
+        except TransportError as e:
+            return None, [], FitabaseAPIError(
+                    '%s failed: %s' % (api_path, e)), time.time() - start, 0
+        finally:
+            # Whatever happened (even an error raised by on_head), the slot 
+            # must be given back
+            self.concurrency.release(failed=failed)
+
+        if response.status >= 400:
+            return response.status, response.headers, FitabaseAPIError(
+                    '%s returned HTTP status %d' % (api_path, response.status),
+                    status=response.status), response.elapsed, response.size
+        return (response.status, response.headers, None, response.elapsed,
+                response.size)
+
+
+    def _request(self, api_path, method="get", extra_headers=(),
+            **header_data):
+        """
+        Describe the given API call as a transport.Request, once the deadline 
+        and rate limit allow it to go out.
+
+        extra_headers are raw 'Name: value' lines that, unlike header_data, 
+        are not repeated in the POST body.
+        """
+        if self.deadline is not None and self.deadline.expired:
+            raise DeadlineExceeded('%s: deadline reached before request'
+                    % api_path)
+        if self.rate_limiter:
+            self.metrics.record_wait('rate_limit', self.rate_limiter.acquire())
 
-        # Any header data to put in the curl request, always with token
+        # Any header data to put in the request, always with token
         data = {
             'Ocp-Apim-Subscription-Key': self.token
         }
         data.update(header_data)
-        ch = pycurl.Curl()
-        ch.setopt(ch.URL, self.url + api_path)
 
         assert method in ('get', 'post')
-        if method == 'get':
-            ch.setopt(ch.HTTPGET, True)
-        elif method == 'post':
-            ch.setopt(ch.POSTFIELDS, urlencode(data))
         # FIXME: Should be urlencoded?
-        ch.setopt(ch.HTTPHEADER, ['%s: %s' % (k, v) for k, v in data.items()])
-        ch.setopt(ch.WRITEFUNCTION, buf.write)
-        ch.perform()
-        ch.close()
-
-        out_raw = StringIO(buf.getvalue())
-        buf.close()
-
-        assert format in ("raw", "json", "df")
-        if format == "json":
-            return json.load(out_raw)
-        elif format == "df":
-            return pd.DataFrame(json.load(out_raw))
-        else:
-            return out_raw
+        return Request(method, self.url + api_path,
+                ['%s: %s' % (k, v) for k, v in data.items()]
+                + list(extra_headers),
+                data, self.connect_timeout, self.read_timeout)
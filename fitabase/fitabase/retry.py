@@ -0,0 +1,95 @@
+"""
+Retry, backoff and deadline handling for Fitabase API requests.
+"""
+import random
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+
+class FitabaseAPIError(IOError):
+    """
+    The API answered with an error status, or not at all.
+
+    `status` is the HTTP status code, or None if no response was received.
+    """
+
+    def __init__(self, message, status=None):
+        super(FitabaseAPIError, self).__init__(message)
+        self.status = status
+
+
+class DeadlineExceeded(FitabaseAPIError):
+    """
+    The Project's per-run deadline passed before the request could complete.
+    """
+
+
+class Deadline(object):
+    """
+    Point in time after which no further requests (or retries) are started.
+    """
+
+    def __init__(self, seconds):
+        self.expires = time.time() + seconds
+
+    def remaining(self):
+        return self.expires - time.time()
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+
+class RetryPolicy(object):
+    """
+    Decide whether a failed request is retried, and how long to wait first.
+
+    Waits grow exponentially from `backoff` seconds up to `max_backoff`, with
+    full jitter so that concurrent workers do not retry in lockstep. A
+    Retry-After header on the response takes precedence, but is also capped
+    at `max_backoff`, so that a run without a deadline never sleeps for
+    longer than that.
+    """
+
+    def __init__(self, max_retries=4, backoff=0.5, max_backoff=30,
+            retry_statuses=(429, 500, 502, 503, 504)):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = set(retry_statuses)
+
+    def should_retry(self, attempt, status=None):
+        """
+        attempt counts from 0; status is None for transport-level failures.
+        """
+        if attempt >= self.max_retries:
+            return False
+        return status is None or status in self.retry_statuses
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        cap = min(self.max_backoff, self.backoff * (2 ** attempt))
+        return random.uniform(0, cap)
+
+
+def parse_retry_after(headers):
+    """
+    Extract the Retry-After delay in seconds from raw header lines, if any.
+
+    Both forms allowed by RFC 7231 - a number of seconds, or an HTTP-date -
+    are understood.
+    """
+    for line in headers:
+        if isinstance(line, bytes):
+            line = line.decode('iso-8859-1')
+        name, _, value = line.partition(':')
+        if name.strip().lower() != 'retry-after':
+            continue
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        parsed = parsedate_tz(value)
+        if parsed is not None:
+            return max(0.0, mktime_tz(parsed) - time.time())
+    return None
@@ -0,0 +1,281 @@
+"""
+Local stand-in for the Fitabase API, serving synthetic data.
+
+It answers the endpoints that Project uses - Profiles/, Sync/Latest/{id},
+BatchExport/Latest and BatchExport/Download/{id} - with payloads shaped like
+the real ones, so that the client can be exercised (and timed) without a
+token or a network. Latency, error rate and throttling are configurable:
+
+```python
+with StandInServer(n_profiles=500, latency=0.05, error_rate=0.01,
+                   throttle_rate=20) as server:
+    api = Project(server.token, url=server.url)
+    devices = api.get_device_ids()
+```
+
+Given a certificate and its key (for instance from make_certificate), it
+serves HTTPS instead, so that TLS handshakes and session reuse are timed
+too; the client then needs the certificate as its CA file:
+
+```python
+certfile, keyfile = make_certificate(tmp_dir)
+with StandInServer(certfile=certfile, keyfile=keyfile) as server:
+    api = Project(server.token, url=server.url,
+                  transport=CurlTransport(ca_file=certfile))
+```
+"""
+import datetime
+import io
+import json
+import os
+import random
+import re
+import socket
+import ssl
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zipfile
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from .throttle import RateLimiter
+
+TOKEN_HEADER = 'Ocp-Apim-Subscription-Key'
+BATTERY_LEVELS = ['Empty', 'Low', 'Medium', 'High']
+REASONS = {200: 'OK', 206: 'Partial Content', 401: 'Unauthorized',
+           404: 'Not Found', 429: 'Too Many Requests',
+           503: 'Service Unavailable'}
+
+
+class StandInData(object):
+    """
+    Synthetic profiles, sync data and batch export, generated from `seed`.
+    """
+
+    def __init__(self, n_profiles=100, archive_members=20,
+            member_size=20000, seed=0):
+        rng = random.Random(seed)
+        now = datetime.datetime(2018, 11, 15, 12, 0, 0)
+        self.profiles = []
+        self.sync = {}
+        for i in range(n_profiles):
+            profile_id = str(uuid.UUID(int=rng.getrandbits(128)))
+            last_sync = now - datetime.timedelta(
+                    seconds=rng.randint(0, 5 * 24 * 3600))
+            battery = rng.choice(BATTERY_LEVELS)
+            self.profiles.append({
+                'ProfileId': profile_id,
+                'Name': 'NDAR_INV%08d' % i,
+                'CreatedDate': '2018-09-25T19:47:50.017'})
+            self.sync[profile_id] = {
+                'SyncDate': last_sync.isoformat(),
+                'LatestBatteryLevel': battery,
+                'LatestDeviceName': 'Charge 2',
+                'SyncDateTracker': last_sync.isoformat(),
+                'LatestBatteryLevelTracker': battery,
+                'LatestDeviceNameTracker': 'Charge 2',
+                'Devices': [{
+                    'DeviceName': 'Charge 2',
+                    'BatteryLevel': battery,
+                    'LastSync': last_sync.isoformat()}]}
+
+        self.batch_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        self.batch_info = {
+            'DownloadDataBatchId': self.batch_id,
+            'Name': 'nightly_past14d',
+            'StartDate': '2018-11-01T00:00:00',
+            'EndDate': '2018-11-14T00:00:00',
+            'ProcessingStarted': '2018-11-15T02:00:00',
+            'ProcessingCompleted': '2018-11-15T02:10:00'}
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for profile in self.profiles[:archive_members]:
+                rows = ['Time,Value'] + [
+                    '11/1/2018 12:%02d:00 AM,%d' % (j % 60, rng.randint(50, 120))
+                    for j in range(member_size // 24)]
+                zf.writestr('%s_heartrate_1min_20181101_20181114.csv'
+                            % profile['Name'], '\n'.join(rows))
+        self.archive = buf.getvalue()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._handle()
+
+    def _handle(self):
+        server = self.server
+        server.count_request()
+        if server.latency:
+            time.sleep(server.latency * random.uniform(0.5, 1.5))
+        if self.headers.get(TOKEN_HEADER) != server.token:
+            return self._send(401, b'{"message": "Access denied"}')
+        if server.throttle is not None and not server.throttle.try_acquire():
+            return self._send(429, b'{"message": "Rate limit exceeded"}',
+                              [('Retry-After', '1')])
+        if server.error_rate and random.random() < server.error_rate:
+            return self._send(503, b'{"message": "Service unavailable"}')
+
+        data = server.data
+        path = self.path.split('?')[0][len(server.prefix):]
+        match = re.match(r'^Sync/Latest/([^/]+)$', path)
+        if path == 'Profiles/':
+            self._send_json(data.profiles)
+        elif match and match.group(1) in data.sync:
+            self._send_json(data.sync[match.group(1)])
+        elif path == 'BatchExport/Latest':
+            self._send_json(data.batch_info)
+        elif path == 'BatchExport/Download/%s' % data.batch_id:
+            self._send_archive(data.archive)
+        else:
+            self._send(404, b'{"message": "Resource not found"}')
+
+    def _send_json(self, obj):
+        self._send(200, json.dumps(obj).encode('utf-8'))
+
+    def _send_archive(self, body):
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if not match:
+            return self._send(200, body, content_type='application/zip')
+        start = int(match.group(1))
+        end = min(int(match.group(2) or len(body) - 1), len(body) - 1)
+        self._send(206, body[start:end + 1],
+                   [('Content-Range', 'bytes %d-%d/%d'
+                     % (start, end, len(body)))],
+                   content_type='application/zip')
+
+    def _send(self, status, body, headers=(), content_type='application/json'):
+        # Headers and body in one write, so that Nagle's algorithm does not
+        # delay small responses
+        lines = ['HTTP/1.1 %d %s' % (status, REASONS[status]),
+                 'Content-Type: %s' % content_type,
+                 'Content-Length: %d' % len(body)]
+        lines += ['%s: %s' % header for header in headers]
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1')
+        self.wfile.write(head + body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Throttle(RateLimiter):
+    """
+    Non-blocking token bucket: a request either gets a token or a 429.
+    """
+
+    def try_acquire(self):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+def make_certificate(directory):
+    """
+    Write a self-signed certificate for localhost and its key to
+    stand-in.crt and stand-in.key in directory (using the openssl command);
+    return their paths.
+    """
+    certfile = os.path.join(directory, 'stand-in.crt')
+    keyfile = os.path.join(directory, 'stand-in.key')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+             '-days', '1', '-subj', '/CN=localhost',
+             '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+             '-keyout', keyfile, '-out', certfile],
+            stdout=devnull, stderr=subprocess.STDOUT)
+    return certfile, keyfile
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """
+    Stand-in API on 127.0.0.1, served from a background thread.
+
+    latency is the mean delay (seconds) before each response; a fraction
+    error_rate of requests gets a 503; with throttle_rate, requests beyond
+    that many per second (after a burst of throttle_burst) get a 429 with
+    Retry-After. With certfile and keyfile (PEM files), it serves HTTPS.
+    """
+    daemon_threads = True
+    # The default backlog of 5 drops connections under concurrent load
+    request_queue_size = 128
+    prefix = '/v1/'
+
+    def __init__(self, data=None, token='standin-token', latency=0,
+            error_rate=0, throttle_rate=None, throttle_burst=10, port=0,
+            certfile=None, keyfile=None, **data_kwargs):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StandInHandler)
+        self.ssl_context = None
+        if certfile:
+            self.ssl_context = ssl.create_default_context(
+                    ssl.Purpose.CLIENT_AUTH)
+            self.ssl_context.load_cert_chain(certfile, keyfile)
+        self.data = data if data is not None else StandInData(**data_kwargs)
+        self.token = token
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle = (_Throttle(throttle_rate, burst=throttle_burst)
+                         if throttle_rate else None)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        # Python 2 checks certificates against host names, but not addresses
+        if self.ssl_context:
+            return 'https://localhost:%d%s' % (self.server_address[1],
+                                               self.prefix)
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], self.prefix)
+
+    def finish_request(self, request, client_address):
+        # The handshake happens here, in the connection's own thread, rather
+        # than in the accepting one
+        if self.ssl_context is not None:
+            request = self.ssl_context.wrap_socket(request, server_side=True)
+        HTTPServer.finish_request(self, request, client_address)
+
+    def handle_error(self, request, client_address):
+        # A client hanging up, or refusing the certificate, is not an error
+        # of the stand-in
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
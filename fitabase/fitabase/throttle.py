@@ -0,0 +1,89 @@
+"""
+Helpers that keep the request rate against the Fitabase API in check.
+"""
+import threading
+import time
+
+
+class RateLimiter(object):
+    """
+    Token bucket that can be shared by any number of threads.
+
+    Each call to `acquire` takes one token; tokens are refilled at `rate` per
+    second, up to `burst`. If no token is available, the caller reserves the
+    next one and sleeps until it is due, so waiting callers are served in
+    order and the long-run rate never exceeds `rate`.
+    """
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError("rate must be positive, not %r" % rate)
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self._tokens = float(self.burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_interval(cls, interval, burst=1):
+        """
+        Build a limiter equivalent to sleeping `interval` seconds per request.
+
+        Returns None if interval is falsy, i.e. no limit is wanted.
+        """
+        if not interval:
+            return None
+        return cls(1.0 / interval, burst=burst)
+
+    def acquire(self):
+        """
+        Take one token, blocking until it is available. Returns the number of
+        seconds spent waiting.
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class AdaptiveConcurrencyLimit(object):
+    """
+    Cap on the number of requests in flight that backs off under failure.
+
+    The limit starts at `max_limit`. Each failed or throttled request halves
+    it (down to `min_limit`); after `limit` consecutive successes it grows by
+    one again (additive increase, multiplicative decrease).
+    """
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max(1, int(max_limit))
+        self.min_limit = max(1, min(int(min_limit), self.max_limit))
+        self.limit = self.max_limit
+        self._active = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self, failed=False):
+        with self._cond:
+            self._active -= 1
+            if failed:
+                self.limit = max(self.min_limit, self.limit // 2)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
@@ -0,0 +1,326 @@
+"""
+Interchangeable ways of getting an HTTP request to the Fitabase API.
+
+A Project decides *what* to send (URL, token header, timeouts) and when
+(rate limit, retries, deadline); a transport only performs one request and
+streams the body back. Available transports:
+
+- CurlTransport: pooled pycurl handles (the default),
+- RequestsTransport: a pooled requests.Session,
+- RecordingTransport: wraps another transport and saves every response to a
+  cassette file, with the API token scrubbed,
+- ReplayTransport: serves the responses saved in a cassette, without any
+  network access.
+
+All of them implement `perform(request, write, on_head=None)` and `close()`.
+"""
+import base64
+from collections import namedtuple
+import json
+import os
+import pycurl
+import requests
+import tempfile
+import threading
+import time
+try:
+    from urllib.parse import urlencode, urlsplit
+except ImportError:
+    from urllib import urlencode
+    from urlparse import urlsplit
+
+from .pool import CurlHandlePool
+
+TOKEN_HEADER = 'Ocp-Apim-Subscription-Key'
+
+# method is 'get' or 'post'; `headers` are raw 'Name: value' lines; `fields`
+# is the form-encoded POST body
+Request = namedtuple('Request', ['method', 'url', 'headers', 'fields',
+                                 'connect_timeout', 'read_timeout'])
+
+# `headers` are the response's 'Name: value' lines; `aborted` is True if
+# on_head refused the body
+Response = namedtuple('Response', ['status', 'headers', 'elapsed', 'size',
+                                   'aborted'])
+
+
+class TransportError(IOError):
+    """
+    No response was received (connection failure, timeout, ...).
+    """
+
+
+def _header_value(lines, name):
+    for line in lines:
+        key, _, value = line.partition(':')
+        if key.strip().lower() == name.lower():
+            return value.strip()
+    return None
+
+
+class CurlTransport(object):
+    """
+    Requests made with pycurl handles from a CurlHandlePool, so that
+    connections (and DNS / TLS sessions) are reused between calls. If
+    ca_file is given, server certificates are checked against it instead of
+    the system's CAs.
+    """
+
+    def __init__(self, max_idle=8, ca_file=None):
+        self._handles = CurlHandlePool(max_idle=max_idle)
+        self.ca_file = ca_file
+
+    def perform(self, request, write, on_head=None):
+        """
+        Perform request, passing body chunks to write(data).
+
+        If given, on_head(status, header_lines) is called once the response
+        head has arrived; if it returns False, the body is not read and the
+        Response has aborted=True. Raises TransportError if no response
+        arrives.
+        """
+        headers = []
+        state = {'head': None}
+
+        def header_line(line):
+            line = line.decode('iso-8859-1').rstrip('\r\n')
+            if line.startswith('HTTP/'):
+                # A new response (e.g. after 100 Continue) starts over
+                del headers[:]
+                state['status_line'] = line
+            elif line:
+                headers.append(line)
+
+        def write_body(data):
+            if state['head'] is None:
+                status = int(state['status_line'].split()[1])
+                state['head'] = (on_head is None
+                                 or on_head(status, headers) is not False)
+            if not state['head']:
+                return 0
+            write(data)
+
+        ch = self._handles.acquire()
+        ch.setopt(ch.URL, request.url)
+        ch.setopt(ch.CONNECTTIMEOUT, request.connect_timeout)
+        if self.ca_file:
+            ch.setopt(ch.CAINFO, self.ca_file)
+        # There is no read timeout as such; abort on a stalled transfer instead
+        ch.setopt(ch.LOW_SPEED_LIMIT, 1)
+        ch.setopt(ch.LOW_SPEED_TIME, request.read_timeout)
+        if request.method == 'get':
+            ch.setopt(ch.HTTPGET, True)
+        else:
+            ch.setopt(ch.POSTFIELDS, urlencode(request.fields))
+        ch.setopt(ch.HTTPHEADER, list(request.headers))
+        ch.setopt(ch.HEADERFUNCTION, header_line)
+        ch.setopt(ch.WRITEFUNCTION, write_body)
+        try:
+            ch.perform()
+        except pycurl.error as e:
+            self._handles.release(ch, broken=True)
+            if state['head'] is False:
+                status = int(state['status_line'].split()[1])
+                return Response(status, headers, 0.0, 0, True)
+            raise TransportError('%s failed: %s' % (request.url, e))
+        status = ch.getinfo(pycurl.RESPONSE_CODE)
+        elapsed = ch.getinfo(pycurl.TOTAL_TIME)
+        size = int(ch.getinfo(pycurl.SIZE_DOWNLOAD))
+        self._handles.release(ch)
+        if state['head'] is None and on_head is not None:
+            # Empty body: the head still has to be reported
+            on_head(status, headers)
+        return Response(status, headers, elapsed, size, False)
+
+    def close(self):
+        self._handles.close()
+
+
+class RequestsTransport(object):
+    """
+    Requests made through a requests.Session, keeping up to `max_idle`
+    connections per host open. See CurlTransport for ca_file.
+    """
+
+    def __init__(self, max_idle=8, chunk_size=64 * 1024, ca_file=None):
+        self.session = requests.Session()
+        self.ca_file = ca_file
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_idle)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.chunk_size = chunk_size
+
+    def perform(self, request, write, on_head=None):
+        """
+        See CurlTransport.perform.
+        """
+        headers = dict((name.strip(), value.strip()) for name, _, value
+                       in (line.partition(':') for line in request.headers))
+        start = time.time()
+        try:
+            response = self.session.request(
+                    request.method.upper(), request.url, headers=headers,
+                    data=request.fields if request.method == 'post' else None,
+                    timeout=(request.connect_timeout, request.read_timeout),
+                    # (Session.verify would lose to REQUESTS_CA_BUNDLE)
+                    verify=self.ca_file or True, stream=True)
+            try:
+                lines = ['%s: %s' % item for item in response.headers.items()]
+                if on_head is not None and on_head(response.status_code,
+                                                   lines) is False:
+                    return Response(response.status_code, lines,
+                                    time.time() - start, 0, True)
+                size = 0
+                for chunk in response.iter_content(self.chunk_size):
+                    write(chunk)
+                    size += len(chunk)
+            finally:
+                response.close()
+        except requests.RequestException as e:
+            raise TransportError('%s failed: %s' % (request.url, e))
+        return Response(response.status_code, lines, time.time() - start,
+                        size, False)
+
+    def close(self):
+        self.session.close()
+
+
+# Response headers worth keeping in a cassette
+RECORDED_HEADERS = ('Content-Type', 'Content-Range', 'Retry-After')
+
+
+def _interaction_key(request):
+    """
+    Identify a request independently of host and token: method, path and
+    query, and the byte range asked for, if any.
+    """
+    url = urlsplit(request.url)
+    key = '%s %s' % (request.method.upper(), url.path)
+    if url.query:
+        key += '?' + url.query
+    byte_range = _header_value(request.headers, 'Range')
+    if byte_range:
+        key += ' ' + byte_range
+    return key
+
+
+class RecordingTransport(object):
+    """
+    Pass requests on to `transport`, and keep every complete response so
+    that save() (or close()) can write them to the cassette at `path`.
+
+    Request headers are not recorded at all, and the API token is replaced
+    in anything that is.
+    """
+
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = path
+        self.interactions = {}
+        self._lock = threading.Lock()
+
+    def perform(self, request, write, on_head=None):
+        body = []
+
+        def tee(data):
+            body.append(data)
+            write(data)
+
+        response = self.transport.perform(request, tee, on_head)
+        if response.aborted:
+            return response
+        token = _header_value(request.headers, TOKEN_HEADER)
+        content = b''.join(body)
+        try:
+            recorded_body = {'text': content.decode('utf-8')}
+            if token:
+                recorded_body['text'] = recorded_body['text'].replace(
+                        token, '<token>')
+        except UnicodeDecodeError:
+            recorded_body = {
+                'base64': base64.b64encode(content).decode('ascii')}
+        recorded = {
+            'status': response.status,
+            'headers': [line for line in response.headers
+                        if line.partition(':')[0].strip() in RECORDED_HEADERS],
+            'body': recorded_body}
+        with self._lock:
+            self.interactions.setdefault(_interaction_key(request),
+                                         []).append(recorded)
+        return response
+
+    def save(self):
+        """
+        Write the cassette (atomically, via a rename).
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._lock:
+            content = json.dumps({'interactions': self.interactions},
+                                 indent=1, sort_keys=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.rename(tmp_path, self.path)
+
+    def close(self):
+        self.save()
+        self.transport.close()
+
+
+class ReplayTransport(object):
+    """
+    Answer requests from a cassette written by RecordingTransport, with no
+    network access and no delay.
+
+    Repeated requests get the recorded responses in order, the last one
+    repeating. A request that was never recorded gets a 404.
+    """
+
+    def __init__(self, path):
+        with open(path) as f:
+            self.interactions = json.load(f)['interactions']
+        self._played = {}
+        self._lock = threading.Lock()
+
+    def perform(self, request, write, on_head=None):
+        key = _interaction_key(request)
+        recorded = self.interactions.get(key)
+        if not recorded:
+            recorded = {'status': 404, 'headers': [],
+                        'body': {'text': '{"message": "Not in cassette: %s"}'
+                                         % key}}
+        else:
+            with self._lock:
+                played = self._played.get(key, 0)
+                self._played[key] = played + 1
+            recorded = recorded[min(played, len(recorded) - 1)]
+
+        body = recorded['body']
+        if 'base64' in body:
+            content = base64.b64decode(body['base64'])
+        else:
+            content = body['text'].encode('utf-8')
+        headers = list(recorded['headers'])
+        if on_head is not None and on_head(recorded['status'],
+                                           headers) is False:
+            return Response(recorded['status'], headers, 0.0, 0, True)
+        write(content)
+        return Response(recorded['status'], headers, 0.0, len(content),
+                        False)
+
+    def close(self):
+        pass
+
+
+def cassette_transport(record_to=None, replay_from=None):
+    """
+    Return a transport recording to the cassette record_to, or replaying the
+    cassette replay_from; None (i.e. the Project's default) if neither is set.
+    """
+    if replay_from:
+        return ReplayTransport(replay_from)
+    if record_to:
+        return RecordingTransport(CurlTransport(), record_to)
+    return None
@@ -5,6 +5,7 @@
 
 import pycurl, cStringIO, json, sys, re, time
 import datetime
+import fitabase
 from StringIO import StringIO
 
 
@@ -32,21 +33,11 @@ if ftoken == '':
     print('Error: this site does not have a token')
     sys.exit(-1)
     
-buf = cStringIO.StringIO()
-# variables we need from REDCap
-data = {
-    'Ocp-Apim-Subscription-Key': ftoken
-}
-ch = pycurl.Curl()
-ch.setopt(ch.URL, 'https://api.fitabase.com/v1/Profiles/')
-ch.setopt(ch.HTTPGET, True)
-ch.setopt(ch.HTTPHEADER, ['%s: %s' % (k, v) for k, v in data.items()])
-ch.setopt(ch.WRITEFUNCTION, buf.write)
-ch.perform()
-ch.close()
-
-v = json.load( StringIO(buf.getvalue()) )
-buf.close()
+# the list of profiles rarely changes, so it comes from the shared on-disk 
+# cache if another script fetched it recently
+fit_api = fitabase.Project(ftoken, cache=fitabase.ResponseCache())
+v = fit_api.get_device_ids(format='json')
+fit_api.close()
 
 # print out the profiles on fitabase - one for each participant
 # print(json.dumps(v))
@@ -21,8 +21,10 @@ import logging as log
 from notification import NotificationSubmission
 import os
 import pandas as pd
+from poll_schedule import PollScheduler, collection_window_end
 import redcap as rc
 import requests
+from site_runner import run_sites
 import sys
 
 # NOTE: This setting was made _after_ I investigate where the supposed chained 
@@ -47,20 +49,63 @@ def parse_arguments():
             help="Update all records, even if they do not have a Fitbit distribution date")
     parser.add_argument('--dry-run', '-n', action='store_true',
             help="Print final dataframe instead of uploading it")
+    parser.add_argument('--site-workers', type=int, default=4,
+            help="Number of sites processed at the same time")
+    parser.add_argument('--rate-limit', type=float, default=None,
+            help="Maximum Fitabase requests per second, per site")
+    parser.add_argument('--api-workers', type=int, default=4,
+            help="Number of concurrent Fitabase sync requests per site")
+    parser.add_argument('--site-deadline', type=float, default=900,
+            help="Seconds after which a site's Fitabase requests are abandoned")
+    parser.add_argument('--no-cache', action='store_true',
+            help="Always fetch the Fitabase profile list from the API")
+    parser.add_argument('--poll-all', action='store_true',
+            help="Poll sync data for every device, rather than only the ones "
+                 "whose Redcap data could be out of date by the next run")
+    parser.add_argument('--poll-state-dir',
+            default=os.path.join(CURRENT_DIR, 'poll_state'),
+            help="Where to keep the last observed sync data of each device")
+    parser.add_argument('--poll-lead-time', type=float, default=24,
+            help="Hours between two runs: a device is polled that long "
+                 "before its data could go stale (default: 24, for nightly "
+                 "runs)")
+    parser.add_argument('--metrics-file', default=None,
+            help="Write Fitabase API request metrics here at the end of the "
+                 "run (Prometheus textfile if it ends in .prom, else JSON)")
+    cassettes = parser.add_mutually_exclusive_group()
+    cassettes.add_argument('--record-dir', default=None,
+            help="Save each site's Fitabase API responses to a cassette "
+                 "(SITE.json) in this directory, with the token removed")
+    cassettes.add_argument('--replay-dir', default=None,
+            help="Answer Fitabase API calls from the cassettes in this "
+                 "directory instead of the network")
     parser.add_argument('--verbose', '-v', action='store_true',
             help="Display / save INFO-level messages, too.")
     return parser.parse_args()
 
 
-def load_fitabase_data(api, pull_sync=False, name_subset=None):
+def load_fitabase_data(api, pull_sync=False, name_subset=None, max_workers=1,
+        scheduler=None, active_until=None):
+    """
+    If a PollScheduler is passed, only the devices it considers due are 
+    polled; the others get their last observed sync data.
+    """
     fit_devices = api.get_device_ids().set_index('Name')
     if name_subset is not None:
         fit_devices = fit_devices.loc[fit_devices.index.isin(name_subset)]
-    if pull_sync and not fit_devices.empty:
-        return fit_devices.join(api.get_all_tracker_sync_data(fit_devices,
-            device_name='Charge 2'))
-    else:
+    if not pull_sync or fit_devices.empty:
         return fit_devices
+    if scheduler is None:
+        return fit_devices.join(api.get_all_tracker_sync_data(fit_devices,
+            device_name='Charge 2', max_workers=max_workers))
+
+    due = scheduler.due(fit_devices['ProfileId'], active_until=active_until)
+    log.info('Polling %d of %d devices', due.sum(), due.shape[0])
+    polled = api.get_all_tracker_sync_data(fit_devices.loc[due],
+            device_name='Charge 2', max_workers=max_workers)
+    scheduler.update(fit_devices.loc[due, 'ProfileId'], polled)
+    skipped = scheduler.last_observed(fit_devices.loc[~due, 'ProfileId'])
+    return fit_devices.join(pd.concat([polled, skipped]))
 
 
 if __name__ == "__main__":
@@ -78,104 +123,130 @@ if __name__ == "__main__":
         redcap_tokens = json.load(data_file)
         redcap_tokens = pd.DataFrame.from_dict(redcap_tokens, orient='index', columns=['token'])
 
-    # No need to keep the call one site at a time - we can iterate through all
-    for site in args.site:
+    # Shared by all sites' Fitabase API objects
+    api_metrics = fitabase.RequestMetrics()
+
+    def process_site(site):
         log.info("%s: Started processing", site)
 
+        # Get device list from main Redcap project
         try:
-            # Get device list from main Redcap project
-            try:
-                rc_token = redcap_tokens.loc[site, 'token']
-            except KeyError:
-                log.error('%s: Redcap token ID is not available!', site)
-                continue
-            rc_api = rc.Project(REDCAP_URL, rc_token)
-            rc_fit_fields = ['fitc_device_dte']
-            rc_devices = rc_api.export_records(
-                    fields=rc_fit_fields + [rc_api.def_field],
-                    events=[REDCAP_EVENT],  
-                    export_data_access_groups=True,
-                    df_kwargs={
-                        'parse_dates': rc_fit_fields,
-                        # Only setting record id field as index here, instead of it 
-                        # *and* redcap_event_name, in order to facilitate easy join 
-                        # with the Fitabase DataFrame
-                        'index_col': [rc_api.def_field]},
-                    format='df')
-
-            if not args.all:
-                rc_devices.dropna(subset=['fitc_device_dte'], inplace=True)
-                if rc_devices.empty:
-                    log.info("%s: No active devices at site", site)
-                    continue
-            rc_names = rc_devices.index.get_level_values('id_redcap').tolist()
-
-            # Get device list from Fitabase
-            try:
-                fit_token = fitabase_tokens.loc[site, 'token']
-            except KeyError:
-                log.error('%s: Fitabase token ID is not available!', site)
-                continue
-            fit_api = fitabase.Project(fit_token)
-            # TODO: Maybe subset based on available Redcap IDs? If ID is absent in 
-            # Redcap, that maybe warrants a warning, but the data definitely won't 
-            # be useful...
+            rc_token = redcap_tokens.loc[site, 'token']
+        except KeyError:
+            log.error('%s: Redcap token ID is not available!', site)
+            return
+        rc_api = rc.Project(REDCAP_URL, rc_token)
+        rc_fit_fields = ['fitc_device_dte']
+        rc_devices = rc_api.export_records(
+                fields=rc_fit_fields + ['fitc_extension', rc_api.def_field],
+                events=[REDCAP_EVENT],  
+                export_data_access_groups=True,
+                df_kwargs={
+                    'parse_dates': rc_fit_fields,
+                    # Only setting record id field as index here, instead of it 
+                    # *and* redcap_event_name, in order to facilitate easy join 
+                    # with the Fitabase DataFrame
+                    'index_col': [rc_api.def_field]},
+                format='df')
+
+        if not args.all:
+            rc_devices.dropna(subset=['fitc_device_dte'], inplace=True)
+            if rc_devices.empty:
+                log.info("%s: No active devices at site", site)
+                return
+        rc_names = rc_devices.index.get_level_values('id_redcap').tolist()
+
+        # Get device list from Fitabase
+        try:
+            fit_token = fitabase_tokens.loc[site, 'token']
+        except KeyError:
+            log.error('%s: Fitabase token ID is not available!', site)
+            return
+        fit_api = fitabase.Project(fit_token, 
+                # (A recording must see the profile list, not the cache)
+                cache=(None if args.no_cache or args.record_dir
+                       else fitabase.ResponseCache()),
+                rate_limit=args.rate_limit,
+                deadline=args.site_deadline,
+                metrics=api_metrics,
+                transport=fitabase.cassette_transport(
+                    record_to=args.record_dir and os.path.join(args.record_dir, site + '.json'),
+                    replay_from=args.replay_dir and os.path.join(args.replay_dir, site + '.json')))
+        # TODO: Maybe subset based on available Redcap IDs? If ID is absent in 
+        # Redcap, that maybe warrants a warning, but the data definitely won't 
+        # be useful...
+        try:
+            if args.poll_all:
+                scheduler = None
+            else:
+                scheduler = PollScheduler(
+                        os.path.join(args.poll_state_dir, site + '.json'),
+                        lead_time=pd.Timedelta(hours=args.poll_lead_time))
             fit_data = load_fitabase_data(fit_api, pull_sync=True, 
-                    name_subset=rc_names)
-
-            # Now, transform the Fitabase data into columns. Matches almost 1-to-1:
-            join = rc_devices.join(fit_data).rename(columns={
-                'SyncDateTracker': 'fitc_last_sync_date',
-                'LatestBatteryLevelTracker': 'fitc_last_battery_level',
-                'ProfileId': 'fitc_fitabase_profile_id',
-                })
-
-            # Note the .astype(int) - PyCAP apparently doesn't know to convert 
-            # boolean pandas columns, and instead uploads strings, so we have to do 
-            # this for it
-            join.loc[:, 'fitc_fitabase_exists'] = pd.notnull(join['fitc_fitabase_profile_id']).astype(int)
-
-            # For Redcap upload to work, redcap_event_name must be in the index
-            join = join.reset_index().set_index(['id_redcap', 'redcap_event_name'])
-
-            # The try block is necessary because in some cases, there won't be any 
-            # Fitabase matches - thus no last_sync_date or last_battery_level. (We 
-            # could explicitly test for them, but catching KeyError should be 
-            # sufficiently specific.)
+                    name_subset=rc_names, max_workers=args.api_workers,
+                    scheduler=scheduler,
+                    active_until=collection_window_end(
+                        rc_devices['fitc_device_dte'],
+                        rc_devices['fitc_extension']))
+        finally:
+            # Also releases the connections and writes any --record-dir 
+            # cassette, even if the site failed
+            fit_api.close()
+        if scheduler is not None:
+            scheduler.save()
+
+        # Now, transform the Fitabase data into columns. Matches almost 1-to-1:
+        join = rc_devices.join(fit_data).rename(columns={
+            'SyncDateTracker': 'fitc_last_sync_date',
+            'LatestBatteryLevelTracker': 'fitc_last_battery_level',
+            'ProfileId': 'fitc_fitabase_profile_id',
+            })
+
+        # Note the .astype(int) - PyCAP apparently doesn't know to convert 
+        # boolean pandas columns, and instead uploads strings, so we have to do 
+        # this for it
+        join.loc[:, 'fitc_fitabase_exists'] = pd.notnull(join['fitc_fitabase_profile_id']).astype(int)
+
+        # For Redcap upload to work, redcap_event_name must be in the index
+        join = join.reset_index().set_index(['id_redcap', 'redcap_event_name'])
+
+        # The try block is necessary because in some cases, there won't be any 
+        # Fitabase matches - thus no last_sync_date or last_battery_level. (We 
+        # could explicitly test for them, but catching KeyError should be 
+        # sufficiently specific.)
+        try:
+            # It's insane, but ABCD Redcap follows MDY convention
+            # Also, the field is unvalidated text, so NaT wreaks havoc
+            join['fitc_last_sync_date'] = (join['fitc_last_sync_date']
+                    .dt.strftime('%m-%d-%Y %H:%M:%S')
+                    .astype(str)
+                    .replace('NaT', ''))
+            join['fitc_last_battery_level'] = join['fitc_last_battery_level'].str.upper()
+
+            # Only keep the columns of interest
+            # (This removes both original Fitabase columns that we have no use for, 
+            # and original Redcap columns that we don't need to rewrite.)
+            join = join.loc[:, ['fitc_last_sync_date', 'fitc_last_battery_level', 
+                'fitc_fitabase_exists', 'fitc_fitabase_profile_id']]
+        except KeyError as e:
+            log.warn('%s: No corresponding Fitabase entries for any of %s.', site,
+                    join.index.get_level_values('id_redcap').tolist())
+            join = join.loc[:, ['fitc_fitabase_exists']]
+        if args.dry_run:
+            print(join.to_csv(sys.stdout))
+        else:
             try:
-                # It's insane, but ABCD Redcap follows MDY convention
-                # Also, the field is unvalidated text, so NaT wreaks havoc
-                join['fitc_last_sync_date'] = (join['fitc_last_sync_date']
-                        .dt.strftime('%m-%d-%Y %H:%M:%S')
-                        .astype(str)
-                        .replace('NaT', ''))
-                join['fitc_last_battery_level'] = join['fitc_last_battery_level'].str.upper()
-
-                # Only keep the columns of interest
-                # (This removes both original Fitabase columns that we have no use for, 
-                # and original Redcap columns that we don't need to rewrite.)
-                join = join.loc[:, ['fitc_last_sync_date', 'fitc_last_battery_level', 
-                    'fitc_fitabase_exists', 'fitc_fitabase_profile_id']]
-            except KeyError as e:
-                log.warn('%s: No corresponding Fitabase entries for any of %s.', site,
-                        join.index.get_level_values('id_redcap').tolist())
-                join = join.loc[:, ['fitc_fitabase_exists']]
-            if args.dry_run:
-                print(join.to_csv(sys.stdout))
-            else:
-                try:
-                    out = rc_api.import_records(join, overwrite='overwrite', return_content='ids')
-                    # TODO: Maybe compare out (which is a list of IDs) with 
-                    # join.index.get_level_values('id_redcap') to see if any were 
-                    # omitted?
-                    log.info('%s: Successfully updated Redcap records for %s', site, out)
-                except requests.RequestException as e:
-                    # TODO: If exception happens, maybe retry record-by-record?
-                    log.exception('%s: Error occurred during upload of %d records.', site, join.shape[0])
-
-        except Exception as e:
-            # log.exception("%s: Uncaught exception occurred.", site)
-            log.critical("%s: Uncaught exception occurred.", site, exc_info=True)
-            continue
-
+                out = rc_api.import_records(join, overwrite='overwrite', return_content='ids')
+                # TODO: Maybe compare out (which is a list of IDs) with 
+                # join.index.get_level_values('id_redcap') to see if any were 
+                # omitted?
+                log.info('%s: Successfully updated Redcap records for %s', site, out)
+            except requests.RequestException as e:
+                # TODO: If exception happens, maybe retry record-by-record?
+                log.exception('%s: Error occurred during upload of %d records.', site, join.shape[0])
+
+    run_sites(args.site, process_site, workers=args.site_workers)
+
+    if args.metrics_file:
+        api_metrics.dump(args.metrics_file)
     log.info('Ended run with invocation: %s', sys.argv)
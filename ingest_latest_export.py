@@ -4,17 +4,34 @@ For selected site(s), download and save/extract latest batch export archive.
 
 By default, export is into SITE/SUBJECT/CURRENT_DATE; this can be modified with 
 --target-dir, --no-subject-subdirs and --no-date-subdirs, respectively.
+With --columnar-dir, the files are also (or, with --columnar-only, instead) 
+converted into typed Parquet/Arrow files; see columnar.py. With --delta-dir, 
+only the rows not ingested yet are appended to per-subject logs; see 
+delta_log.py. The subjects and measures that changed are published to a 
+change feed; see change_feed.py.
 """
 import argparse
+from catalog import Catalog
+from change_feed import ChangeFeed
+from collections import OrderedDict
+import columnar
+import compressed_csv
+from content_store import ContentStore, format_report
 import datetime
+from delta_log import HighWaterMarks, append_new_rows
 import fitabase
-import itertools
+import functools
 import json
 import logging as log
+import multiprocessing
 import os
 import pandas as pd
 import re
+from ingest_manifest import IngestManifest
+from site_runner import run_sites
+import shutil
 import sys
+import tempfile
 import zipfile
 
 # If executed from cron, paths are relative to PWD, so anything we need must 
@@ -51,13 +68,72 @@ def parse_arguments():
                  '"nightly_past14d".) If the name is different, the batch '
                  'export will not be downloaded and processing will move on '
                  'to the next site.')
+    parser.add_argument('--site-workers', type=int, default=4,
+            help="Number of sites processed at the same time")
+    parser.add_argument('--rate-limit', type=float, default=None,
+            help="Maximum Fitabase requests per second, per site")
+    parser.add_argument('--connections', type=int, default=4,
+            help="Number of parallel connections for the batch download.")
+    parser.add_argument('--extract-workers', type=int, default=1,
+            help="Number of processes extracting the archive in parallel.")
+    parser.add_argument('--delta-dir', default=None,
+            help="Also append the rows of each subject's files that are newer "
+                 "than those already ingested to DELTA_DIR/SITE/SUBJECT/"
+                 "MEASURE.csv (see delta_log.py)")
+    parser.add_argument('--lookback-hours', type=float, default=24,
+            help="With --delta-dir, also append the rows of this many hours "
+                 "before the last one ingested, in case they were revised")
+    parser.add_argument('--change-feed', default=None,
+            help="SQLite database to publish the changed subjects and "
+                 "measures of each batch to (default: .change_feed.sqlite in "
+                 "the root or target dir; see change_feed.py)")
+    parser.add_argument('--catalog', default=None,
+            help="Catalog of the data root to record the extracted files in "
+                 "(default: ROOT_DIR/.catalog.sqlite, unless --target-dir is "
+                 "given; see catalog.py)")
+    parser.add_argument('--dedup', action='store_true',
+            help="Store each distinct file once, in TARGET_DIR/.objects, and "
+                 "hardlink it into place (see content_store.py)")
+    parser.add_argument('--force', '-f', action='store_true',
+            help="Download and extract the batch even if the site's ingest "
+                 "manifest says it was already ingested")
     parser.add_argument('--no-download', '-n', action='store_true',
             help="Check but do not download.")
     parser.add_argument('--no-extract', '-x', action='store_true',
             help="Do not extract the files from the zip.")
+    parser.add_argument('--compress', default=None,
+            choices=sorted(compressed_csv.COMPRESSIONS),
+            help="Write the extracted CSVs compressed, as NAME.csv.gz or "
+                 "NAME.csv.zst (see compressed_csv.py)")
+    parser.add_argument('--columnar-dir', default=None,
+            help="Also convert each subject's files into typed columnar "
+                 "files under COLUMNAR_DIR/site=SITE/measure=MEASURE/"
+                 "subject=SUBJECT/ (see columnar.py; needs pyarrow)")
+    parser.add_argument('--columnar-format', default='parquet',
+            choices=sorted(columnar.FORMATS),
+            help="Format of the columnar files (default: parquet)")
+    parser.add_argument('--columnar-only', action='store_true',
+            help="Only write the columnar files, not the extracted CSVs")
+    parser.add_argument('--metrics-file', default=None,
+            help="Write Fitabase API request metrics here at the end of the "
+                 "run (Prometheus textfile if it ends in .prom, else JSON)")
+    cassettes = parser.add_mutually_exclusive_group()
+    cassettes.add_argument('--record-dir', default=None,
+            help="Save each site's Fitabase API responses to a cassette "
+                 "(SITE.json) in this directory, with the token removed")
+    cassettes.add_argument('--replay-dir', default=None,
+            help="Answer Fitabase API calls from the cassettes in this "
+                 "directory instead of the network")
     parser.add_argument('--verbose', '-v', action='store_true',
             help="Display / save logged INFO-level messages.")
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.columnar_only and not args.columnar_dir:
+        parser.error('--columnar-only requires --columnar-dir')
+    if args.columnar_dir:
+        columnar.require_pyarrow()
+    if args.compress == 'zstd':
+        compressed_csv.require_zstandard()
+    return args
 
 
 def ensure_directory(root, *args):
@@ -66,32 +142,189 @@ def ensure_directory(root, *args):
     """
     export_dir = os.path.join(root, *args)
     if not os.path.isdir(export_dir):  # makedirs -> OSError if leaf dir exists
-        os.makedirs(export_dir)  # could still raise OSError for permissions
+        try:
+            os.makedirs(export_dir)  # could still raise OSError for permissions
+        except OSError:
+            # Another site's worker may have created it in the meantime
+            if not os.path.isdir(export_dir):
+                raise
     return export_dir
 
 
-def group_files_into_matched_directories(file_list, subject_pattern=r'^(NDAR_[^_]+)_(.+)_\d{8}_\d{8}\.csv$'):
+SUBJECT_PATTERN = re.compile(r'^(NDAR_[^_]+)_(.+)_\d{8}_\d{8}\.csv$')
+
+
+def group_files_into_matched_directories(file_list, subject_pattern=SUBJECT_PATTERN):
     """
     Separate a list of strings into groups based on a regex pattern match 
     **with multiple match groups**, thus creating an arbitrary number of 
-    subdirectories. (Those subdirectories do have to be consecutive right now - 
-    maybe there's a way to work around that?)
+    subdirectories. Members of a group need not be consecutive in file_list.
 
-    Returns an itertools.Groupby iterable of the form 
-        (group_key1, group_key2, ...) -> [member_list].
+    Returns an OrderedDict of the form 
+        (group_key1, group_key2, ...) -> [member_list],
+    with groups in order of first appearance and members in their original 
+    order. Strings that do not match are grouped under None.
 
     (Note that re.match only matches the beginning of the string. If group_key 
     is located elsewhere in the string, re.search or equivalent should be used 
     instead.)
     """
-    def get_subject_id(haystack):
-        match = re.match(subject_pattern, haystack)
-        if not match:
-            return None
-        else:
-            return match.groups()
+    match = re.compile(subject_pattern).match
+    groups = OrderedDict()
+    for haystack in file_list:
+        found = match(haystack)
+        groups.setdefault(found.groups() if found else None, []).append(haystack)
+    return groups
+
+
+# Read / write buffer for extracted members
+EXTRACT_BUFFER_SIZE = 1024 * 1024
+
+
+def extracted_name(name, compression=None):
+    """
+    The name a member is extracted under: with compression, CSVs get the 
+    suffix of compressed_csv.COMPRESSIONS appended.
+    """
+    if compression and name.endswith('.csv'):
+        return name + compressed_csv.COMPRESSIONS[compression]
+    return name
+
+
+def extract_members(zip_path, members, store_dir=None, compression=None):
+    """
+    Extract (member name, destination directory) pairs from the archive at 
+    zip_path; the destination directories must already exist. Returns the 
+    number of bytes written.
+
+    With store_dir, each member is put into that ContentStore and hardlinked 
+    into place, so only content the store has not seen yet is written. With 
+    compression, CSVs are written compressed (see extracted_name).
+    """
+    store = store_dir and ContentStore(store_dir)
+    written = 0
+    with zipfile.ZipFile(zip_path) as site_zip:
+        for name, dest_dir in members:
+            # Unlike ZipFile.extract, this does not sanitize the member name, 
+            # so refuse anything that would land outside dest_dir
+            if os.path.isabs(name) or '..' in name.split('/'):
+                raise ValueError('Unsafe member name in %s: %s' % (zip_path, name))
+            dest = os.path.join(dest_dir, extracted_name(name, compression))
+            with site_zip.open(name) as src:
+                if dest == os.path.join(dest_dir, name):
+                    written += _write_member(src, dest, store)
+                    continue
+                # Compress first, so that the store sees what goes to disk
+                with tempfile.SpooledTemporaryFile(EXTRACT_BUFFER_SIZE) as compressed:
+                    compressed_csv.write_compressed(src, compressed, compression)
+                    compressed.seek(0)
+                    written += _write_member(compressed, dest, store)
+    return written
+
+
+def _write_member(src, dest, store=None):
+    if store:
+        _, new = store.put(src, dest)
+        return os.path.getsize(dest) if new else 0
+    # dest may be a hardlink into the store from an earlier --dedup run; 
+    # writing into it would change the stored object (and every other link 
+    # to it), so replace the link instead
+    if os.path.lexists(dest):
+        os.remove(dest)
+    with open(dest, 'wb', EXTRACT_BUFFER_SIZE) as dst:
+        shutil.copyfileobj(src, dst, EXTRACT_BUFFER_SIZE)
+        return dst.tell()
+
+
+def _extract_members_star(job):
+    extract, zip_path, members = job
+    return extract(zip_path, members)
+
+
+def extract_members_parallel(zip_path, members, workers=1,
+                             extract=extract_members):
+    """
+    Like extract_members, but split across a pool of `workers` processes, 
+    each opening the archive by itself. (Decompression is CPU-bound, so 
+    threads would not help.) `extract` may be any module-level function 
+    (or functools.partial of one) with the same signature, such as 
+    columnar.convert_members.
+    """
+    if workers <= 1 or len(members) < 2:
+        return extract(zip_path, members)
+
+    # Deal the members out largest first, so that the chunks come out about 
+    # equally large; a few chunks per worker even out the rest
+    with zipfile.ZipFile(zip_path) as site_zip:
+        sizes = dict((info.filename, info.compress_size)
+                     for info in site_zip.infolist())
+    ordered = sorted(members, key=lambda member: -sizes.get(member[0], 0))
+    n_chunks = min(len(ordered), workers * 4)
+    chunks = [ordered[i::n_chunks] for i in range(n_chunks)]
+
+    pool = multiprocessing.Pool(min(workers, n_chunks))
+    try:
+        return sum(pool.map(_extract_members_star,
+                            [(extract, zip_path, chunk) for chunk in chunks]))
+    finally:
+        pool.close()
+        pool.join()
+
+def append_deltas(zip_path, files_by_subject, site_delta_dir, lookback):
+    """
+    Append the new rows of each (subject, measure) group of members to its 
+    log in site_delta_dir, and advance the groups' high-water marks. Returns 
+    the number of rows appended, and a list of (subject, measure, first 
+    time, last time) of the groups whose data went past their mark.
+    """
+    marks = HighWaterMarks(os.path.join(site_delta_dir, '.high_water_marks.json'))
+    appended = 0
+    changes = []
+    with zipfile.ZipFile(zip_path) as site_zip:
+        for subdir, files in files_by_subject.items():
+            if subdir is None:
+                continue
+            subject, measure = subdir
+            # Every member is compared with the mark as of the previous batch
+            mark = marks.get(subject, measure)
+            since = marks.since(subject, measure, lookback)
+            log_path = os.path.join(
+                ensure_directory(site_delta_dir, subject), measure + '.csv')
+            total, first, last = 0, None, None
+            for f in sorted(files):
+                try:
+                    with site_zip.open(f) as src:
+                        rows, member_first, member_last = append_new_rows(
+                                src, measure, log_path, since)
+                except ValueError as e:
+                    log.warning('%s: %s; not appended to %s', f, e, log_path)
+                    break
+                total += rows
+                if member_first is not None:
+                    first = min(first or member_first, member_first)
+                    last = max(last or member_last, member_last)
+            appended += total
+            if last is not None and (mark is None or last > mark):
+                marks.update(subject, measure, last)
+                changes.append((subject, measure, first, last))
+    marks.save()
+    return appended, changes
+
+
+def member_time_range(name):
+    """
+    The first and last time that an exported file covers, going by its name 
+    (e.g. NDAR_INVXXX_heartrate_1min_20181101_20181114.csv), or None, None.
+    """
+    found = re.search(r'_(\d{8})_(\d{8})\.csv$', name)
+    if not found:
+        return None, None
+    # Not strptime: site threads call this, and on Python 2 the first 
+    # strptime made from several threads at once can fail with AttributeError
+    first, last = [datetime.datetime(int(day[:4]), int(day[4:6]), int(day[6:]))
+                   for day in found.groups()]
+    return first, last + datetime.timedelta(days=1, seconds=-1)
 
-    return itertools.groupby(file_list, get_subject_id)
 
 if __name__ == "__main__":
     args = parse_arguments()
@@ -103,14 +336,28 @@ if __name__ == "__main__":
         fitabase_tokens = pd.DataFrame.from_records(fitabase_tokens, index='name')
 
     log.info('Started run with invocation: %s', sys.argv)
-    for site in args.site:
+    # Shared by all sites' Fitabase API objects
+    api_metrics = fitabase.RequestMetrics()
+    change_feed = ChangeFeed(args.change_feed or os.path.join(
+        args.target_dir or args.root_dir, '.change_feed.sqlite'))
+    # The catalog lives in the data root that its paths are relative to
+    catalog_path = args.catalog or (None if args.target_dir else
+            os.path.join(args.root_dir, '.catalog.sqlite'))
+    catalog = catalog_path and Catalog(catalog_path,
+            os.path.dirname(os.path.abspath(catalog_path)))
+
+    def process_site(site):
+        try:
+            fit_token = fitabase_tokens.loc[site, 'token']
+        except KeyError:
+            log.error('%s: Fitabase token ID is not available!', site)
+            return
+        fit_api = fitabase.Project(fit_token, rate_limit=args.rate_limit,
+                metrics=api_metrics,
+                transport=fitabase.cassette_transport(
+                    record_to=args.record_dir and os.path.join(args.record_dir, site + '.json'),
+                    replay_from=args.replay_dir and os.path.join(args.replay_dir, site + '.json')))
         try:
-            try:
-                fit_token = fitabase_tokens.loc[site, 'token']
-            except KeyError:
-                log.error('%s: Fitabase token ID is not available!', site)
-                continue
-            fit_api = fitabase.Project(fit_token)
             last_batch = fit_api.get_last_batch_export_info()
 
             if args.batch_name and last_batch.get('Name') != args.batch_name:
@@ -122,11 +369,11 @@ if __name__ == "__main__":
                 last_id = last_batch.get('DownloadDataBatchId')
             except (AttributeError, IOError) as e:
                 log.error('%s: Last batch ID not available.', site)
-                continue
+                return
 
             if args.no_download:
                 log.info('%s, %s: Not downloading', site, last_id)
-                continue
+                return
 
             # Determine what the base directory is and create it if needed
             if args.target_dir:
@@ -134,50 +381,160 @@ if __name__ == "__main__":
             else:
                 target_dir = ensure_directory(args.root_dir, site)
 
+            manifest = IngestManifest(os.path.join(target_dir,
+                '.ingest_manifest_%s.json' % site))
+            if manifest.has_batch(last_id) and not args.force:
+                log.info('%s, %s: Batch already ingested; skipping', 
+                         site, last_id)
+                return
+
             ymd_string = datetime.datetime.now().strftime('%Y%m%d')  # .utcnow()?
+            store_dir = os.path.join(target_dir, '.objects') if args.dedup else None
 
             # Save the whole zip file if required...
             if args.no_extract:
-                site_zip_stream = fit_api.export_batch(last_id)
-
                 file_name = "%s_%s.zip" % (ymd_string, last_id[:6])
                 target_file = os.path.join(target_dir, file_name)
-                with file(target_file, mode='wb') as zf:
-                    zf.write(site_zip_stream.read())
+                fit_api.download_batch(last_id, target_file,
+                        connections=args.connections)
 
+                # The batch is not recorded in the manifest: nothing has been 
+                # extracted from it yet, so the next run should still do that
                 log.info('%s, %s: Saving zip file without extraction to %s',
                          site, last_id, target_file)
-                continue
+                return
 
-            # ...otherwise, extracting files one way or another:
-            with fit_api.get_batch_export_zipfile(last_id) as site_zip:
-                if args.no_subject_subdirs:
+            # ...otherwise, extracting files one way or another. The archive is 
+            # downloaded next to its destination (rather than into memory) under 
+            # a name that stays the same between runs, so that a download cut 
+            # short is resumed by the next run; it is removed once extracted.
+            zip_path = os.path.join(target_dir, '.batch_%s.zip' % last_id)
+            fit_api.download_batch(last_id, zip_path,
+                    connections=args.connections)
+            with zipfile.ZipFile(zip_path) as site_zip:
+                # Group files by participant, then extract them into subdirs
+                files_by_subject = group_files_into_matched_directories(
+                        site_zip.namelist())
+                if args.columnar_only:
+                    files_by_dir = OrderedDict()
+                elif args.no_subject_subdirs:
                     target_dir = ensure_directory(target_dir, ymd_string)
-                    site_zip.extractall(path=target_dir)
-                    log.info('%s, %s: Extracting all files as-is to %s', 
-                            site, last_id, target_dir)
+                    files_by_dir = OrderedDict([(None, site_zip.namelist())])
                 else:
-                    # Group files by participant, then extract them into subdirs
-                    all_files = site_zip.namelist()
-                    files_by_dir = group_files_into_matched_directories(all_files)
-                    for subdir, files in files_by_dir:
-                        # If subject ID did not match the pattern, then the file 
-                        # was not grouped:
-                        if subdir is not None:
-                            subject_dir = ensure_directory(target_dir, *subdir)
+                    files_by_dir = files_by_subject
+
+                # Plan the writes one subject at a time: which members have 
+                # changed, and which directories they need
+                to_extract = []
+                extracted_info = []
+                directories = set()
+                skipped = 0
+                for subdir, files in files_by_dir.items():
+                    # If subject ID did not match the pattern, then the file 
+                    # was not grouped:
+                    if subdir is not None:
+                        subject_dir = os.path.join(target_dir, *subdir)
+                    else:
+                        subject_dir = target_dir
+
+                    # Extract all files in the group to the designated subdir, 
+                    # unless an identical copy is already there
+                    for f in files:
+                        if f.endswith('/'):
+                            continue
+                        dest = os.path.join(subject_dir,
+                                extracted_name(f, args.compress))
+                        info = site_zip.getinfo(f)
+                        if manifest.unchanged(dest, info):
+                            skipped += 1
                         else:
-                            subject_dir = target_dir
+                            to_extract.append((f, subject_dir))
+                            extracted_info.append(info)
+                            directories.add(os.path.dirname(dest))
 
-                        # Extract all files in the group to the designated subdir
+                # Likewise for the columnar copies, which are always 
+                # partitioned by subject
+                to_convert = []
+                converted_info = []
+                if args.columnar_dir:
+                    for subdir, files in files_by_subject.items():
+                        if subdir is None:
+                            continue
+                        subject, measure = subdir
                         for f in files:
-                            site_zip.extract(f, path=subject_dir)
+                            dest = columnar.columnar_path(args.columnar_dir,
+                                    site, measure, subject, f,
+                                    args.columnar_format)
+                            info = site_zip.getinfo(f)
+                            if manifest.unchanged(dest, info):
+                                skipped += 1
+                            else:
+                                to_convert.append((f, dest))
+                                converted_info.append(info)
+                                directories.add(os.path.dirname(dest))
+
+            # All directories are created up front, so that the extraction 
+            # workers only write files
+            for directory in directories:
+                ensure_directory(directory)
+            extract_members_parallel(zip_path, to_extract,
+                    workers=args.extract_workers,
+                    extract=functools.partial(extract_members,
+                                              store_dir=store_dir,
+                                              compression=args.compress))
+            extracted = [os.path.join(subject_dir, extracted_name(f, args.compress))
+                         for f, subject_dir in to_extract]
+            for dest, info in zip(extracted, extracted_info):
+                manifest.record_member(dest, info)
+            if catalog:
+                catalog.update(extracted)
+            extract_members_parallel(zip_path, to_convert,
+                    workers=args.extract_workers,
+                    extract=columnar.convert_members)
+            for (f, dest), info in zip(to_convert, converted_info):
+                manifest.record_member(dest, info)
+            if args.delta_dir:
+                appended, changes = append_deltas(zip_path, files_by_subject,
+                        ensure_directory(args.delta_dir, site),
+                        datetime.timedelta(hours=args.lookback_hours))
+                log.info('%s, %s: Appended %d rows to %s.',
+                         site, last_id, appended, args.delta_dir)
+            else:
+                # Without the deltas, go by the names of the changed files
+                ranges = OrderedDict()
+                for f, _ in to_extract + to_convert:
+                    found = SUBJECT_PATTERN.match(f)
+                    if not found:
+                        continue
+                    first, last = member_time_range(f)
+                    known = ranges.get(found.groups(), (first, last))
+                    ranges[found.groups()] = (min(known[0], first),
+                                              max(known[1], last))
+                changes = [key + times for key, times in ranges.items()]
+            change_feed.publish(site, last_id, changes)
+            log.info('%s, %s: Published %d changed subject measures to %s.',
+                     site, last_id, len(changes), change_feed.path)
 
-                    log.info('%s, %s: Extracted files into per-subject folders in '
-                             '%s.',
-                             site, last_id, target_dir)
+            if not args.columnar_only:
+                log.info('%s, %s: Extracted %d files into %s%s.',
+                         site, last_id, len(to_extract), target_dir,
+                         '' if args.no_subject_subdirs
+                         else ' in per-subject folders')
+            if args.columnar_dir:
+                log.info('%s, %s: Converted %d files into %s.',
+                         site, last_id, len(to_convert), args.columnar_dir)
+            log.info('%s, %s: %d files unchanged.', site, last_id, skipped)
+            if store_dir:
+                log.info('%s: Content store %s', site,
+                         format_report(ContentStore(store_dir).report()))
+            manifest.record_batch(last_id)
+            manifest.save()
+            os.remove(zip_path)
+        finally:
+            fit_api.close()
 
-        except Exception as e:
-            log.critical("%s: Uncaught exception occurred.", site, exc_info=True)
-            continue
+    run_sites(args.site, process_site, workers=args.site_workers)
 
+    if args.metrics_file:
+        api_metrics.dump(args.metrics_file)
     log.info('Ended run with invocation: %s', sys.argv)
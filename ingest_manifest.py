@@ -0,0 +1,91 @@
+"""
+Record of what ingest_latest_export.py has already extracted for a site.
+
+Fitabase often serves the same batch export on consecutive days, and a new
+batch mostly repeats files that are already on disk. The manifest keeps the
+IDs of ingested batches, and the CRC32 and size (from the zip's central
+directory) of every file extracted, so that a re-run can skip an unchanged
+batch without downloading it, and otherwise extract only the members whose
+content changed.
+
+Imagined use:
+
+```python
+manifest = IngestManifest(os.path.join(target_dir, '.ingest_manifest_UCSD.json'))
+if not manifest.has_batch(batch_id):
+    for info in site_zip.infolist():
+        if not manifest.unchanged(dest, info):
+            site_zip.extract(info, path=subject_dir)
+            manifest.record_member(dest, info)
+    manifest.record_batch(batch_id)
+    manifest.save()
+```
+"""
+import json
+import os
+import tempfile
+
+
+class IngestManifest(object):
+    """
+    Ingested batch IDs and extracted files, persisted as JSON in `path`.
+
+    Files are keyed by their path relative to the manifest's directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        self.batches = []
+        self.members = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.batches = state.get('batches', [])
+            self.members = state.get('members', {})
+
+    def _key(self, dest):
+        return os.path.relpath(os.path.abspath(dest), self.root)
+
+    def has_batch(self, batch_id):
+        return batch_id in self.batches
+
+    def unchanged(self, dest, info):
+        """
+        Is the file at dest what extracting (or converting) the zip member
+        `info` (a zipfile.ZipInfo) would produce?
+        """
+        entry = self.members.get(self._key(dest))
+        return (entry is not None
+                and entry['crc'] == info.CRC
+                and entry['size'] == info.file_size
+                and os.path.isfile(dest)
+                and os.path.getsize(dest) == entry.get('written',
+                                                       info.file_size))
+
+    def record_member(self, dest, info):
+        """
+        Record that dest was written from the zip member `info`. The size of
+        dest is kept too, since a converted file (see columnar.py) differs
+        in size from the member.
+        """
+        self.members[self._key(dest)] = {'crc': info.CRC,
+                                          'size': info.file_size,
+                                          'written': os.path.getsize(dest)}
+
+    def record_batch(self, batch_id):
+        if batch_id not in self.batches:
+            self.batches.append(batch_id)
+
+    def save(self):
+        """
+        Write the manifest (atomically, via a rename). Entries for files that
+        no longer exist are dropped.
+        """
+        self.members = dict(
+            (key, entry) for key, entry in self.members.items()
+            if os.path.isfile(os.path.join(self.root, key)))
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'batches': self.batches, 'members': self.members}, f)
+        os.rename(tmp_path, self.path)
@@ -0,0 +1,233 @@
+"""
+Registry of the Fitabase measures: how to read each one.
+
+For every measure (the folder name in the data tree, e.g. heartrate_1min),
+MEASURES gives the column its rows are indexed by, the format of the times
+in that column, the dtypes of its other columns, and the columns that
+identify a row when exports are merged (the last copy of a row wins).
+concat.py, ingest_latest_export.py (through columnar.py and delta_log.py)
+and score/old_score.py all read the exported CSVs with read_csv here:
+
+```python
+hr = read_csv('NDAR_INVXXX_heartrate_1min_20181101_20181114.csv')
+hr['Time']  # datetime64, parsed with MEASURES['heartrate_1min'].time_format
+hr['Value']  # uint8
+```
+
+Giving pandas the dtypes saves it inferring them from the text of every
+file, and keeps minute-level data in 1- and 2-byte columns instead of
+8-byte ones. Parsing the times with their known format is many times
+faster than letting pandas guess it.
+"""
+from collections import namedtuple
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+import compressed_csv
+
+# index: the time column rows are indexed (and merged) by
+# time_format: how Fitabase writes that column
+# dtypes: of the other columns; those not listed are inferred. Decimals stay
+#   float64: merged files are written back, and float32 would print 1.23456789
+#   as 1.2345679
+# key: the columns that identify a row
+Measure = namedtuple('Measure', ['index', 'time_format', 'dtypes', 'key'])
+
+# Fitabase writes times as "11/1/2018 12:00:00 AM", and days as "11/1/2018"
+TIME_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+DAY_FORMAT = '%m/%d/%Y'
+
+
+def _measure(index, time_format=TIME_FORMAT, dtypes=None, key=None):
+    return Measure(index, time_format, dtypes or {}, key or (index,))
+
+
+_MINUTE_SLEEP = {'value': 'uint8', 'logId': 'int64'}
+_SLEEP_DAY = {'TotalSleepRecords': 'uint8', 'TotalMinutesAsleep': 'int16',
+              'TotalTimeInBed': 'int16'}
+_SLEEP_LOG = {'LogId': 'int64', 'Duration': 'int32'}
+
+MEASURES = {
+    'heartrate': _measure('Time', dtypes={'Value': 'uint8'}),
+    'heartrate_1min': _measure('Time', dtypes={'Value': 'uint8'}),
+    '30secondSleepStages': _measure('Time', dtypes={
+        'LogId': 'int64', 'Level': 'category', 'ShortWakes': 'category',
+        'SleepStage': 'category'}),
+    'minuteCaloriesNarrow': _measure('ActivityMinute', dtypes={
+        'Calories': 'float64'}),
+    'minuteIntensitiesNarrow': _measure('ActivityMinute', dtypes={
+        'Intensity': 'uint8'}),
+    'minuteMETsNarrow': _measure('ActivityMinute', dtypes={
+        'METs': 'float64'}),
+    'minuteStepsNarrow': _measure('ActivityMinute', dtypes={
+        'Steps': 'int16'}),
+    'minuteSleep': _measure('date', dtypes=_MINUTE_SLEEP),
+    'sleepDay': _measure('SleepDay', dtypes=_SLEEP_DAY),
+    'sleepStagesDay': _measure('SleepDay', dtypes=dict(_SLEEP_DAY, **{
+        'TotalTimeAwake': 'int16', 'TotalMinutesLight': 'int16',
+        'TotalMinutesDeep': 'int16', 'TotalMinutesREM': 'int16'})),
+    'activitylogs': _measure('StartTime'),
+    'sleepLogInfo': _measure('StartTime', dtypes=_SLEEP_LOG),
+    'sleepStageLogInfo': _measure('StartTime', dtypes=_SLEEP_LOG),
+    'battery': _measure('DateTime', dtypes={'DeviceName': 'category',
+                                            'BatteryLevel': 'category'}),
+    'dailyActivity': _measure('ActivityDate', DAY_FORMAT, {
+        'TotalSteps': 'int32', 'TotalDistance': 'float64',
+        'VeryActiveMinutes': 'int16', 'FairlyActiveMinutes': 'int16',
+        'LightlyActiveMinutes': 'int16', 'SedentaryMinutes': 'int16',
+        'Calories': 'int16'}),
+    'dailySteps': _measure('ActivityDay', DAY_FORMAT, {'StepTotal': 'int32'}),
+}
+
+DATE_RANGE_PATTERN = re.compile(r'_\d{8}_\d{8}$')
+
+
+def get(measure):
+    """
+    The Measure of a measure name; raises ValueError if it is not known.
+    """
+    try:
+        return MEASURES[measure]
+    except KeyError:
+        raise ValueError('Unknown measure: %s' % measure)
+
+
+def measure_of(name):
+    """
+    The measure of a data file, from its name (an export member like
+    NDAR_INVXXX_heartrate_1min_20181101_20181114.csv, or a merged file like
+    heartrate_1min.csv); None if it is not a known measure.
+    """
+    base = DATE_RANGE_PATTERN.sub('', compressed_csv.strip_csv_suffix(name))
+    # The longest match, so that ..._heartrate_1min isn't taken for heartrate
+    for measure in sorted(MEASURES, key=len, reverse=True):
+        if base == measure or base.endswith('_' + measure):
+            return measure
+    return None
+
+
+def parse_times(values, time_format=None):
+    """
+    Convert a column of Fitabase time strings to datetimes. The given format
+    (or else the usual ones) is tried first, since inferring the format is
+    far slower; values that fit none of them become NaT. Columns that are
+    already datetimes are returned as they are.
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    formats = [TIME_FORMAT, DAY_FORMAT]
+    if time_format is not None:
+        formats.insert(0, time_format)
+    for candidate in formats:
+        try:
+            return pd.to_datetime(values, format=candidate)
+        except (TypeError, ValueError):
+            continue
+    return pd.to_datetime(values, errors='coerce')
+
+
+# The zero padding that strftime gives the month, day and hour (but not the
+# minutes and seconds), which Fitabase leaves out
+_PADDING = re.compile(r'(^|[/ ])0(\d)')
+
+
+def format_times(values, time_format=TIME_FORMAT):
+    """
+    Convert a column of datetimes back to strings as Fitabase writes them,
+    e.g. "11/1/2018 1:02:00 PM". NaT becomes NaN.
+    """
+    text = values.dt.strftime(time_format).str.replace(_PADDING, r'\1\2',
+                                                       regex=True)
+    # Older pandas formats NaT as "NaT"
+    return text.where(values.notnull())
+
+
+def _is_integer(dtype):
+    return dtype.startswith(('int', 'uint'))
+
+
+def _wide_dtypes(dtypes):
+    # read_csv doesn't check that integers fit the dtype it is given: 300 in
+    # a uint8 column becomes 44. So they are read as int64, and narrowed
+    # once they are known to fit.
+    return dict((column, 'int64' if _is_integer(dtype) else dtype)
+                for column, dtype in dtypes.items())
+
+
+def _float_dtypes(dtypes):
+    # Integer columns can't hold missing values; float32 can (and holds
+    # counts exactly), but IDs need float64
+    return dict((column, ('float64' if dtype == 'int64' else 'float32')
+                 if _is_integer(dtype) else dtype)
+                for column, dtype in dtypes.items())
+
+
+def _narrow(frame, dtypes):
+    """
+    Convert the int64 columns of frame to their narrow dtypes where all
+    values fit.
+    """
+    for column, dtype in dtypes.items():
+        if (not _is_integer(dtype) or column not in frame.columns or
+                frame[column].dtype != np.int64):
+            continue
+        values = frame[column]
+        bounds = np.iinfo(dtype)
+        if values.empty or (values.min() >= bounds.min and
+                            values.max() <= bounds.max):
+            frame[column] = values.astype(dtype)
+    return frame
+
+
+def read_csv(src, measure=None, parse_index=True):
+    """
+    Read an exported or merged CSV (a path, plain or compressed, or an open
+    file) of `measure`, by default the one its path names. The columns get
+    the measure's dtypes, and the index column is parsed as datetimes (unless
+    parse_index is false). Files of unknown measures are read as by
+    pandas.read_csv.
+
+    If a file doesn't fit the dtypes (say, a count is missing), its integer
+    columns are read as floats, and failing that, their dtypes inferred.
+    Integers out of their dtype's range (a heart rate over 255) keep int64.
+    """
+    is_file = hasattr(src, 'read')
+    if measure is None and not is_file:
+        measure = measure_of(os.path.basename(src))
+    schema = MEASURES.get(measure)
+    read = pd.read_csv if is_file else compressed_csv.read_csv
+    if schema is None:
+        return read(src)
+
+    for dtypes in [_wide_dtypes(schema.dtypes), _float_dtypes(schema.dtypes),
+                   None]:
+        try:
+            frame = _narrow(read(src, dtype=dtypes), schema.dtypes)
+            break
+        except (ValueError, OverflowError):
+            # An open file can only be read again if it can be rewound
+            if dtypes is None or (is_file and not hasattr(src, 'seek')):
+                raise
+            if is_file:
+                src.seek(0)
+    if parse_index and schema.index in frame.columns:
+        frame[schema.index] = parse_times(frame[schema.index],
+                                          schema.time_format)
+    return frame
+
+
+def write_csv(frame, path, measure):
+    """
+    Write a frame read by read_csv back as CSV, with the times as Fitabase
+    writes them (see format_times).
+    """
+    time_format = get(measure).time_format
+    times = dict((column, format_times(frame[column], time_format))
+                 for column in frame.columns
+                 if pd.api.types.is_datetime64_any_dtype(frame[column]))
+    if times:
+        frame = frame.assign(**times)
+    frame.to_csv(path, index=False)
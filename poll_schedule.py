@@ -0,0 +1,173 @@
+"""
+Decide which Fitabase profiles are worth polling for sync / battery data.
+
+Most devices cannot change the outcome of the alert scripts between two runs:
+a device that synced an hour ago with a full battery cannot cross the 3-day
+late-sync threshold or the low-battery conditions before it is polled again,
+and a device whose collection window has closed cannot trigger anything. The
+PollScheduler keeps the last observed SyncDate and battery level of each
+profile on disk, and only marks a profile as due once a poll could matter.
+
+Imagined use:
+
+```python
+scheduler = PollScheduler('poll_state/UCSD.json')
+due = scheduler.due(devices['ProfileId'], active_until=active_until)
+polled = api.get_all_tracker_sync_data(devices.loc[due])
+scheduler.update(devices.loc[due, 'ProfileId'], polled)
+scheduler.save()
+```
+"""
+import json
+import os
+import pandas as pd
+import random
+
+SYNC_COLUMN = 'SyncDateTracker'
+BATTERY_COLUMN = 'LatestBatteryLevelTracker'
+
+# Devices are worn for 23 days from fitc_device_dte, plus any fitc_extension
+COLLECTION_PERIOD = pd.Timedelta(days=23)
+
+# alert_late_sync.py alerts once the last sync is more than 3 days old
+LATE_SYNC_THRESHOLD = pd.Timedelta(days=3)
+
+# Longest time a profile goes unpolled, by last seen battery level. Battery
+# level is only reported on sync, so even a device that is nowhere near the
+# late-sync threshold has to be checked in case it is running down; LOW and
+# EMPTY (and unknown) devices are candidates for alert_low_battery.py and are
+# polled every run.
+MAX_POLL_INTERVAL = {
+    'High': pd.Timedelta(hours=24),
+    'Medium': pd.Timedelta(hours=12),
+}
+
+
+def collection_window_end(device_dte, extension_days=None):
+    """
+    Given Series of fitc_device_dte and fitc_extension, return the Series of 
+    times at which each device stops collecting data.
+    """
+    end = device_dte + COLLECTION_PERIOD
+    if extension_days is not None:
+        end = end + pd.to_timedelta(extension_days.fillna(0), unit='D')
+    return end
+
+
+class PollScheduler(object):
+    """
+    Persisted record of what each profile looked like when last polled.
+    """
+
+    def __init__(self, state_file, lead_time=pd.Timedelta(days=1),
+            audit_fraction=0.05, late_sync_threshold=LATE_SYNC_THRESHOLD,
+            max_poll_interval=MAX_POLL_INTERVAL, seed=None):
+        """
+        lead_time is how long before a threshold could be crossed a profile
+        becomes due; it should cover the time between two runs, so that the
+        alert scripts see fresh data by the time the threshold passes. The
+        default suits nightly runs.
+
+        audit_fraction of the profiles that are not due are polled anyway, so
+        that drift between the model and reality shows up.
+        """
+        self.state_file = state_file
+        self.lead_time = lead_time
+        self.audit_fraction = audit_fraction
+        self.late_sync_threshold = late_sync_threshold
+        self.max_poll_interval = max_poll_interval
+        self._random = random.Random(seed)
+        self.state = {}
+        if os.path.isfile(state_file):
+            with open(state_file) as f:
+                self.state = json.load(f)
+
+    def next_due(self, profile_id):
+        """
+        Return the time from which polling profile_id could change an alert
+        outcome, or None if it should be polled right away.
+        """
+        entry = self.state.get(profile_id)
+        if not entry or not entry.get('sync') or not entry.get('polled'):
+            return None
+        interval = self.max_poll_interval.get(entry.get('battery'))
+        if interval is None:
+            return None
+        return min(
+            pd.Timestamp(entry['sync']) + self.late_sync_threshold,
+            pd.Timestamp(entry['polled']) + interval) - self.lead_time
+
+    def due(self, profile_ids, active_until=None, now=None):
+        """
+        Return a boolean Series, indexed like profile_ids, marking profiles to
+        poll in this run.
+
+        If given, active_until (aligned with profile_ids by index) is the end
+        of each device's collection window; devices past it are only polled
+        as part of the audit sample. NaT means the window is not known.
+
+        Profiles never polled before are always due, whatever their window:
+        there is no last observed data to report for them instead.
+        """
+        if now is None:
+            now = pd.Timestamp.now()
+        due = pd.Series(False, index=profile_ids.index)
+        if active_until is not None:
+            active_until = active_until.reindex(profile_ids.index)
+
+        for idx, profile_id in profile_ids.items():
+            if not self.state.get(profile_id):
+                due.loc[idx] = True
+                continue
+            if active_until is not None:
+                window_end = active_until.loc[idx]
+                if pd.notnull(window_end) and window_end < now:
+                    due.loc[idx] = self._audit()
+                    continue
+            next_due = self.next_due(profile_id)
+            due.loc[idx] = next_due is None or next_due <= now or self._audit()
+        return due
+
+    def _audit(self):
+        return self._random.random() < self.audit_fraction
+
+    def update(self, profile_ids, results, now=None):
+        """
+        Record the outcome of polling: results is the output of
+        get_all_tracker_sync_data, indexed like profile_ids.
+        """
+        if now is None:
+            now = pd.Timestamp.now()
+        for idx, profile_id in profile_ids.items():
+            sync = results.loc[idx, SYNC_COLUMN]
+            battery = results.loc[idx, BATTERY_COLUMN]
+            self.state[profile_id] = {
+                'sync': pd.Timestamp(sync).isoformat() if pd.notnull(sync) else None,
+                'battery': battery if pd.notnull(battery) else None,
+                'polled': now.isoformat()}
+
+    def last_observed(self, profile_ids):
+        """
+        Return the stored sync date and battery level of each profile, in the
+        shape returned by get_all_tracker_sync_data.
+        """
+        rows = []
+        for profile_id in profile_ids:
+            entry = self.state.get(profile_id) or {}
+            rows.append({
+                SYNC_COLUMN: pd.Timestamp(entry['sync']) if entry.get('sync') else pd.NaT,
+                BATTERY_COLUMN: entry.get('battery')})
+        return pd.DataFrame(rows, index=profile_ids.index,
+                columns=[SYNC_COLUMN, BATTERY_COLUMN])
+
+    def save(self):
+        """
+        Write the state file (atomically, via a rename).
+        """
+        directory = os.path.dirname(os.path.abspath(self.state_file))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.state, f)
+        os.rename(tmp_file, self.state_file)
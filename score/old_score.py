@@ -17,6 +17,14 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 
+# Modules shared with the ingest scripts are in the repository root
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from catalog import Catalog
+from change_feed import ChangeFeed
+from compressed_csv import is_csv, strip_csv_suffix
+from concat import read_merged
+from measures import parse_times
+
 # Just to must pandas warnings
 pd.options.mode.chained_assignment = None
 
@@ -33,8 +41,24 @@ def parse_args():
     parser.add_argument('--assume-merged', action='store_true', 
             help="Assume files are coming from the equivalent of a Year 2 merge")
     parser.add_argument('--event', default='baseline_year_1_arm_1')
+    changes = parser.add_mutually_exclusive_group()
+    changes.add_argument('--changes', default=None,
+            help="Only score the participants that the change feed of "
+                 "ingest_latest_export.py lists since the last scoring run "
+                 "with --changes (see change_feed.py)")
+    changes.add_argument('--catalog', default=None,
+            help="Only score the participants with files that this data root "
+                 "catalog has as new since the last scoring run with "
+                 "--catalog (see catalog.py)")
+    parser.add_argument('--rescan', action='store_true',
+            help="With --catalog, scan the site's folder into the catalog "
+                 "first, for files that ingest_latest_export.py did not "
+                 "write")
     parser.add_argument('--verbose', '-v')
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.rescan and not args.catalog:
+        parser.error('--rescan needs --catalog')
+    return args
 
 
 def redcap_site_subjects(token, event):
@@ -75,7 +99,7 @@ def collect_fitabase_files_from_folder(folder):
     # for root, dirs, files in os.walk("data_SubStudy"):
     for root, dirs, files in os.walk(folder):
         for file in files:
-            if file.endswith(".csv"):
+            if is_csv(file):
                 sp = file.split("_")
                 pGUID = sp[0].strip()
                 if sp[0] == "NDAR":
@@ -94,7 +118,7 @@ def dateRangeSet( files ):
     for entry in files:
         file = entry['filename']
         fn = os.path.basename(file)
-        fn = os.path.splitext(fn)[0]
+        fn = strip_csv_suffix(fn)
         # example: NDAR_INV0AU5R8NA_30secondSleepStages_20160308_20180408.csv
         fn = fn.split("_")
         daterange = fn[-2] + "_" + fn[-1]
@@ -106,7 +130,7 @@ def dateRangeSet( files ):
         for entry in files:
             file = entry['filename']
             fn = os.path.basename(file)
-            fn = os.path.splitext(fn)[0]
+            fn = strip_csv_suffix(fn)
             # example: NDAR_INV0AU5R8NA_30secondSleepStages_20160308_20180408.csv
             fn = fn.split("_")
             daterange = fn[-2] + "_" + fn[-1]
@@ -130,15 +154,20 @@ def extract_pGUID(path_string):
 
 def collect_merged_fitabase_files(root_folder):
     """
-    Assumes a structure with child nodes of the form $SUBJECT_ID/merged/*.csv.
+    Assumes a structure with child nodes of the form $SUBJECT_ID/merged/*.csv,
+    or $SUBJECT_ID/merged/$MEASURE/ for measures partitioned by month (see
+    concat.py --partition-by-month).
 
     Alternative to collect_fitabase_files_from_folder for Year 2 data.
    """
 
     out_files = defaultdict(list)
     for root, dirs, files in os.walk(root_folder):
-        if not root.endswith('merged') or len(dirs) > 0:
+        if not root.endswith('merged'):
             continue
+        # Partitioned measures are read whole, by read_merged
+        files = files + dirs
+        dirs[:] = []
         try:
             pGUID = extract_pGUID(root)
         except ValueError:
@@ -186,21 +215,19 @@ def collect_merged_fitabase_files(root_folder):
 #   preferred method of contact in REDCap
 
 def normalizeDate( t, column ):
-    # normalize the Time entry to remove seconds
-    t[column] = t[column].apply(lambda x: datetime.strptime(x, '%m/%d/%Y %I:%M:%S %p').strftime('%m/%d/%Y %H:%M'))
+    # normalize the Time entry to remove seconds (read_merged has parsed it already)
+    t[column] = parse_times(t[column]).dt.strftime('%m/%d/%Y %H:%M')
         
 def normalizeDate30( t, column ):
     # normalize the Time entry to remove seconds / duplicate the SleepStage column to store the second entry in column+"30"
     # should be 00 or 30 to indicate which row is for which participant
-    t['slice'] = t[column]
-    t['slice'] = t['slice'].apply(lambda x: datetime.strptime(x, '%m/%d/%Y %I:%M:%S %p').strftime('%S'))
+    times = parse_times(t[column])
+    t['slice'] = times.dt.strftime('%S')
+    # strip the seconds
+    t[column] = times.dt.strftime('%m/%d/%Y %H:%M')
     # get two tables for 00 and 30
     table1 = t[t['slice'] == "00"]
-    # strip the seconds
-    table1[column] = table1[column].apply(lambda x: datetime.strptime(x, '%m/%d/%Y %I:%M:%S %p').strftime('%m/%d/%Y %H:%M'))
     table2 = t[t['slice'] == "30"]
-    # strip the seconds
-    table2[column] = table2[column].apply(lambda x: datetime.strptime(x, '%m/%d/%Y %I:%M:%S %p').strftime('%m/%d/%Y %H:%M'))
     # rename to SleepStage30
     table2 = table2.rename(columns={'SleepStage': 'SleepStage30'})
     # now merge both by time to get one Time, a 'SleepStage' and a 'SleepStage30'
@@ -306,7 +333,7 @@ def run_pandas_prep(validsteps, date0, min_day=-1, max_day=22):
 def load_and_normalize(instrument, callback=None, *args, **kwargs):
     fname = [item['filename'] for item in timerange if instrument in item['filename']][0]
     # Let the calling scope handle the possible IndexError
-    data = pd.read_csv(fname)
+    data = read_merged(fname)
     if callback:
         # callback expected to modify data in-place
         callback(data, *args, **kwargs)
@@ -317,7 +344,7 @@ def get_valid_steps(timerange, pGUID=None, site=None):
     # import the data
     try:
         heartrate = [item['filename'] for item in timerange if 'heartrate_1min' in item['filename']][0]
-        hrdata = pd.read_csv(heartrate).pipe(prepare_heart_rate, pGUID=pGUID, site=site)
+        hrdata = read_merged(heartrate).pipe(prepare_heart_rate, pGUID=pGUID, site=site)
     except IndexError:
         print("Error: timerange without heartrate_1min " + str([item['filename'] for item in timerange]))
         return None
@@ -326,29 +353,29 @@ def get_valid_steps(timerange, pGUID=None, site=None):
         # TODO: Later, determine if we can forgive the absence of a measure / 
         # if we can supply an empty DataFrame instead
         steps = [item['filename'] for item in timerange if 'minuteStepsNarrow' in item['filename']][0]
-        stdata = pd.read_csv(steps)
+        stdata = read_merged(steps)
         normalizeDate(stdata, 'ActivityMinute') # remove the seconds fom this date
         # data is in Steps
         
         # metabolic equivalents (METs)
         mets = [item['filename'] for item in timerange if 'minuteMETsNarrow' in item['filename']][0]
-        medata = pd.read_csv(mets)
+        medata = read_merged(mets)
         normalizeDate(medata, 'ActivityMinute')
         
         sl = [item['filename'] for item in timerange if 'minuteSleep' in item['filename']][0]
-        sldata = pd.read_csv(sl)
+        sldata = read_merged(sl)
         # rename the columns for the sleep valuea
         sldata.rename(columns={'value': 'sleep_value', 'logId': 'sleep_logId' }, inplace=True)
         normalizeDate(sldata, 'date')
 
         # add physical activity minuteIntensitiesNarrow (level 0, 1, 2, 3) -> get per day number in that activity state
         inte = [item['filename'] for item in timerange if 'minuteIntensitiesNarrow' in item['filename']][0]
-        indata = pd.read_csv(inte)
+        indata = read_merged(inte)
         normalizeDate(indata, 'ActivityMinute')
 
         # add 30second sleep stages (SleepStage,SleepStage30)
         sleep30 = [item['filename'] for item in timerange if '30secondSleepStages' in item['filename']][0]
-        sleep30data = pd.read_csv(sleep30)
+        sleep30data = read_merged(sleep30)
         sleep30data = normalizeDate30(sleep30data, 'Time')
     except IndexError as e:
         print("%s: Lacking one of the auxiliary data files." % pGUID)
@@ -941,6 +968,22 @@ if __name__ == "__main__":
     else:
         fitabase_files = collect_fitabase_files_from_folder(args.input)
 
+    if args.changes or args.catalog:
+        if args.changes:
+            change_feed = ChangeFeed(args.changes)
+        else:
+            # The catalog answers "what's new" just like a change feed
+            change_feed = Catalog(args.catalog,
+                    os.path.dirname(os.path.abspath(args.catalog)))
+            if (args.rescan and
+                    os.path.isdir(os.path.join(change_feed.root, site))):
+                change_feed.scan(os.path.join(change_feed.root, site))
+        changes = change_feed.pending('score/' + site, site=site)
+        changed_pGUIDs = set(change.subject for change in changes)
+        # Files of participants without changes are not scored, on purpose
+        for pGUID in set(fitabase_files) - changed_pGUIDs:
+            del fitabase_files[pGUID]
+
     scores = []
     # walk over the participants for this site
     for u in out:
@@ -1017,6 +1060,9 @@ if __name__ == "__main__":
     else:        
         print(json.dumps(scores_combined, indent=4))
 
+    if args.changes or args.catalog:
+        change_feed.acknowledge('score/' + site, changes, site=site)
+
     # list the files that we did not process
     for pGUID in fitabase_files:
         for entry in fitabase_files[pGUID]:
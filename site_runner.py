@@ -0,0 +1,103 @@
+"""
+Run the same per-site processing for many sites at once.
+
+Every site has its own Fitabase token (and so its own API quota), so there is
+no reason for one site's slow requests to hold up the next. run_sites hands
+the sites to a bounded pool of worker threads; a site that raises is logged
+and skipped without affecting the others.
+
+While a site is being processed, everything logged from its worker thread is
+held back, and released once the site is done - in the order the sites were
+given - so that the log still reads one site at a time.
+
+Imagined use:
+
+```python
+def process_site(site):
+    log.info('%s: Started processing', site)
+    ...
+
+results = run_sites(args.site, process_site, workers=args.site_workers)
+```
+"""
+import logging
+from multiprocessing.pool import ThreadPool
+import threading
+
+
+class _SiteLogRouter(logging.Handler):
+    """
+    Stand-in for the root logger's handlers: records logged from a thread
+    that is processing a site are buffered, all others are passed on.
+    """
+
+    def __init__(self, handlers):
+        super(_SiteLogRouter, self).__init__()
+        self.handlers = handlers
+        self._local = threading.local()
+
+    def start_buffering(self):
+        self._local.records = []
+
+    def stop_buffering(self):
+        records = self._local.records
+        self._local.records = None
+        return records
+
+    def emit(self, record):
+        records = getattr(self._local, 'records', None)
+        if records is not None:
+            records.append(record)
+        else:
+            self.forward([record])
+
+    def forward(self, records):
+        for record in records:
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+def run_sites(sites, process_site, workers=4, logger=None):
+    """
+    Call process_site(site) for each site, up to `workers` at a time.
+
+    Returns a dict of site -> return value; sites whose processing raised are
+    left out (the exception is logged as critical, like the scripts' own
+    per-site `except` blocks do).
+    """
+    if logger is None:
+        logger = logging.getLogger()
+    router = _SiteLogRouter(logger.handlers[:])
+
+    def run_one(item):
+        position, site = item
+        router.start_buffering()
+        try:
+            try:
+                return site, True, process_site(site)
+            except Exception:
+                logger.critical("%s: Uncaught exception occurred.", site,
+                                exc_info=True)
+                return site, False, None
+        finally:
+            run_one.records[position] = router.stop_buffering()
+
+    run_one.records = {}
+    results = {}
+    original_handlers = logger.handlers[:]
+    logger.handlers = [router]
+    pool = ThreadPool(max(1, min(workers, len(sites) or 1)))
+    try:
+        # imap yields in the order of `sites`, so each site's log is released
+        # only after all earlier sites' logs, even if it finished first
+        for position, (site, succeeded, result) in enumerate(
+                pool.imap(run_one, enumerate(sites))):
+            router.forward(run_one.records.pop(position))
+            if succeeded:
+                results[site] = result
+    finally:
+        pool.close()
+        pool.join()
+        logger.handlers = original_handlers
+    return results
@@ -0,0 +1,64 @@
+"""
+Tests for the catalog of data files under the data root.
+"""
+import os
+
+from catalog import Catalog
+
+
+def test_consumers_see_files_new_since_their_checkpoint(tmpdir):
+    root = tmpdir.join('data')
+    folder = root.join('UCSD', 'NDAR_INVA', 'heartrate_1min').ensure(dir=True)
+    first = folder.join('NDAR_INVA_heartrate_1min_20181101_20181114.csv')
+    first.write('Time,Value\n')
+    root.join('UCSD', 'NDAR_INVA', 'merged').ensure(dir=True) \
+        .join('heartrate_1min.csv').write('Time,Value\n')
+    root.join('UCSD', '.objects').ensure(dir=True).join('x.csv').write('x')
+    catalog = Catalog(str(root.join('.catalog.sqlite')), str(root))
+
+    assert catalog.scan() == 1
+    entries = catalog.pending('concat')
+    assert [(e.site, e.subject, e.measure, e.first_day, e.last_day)
+            for e in entries] == [('UCSD', 'NDAR_INVA', 'heartrate_1min',
+                                   '20181101', '20181114')]
+    catalog.acknowledge('concat', entries)
+    assert catalog.scan() == 0
+    assert catalog.pending('concat') == []
+
+    # Touched, but the same content: not new. An older mtime is still noticed
+    os.utime(str(first), (0, 1000000000))
+    assert catalog.scan() == 0
+    first.write('Time,Value\n11/1/2018 12:00:00 AM,61\n')
+    os.utime(str(first), (0, 1000000000))
+    second = folder.join('NDAR_INVA_heartrate_1min_20181102_20181115.csv')
+    second.write('Time,Value\n')
+    assert catalog.update([str(second)]) == 1
+    assert catalog.scan(str(root.join('UCSD'))) == 1
+    assert sorted(os.path.basename(e.path)
+                  for e in catalog.pending('concat')) == [
+        first.basename, second.basename]
+    # Other consumers have their own checkpoint
+    assert len(catalog.pending('score/UCSD', site='UCSD')) == 2
+    assert catalog.pending('score/CHLA', site='CHLA') == []
+
+    catalog.acknowledge('concat', catalog.pending('concat'))
+    second.remove()
+    assert catalog.scan() == 1
+    assert [e.removed for e in catalog.pending('concat')] == [1]
+
+
+def test_checkpoints_are_kept_per_site(tmpdir):
+    root = tmpdir.join('data')
+    for site in ['UCSD', 'CHLA']:
+        root.join(site, 'NDAR_INVA', 'heartrate_1min').ensure(dir=True) \
+            .join('NDAR_INVA_heartrate_1min_20181101_20181114.csv') \
+            .write('Time,Value\n')
+    catalog = Catalog(str(root.join('.catalog.sqlite')), str(root))
+    assert catalog.scan() == 2
+
+    # One consumer name reading the sites separately
+    ucsd = catalog.pending('score', site='UCSD')
+    catalog.acknowledge('score', ucsd, site='UCSD')
+    assert catalog.pending('score', site='UCSD') == []
+    assert [e.site for e in catalog.pending('score', site='CHLA')] == ['CHLA']
+    assert len(catalog.pending('score')) == 2
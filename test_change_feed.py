@@ -0,0 +1,75 @@
+"""
+Tests for the feed of changed subjects published by ingest.
+"""
+import datetime
+import threading
+
+from change_feed import ChangeFeed
+
+
+def test_consumers_have_their_own_cursor(tmpdir):
+    feed = ChangeFeed(str(tmpdir.join('feed.sqlite')))
+    day = datetime.datetime(2018, 11, 14)
+    feed.publish('UCSD', 'batch-1', [('NDAR_INVA', 'heartrate_1min', day, day),
+                                     ('NDAR_INVB', 'battery', None, None)])
+    feed.publish('CHLA', 'batch-2', [('NDAR_INVC', 'sleepDay', day, day)])
+    feed.publish('CHLA', 'batch-3', [])
+
+    changes = feed.pending('concat')
+    assert [(c.site, c.subject, c.batch_id) for c in changes] == [
+        ('UCSD', 'NDAR_INVA', 'batch-1'), ('UCSD', 'NDAR_INVB', 'batch-1'),
+        ('CHLA', 'NDAR_INVC', 'batch-2')]
+    assert changes[0].min_time == '2018-11-14T00:00:00'
+    assert changes[1].max_time is None
+
+    ucsd = feed.pending('score/UCSD', site='UCSD')
+    assert [c.subject for c in ucsd] == ['NDAR_INVA', 'NDAR_INVB']
+    feed.acknowledge('score/UCSD', ucsd, site='UCSD')
+    assert feed.pending('score/UCSD', site='UCSD') == []
+    assert len(feed.pending('concat')) == 3
+
+    feed.acknowledge('concat', changes[:1])
+    feed.publish('UCSD', 'batch-4', [('NDAR_INVA', 'battery', day, day)])
+    assert [c.batch_id for c in feed.pending('concat')] == [
+        'batch-1', 'batch-2', 'batch-4']
+    assert [c.batch_id for c in feed.pending('score/UCSD', site='UCSD')] == [
+        'batch-4']
+
+
+def test_cursors_are_kept_per_site(tmpdir):
+    feed = ChangeFeed(str(tmpdir.join('feed.sqlite')))
+    feed.publish('UCSD', 'batch-1', [('NDAR_INVA', 'battery', None, None)])
+    feed.publish('CHLA', 'batch-2', [('NDAR_INVB', 'battery', None, None)])
+    feed.publish('UCSD', 'batch-3', [('NDAR_INVA', 'battery', None, None)])
+
+    # One consumer name reading the sites separately
+    ucsd = feed.pending('score', site='UCSD')
+    feed.acknowledge('score', ucsd, site='UCSD')
+    assert feed.pending('score', site='UCSD') == []
+    assert [c.batch_id for c in feed.pending('score', site='CHLA')] == [
+        'batch-2']
+    assert len(feed.pending('score')) == 3
+
+
+def test_concurrent_first_use(tmpdir):
+    # Both site threads sharing a feed and separate processes (here, feeds
+    # of their own) may be the first to use the database
+    path = str(tmpdir.join('feed.sqlite'))
+    shared = ChangeFeed(path)
+    errors = []
+
+    def publish(feed, site):
+        try:
+            feed.publish(site, 'batch', [('NDAR_INVA', 'battery', None, None)])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=publish, args=(feed, 'S%d' % i))
+               for i, feed in enumerate([shared] * 4 +
+                                        [ChangeFeed(path) for _ in range(4)])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(shared.pending('concat')) == 8
@@ -0,0 +1,52 @@
+"""
+Tests for the columnar copies of batch export members.
+"""
+import zipfile
+
+import pandas as pd
+import pytest
+
+import columnar
+from ingest_latest_export import extract_members_parallel
+
+pytest.importorskip('pyarrow')
+
+HEARTRATE = ('Time,Value\n'
+             '11/1/2018 12:00:00 AM,61\n'
+             '11/1/2018 12:01:00 PM,75\n')
+DAILY = 'ActivityDay,StepTotal\n11/1/2018,9031\n11/2/2018,12\n'
+
+
+@pytest.mark.parametrize('columnar_format', sorted(columnar.FORMATS))
+def test_members_round_trip_typed(tmpdir, columnar_format):
+    zip_path = str(tmpdir.join('batch.zip'))
+    members = {'NDAR_INVA_heartrate_1min_20181101_20181114.csv': HEARTRATE,
+               'NDAR_INVA_dailySteps_20181101_20181114.csv': DAILY}
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, content in members.items():
+            zf.writestr(name, content)
+
+    root = str(tmpdir.join('columnar'))
+    jobs = []
+    for name in sorted(members):
+        measure = name.split('_', 2)[2].rsplit('_', 2)[0]
+        dest = columnar.columnar_path(root, 'UCSD', measure, 'NDAR_INVA',
+                                      name, columnar_format)
+        tmpdir.join('columnar').ensure(dest[len(root) + 1:]).remove()
+        jobs.append((name, dest))
+    assert extract_members_parallel(zip_path, jobs,
+                                    extract=columnar.convert_members) > 0
+
+    hr = columnar.read_measure(root, 'heartrate_1min')
+    assert list(hr['Time']) == [pd.Timestamp('2018-11-01 00:00:00'),
+                                pd.Timestamp('2018-11-01 12:01:00')]
+    assert list(hr['Value']) == [61, 75]
+    assert hr['Value'].dtype == 'uint8'
+    assert set(hr['site']) == set(['UCSD'])
+    assert set(hr['subject']) == set(['NDAR_INVA'])
+
+    steps = columnar.read_measure(root, 'dailySteps', site='UCSD',
+                                  subject='NDAR_INVA')
+    assert list(steps['ActivityDay']) == [pd.Timestamp('2018-11-01'),
+                                          pd.Timestamp('2018-11-02')]
+    assert columnar.read_measure(root, 'dailySteps', site='CHLA') is None
@@ -0,0 +1,39 @@
+"""
+Tests for reading and writing extracted CSVs compressed.
+"""
+import io
+
+import pytest
+
+from compressed_csv import (is_csv, read_csv, strip_csv_suffix,
+                            write_compressed)
+
+CSV = b'Time,Value\n11/1/2018 12:00:00 AM,61\n11/1/2018 12:01:00 AM,62\n'
+
+
+def test_names():
+    name = 'NDAR_INVA_heartrate_1min_20181101_20181114'
+    for suffix in ['.csv', '.csv.gz', '.csv.zst']:
+        assert is_csv(name + suffix)
+        assert strip_csv_suffix(name + suffix) == name
+    assert not is_csv('README.txt')
+    assert strip_csv_suffix('README.txt') == 'README.txt'
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd'])
+def test_compressed_csv_reads_like_plain(tmpdir, compression):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    suffix = {'gzip': '.gz', 'zstd': '.zst'}[compression]
+    plain = tmpdir.join('a.csv')
+    plain.write_binary(CSV)
+
+    outputs = []
+    for i in range(2):
+        path = tmpdir.join('a%d.csv%s' % (i, suffix))
+        with open(str(path), 'wb') as dst:
+            write_compressed(io.BytesIO(CSV), dst, compression)
+        outputs.append(path.read_binary())
+    # Same content, same bytes
+    assert outputs[0] == outputs[1]
+    assert read_csv(str(path)).equals(read_csv(str(plain)))
@@ -0,0 +1,198 @@
+"""
+Tests for merging a measure's exported files in concat.py.
+"""
+import datetime
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from concat import main, process_concat, read_merged
+from measures import parse_times
+
+
+def combine_first_merge(paths, index_key):
+    """The merge concat.py used to do: fold the files with combine_first."""
+    merged_df = pd.read_csv(paths[0])
+    for path in paths:
+        file_df = pd.read_csv(path)
+        merged_df = file_df.set_index(index_key, drop=False).combine_first(
+            merged_df.set_index(index_key, drop=False))
+    return merged_df
+
+
+def assert_same_merge(merged_path, expected):
+    """Same rows, in the same order, with the same values. (combine_first
+    may turn integer columns into floats, depending on the pandas version
+    and on which keys each file has; the single-pass merge keeps them. The
+    values must match exactly: a narrowed float would be written rounded.)"""
+    merged = pd.read_csv(merged_path)
+    expected = expected.reset_index(drop=True)
+    pd.testing.assert_frame_equal(merged, expected, check_dtype=False,
+                                  check_exact=True)
+
+
+def write_exports(folder, measure, make_rows, nights=range(4), days=3, seed=0):
+    """Overlapping exports, like nightly_past14d, with revised and missing
+    values in the later ones."""
+    random = np.random.RandomState(seed)
+    start = datetime.datetime(2018, 11, 1)
+    paths = []
+    for i in nights:
+        first = start + datetime.timedelta(days=i)
+        frame = make_rows(first, days, random)
+        revised = random.rand(len(frame)) < 0.05
+        frame.loc[revised, frame.columns[1]] = frame.loc[revised, frame.columns[1]] + 1
+        missing = random.rand(len(frame)) < 0.02
+        frame.loc[missing, frame.columns[-1]] = np.nan
+        last = first + datetime.timedelta(days=days - 1)
+        path = os.path.join(folder, 'NDAR_INVA_%s_%s_%s.csv' % (
+            measure, first.strftime('%Y%m%d'), last.strftime('%Y%m%d')))
+        frame.to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def heartrate_rows(first, days, random):
+    times = pd.date_range(first, periods=days * 24 * 60, freq='min')
+    return pd.DataFrame({
+        'Time': [t.strftime('%m/%d/%Y %I:%M:%S %p').lstrip('0').replace('/0', '/')
+                 for t in times],
+        'Value': random.randint(50, 120, len(times))})[['Time', 'Value']]
+
+
+def daily_activity_rows(first, days, random):
+    dates = pd.date_range(first, periods=days, freq='D')
+    return pd.DataFrame([
+        ['%d/%d/%d' % (d.month, d.day, d.year),
+         random.randint(0, 20000), random.rand() * 10,
+         random.randint(0, 1440)] for d in dates],
+        columns=['ActivityDate', 'TotalSteps', 'TotalDistance',
+                 'SedentaryMinutes'])
+
+
+def test_merge_matches_combine_first(tmpdir):
+    for measure, make_rows, index_key in [
+            ('heartrate_1min', heartrate_rows, 'Time'),
+            ('dailyActivity', daily_activity_rows, 'ActivityDate')]:
+        folder = tmpdir.join('UCSD', 'NDAR_INVA', measure).ensure(dir=True)
+        paths = write_exports(str(folder), measure, make_rows)
+        merged_path = tmpdir.join('UCSD', 'NDAR_INVA', 'merged',
+                                  measure + '.csv')
+
+        # First run: no merged file yet
+        assert process_concat([str(folder)], None) == []
+        assert_same_merge(str(merged_path),
+                          combine_first_merge(paths, index_key))
+
+        # Next run merges new files into the merged file
+        timestamp = time.time()
+        time.sleep(0.01)
+        new_paths = write_exports(str(folder), measure, make_rows,
+                                  nights=range(4, 6), seed=1)
+        expected = combine_first_merge([str(merged_path)] + new_paths,
+                                       index_key)
+        assert process_concat([str(folder)], timestamp) == []
+        assert_same_merge(str(merged_path), expected)
+
+
+def test_month_partitions_read_as_one_frame(tmpdir):
+    folder = tmpdir.join('UCSD', 'NDAR_INVA', 'heartrate_1min').ensure(dir=True)
+    partition_dir = tmpdir.join('UCSD', 'NDAR_INVA', 'merged', 'heartrate_1min')
+    # Ten three-day exports, one a day, from the end of October into November
+    paths = write_exports(str(folder), 'heartrate_1min', heartrate_rows,
+                          nights=range(-5, 5))
+    assert process_concat([str(folder)], None,
+                          partition_by_month=True) == []
+    assert sorted(partition_dir.listdir(lambda p: True), key=str) == [
+        partition_dir.join('2018-10.csv'), partition_dir.join('2018-11.csv')]
+
+    def by_time(frame):
+        # read_merged parses the times, combine_first_merge doesn't
+        frame = frame.reset_index(drop=True)
+        frame['Time'] = parse_times(frame['Time'])
+        return frame.sort_values('Time').reset_index(drop=True)
+    expected = combine_first_merge(paths, 'Time')
+    merged = read_merged(str(partition_dir))
+    pd.testing.assert_frame_equal(by_time(merged), by_time(expected),
+                                  check_dtype=False)
+
+    # New data for November leaves October's partition alone
+    timestamp = time.time()
+    time.sleep(0.01)
+    new_paths = write_exports(str(folder), 'heartrate_1min', heartrate_rows,
+                              nights=range(5, 7), seed=1)
+    os.utime(str(partition_dir.join('2018-10.csv')), (0, 1000000000))
+    assert process_concat([str(folder)], timestamp,
+                          partition_by_month=True) == []
+    assert partition_dir.join('2018-10.csv').mtime() == 1000000000
+    expected = combine_first_merge(paths + new_paths, 'Time')
+    pd.testing.assert_frame_equal(by_time(read_merged(str(partition_dir))),
+                                  by_time(expected), check_dtype=False)
+
+
+def test_rows_without_a_time_are_kept(tmpdir):
+    folder = tmpdir.join('UCSD', 'NDAR_INVA', 'heartrate_1min').ensure(dir=True)
+    partition_dir = tmpdir.join('UCSD', 'NDAR_INVA', 'merged', 'heartrate_1min')
+    for name in ['NDAR_INVA_heartrate_1min_20181101_20181114.csv',
+                 'NDAR_INVA_heartrate_1min_20181102_20181115.csv']:
+        folder.join(name).write('Time,Value\n11/1/2018 12:00:00 AM,60\n'
+                                'not a time,61\n,62\n')
+    assert process_concat([str(folder)], None,
+                          partition_by_month=True) == []
+    assert sorted(p.basename for p in partition_dir.listdir()) == [
+        '2018-11.csv', 'unknown.csv']
+    assert sorted(pd.read_csv(str(partition_dir.join('unknown.csv')))[
+        'Value']) == [61, 62]
+
+
+def test_failed_folder_does_not_stop_the_others(tmpdir):
+    good = tmpdir.join('UCSD', 'NDAR_INVA', 'heartrate_1min').ensure(dir=True)
+    write_exports(str(good), 'heartrate_1min', heartrate_rows)
+    # No column to merge on is known for this measure
+    bad = tmpdir.join('UCSD', 'NDAR_INVA', 'unknownMeasure').ensure(dir=True)
+    bad.join('NDAR_INVA_unknownMeasure_20181101_20181114.csv').write('a,b\n1,2\n')
+
+    assert process_concat([str(bad), str(good)], None, jobs=2) == [str(bad)]
+    assert tmpdir.join('UCSD', 'NDAR_INVA', 'merged',
+                       'heartrate_1min.csv').check()
+
+
+def test_folders_that_are_not_measures_are_skipped(tmpdir, monkeypatch):
+    good = tmpdir.join('UCSD', 'NDAR_INVA', 'heartrate_1min').ensure(dir=True)
+    write_exports(str(good), 'heartrate_1min', heartrate_rows, nights=[0])
+    # As extracted with ingest_latest_export.py --no-subject-subdirs
+    tmpdir.join('UCSD', '20181115').ensure(dir=True).join(
+        'NDAR_INVA_heartrate_1min_20181101_20181114.csv').write(
+        'Time,Value\n11/1/2018 12:00:00 AM,60\n')
+    timestamp_file = tmpdir.join('last_process.txt')
+    monkeypatch.setattr(sys, 'argv', ['concat.py', str(tmpdir),
+                                      str(timestamp_file)])
+
+    main()
+    assert timestamp_file.check()
+    assert tmpdir.join('UCSD', 'NDAR_INVA', 'merged',
+                       'heartrate_1min.csv').check()
+    assert not tmpdir.join('UCSD', 'merged').check()
+
+
+def test_decimals_are_written_back_unchanged(tmpdir):
+    folder = tmpdir.join('UCSD', 'NDAR_INVA', 'minuteCaloriesNarrow').ensure(dir=True)
+    folder.join('NDAR_INVA_minuteCaloriesNarrow_20181101_20181101.csv').write(
+        'ActivityMinute,Calories\n'
+        '11/1/2018 12:00:00 AM,1.23456789\n'
+        '11/1/2018 12:01:00 AM,0.9876543219\n')
+    folder.join('NDAR_INVA_minuteCaloriesNarrow_20181101_20181102.csv').write(
+        'ActivityMinute,Calories\n'
+        '11/1/2018 12:01:00 AM,1.1\n'
+        '11/1/2018 12:02:00 AM,12.3456789012\n')
+
+    assert process_concat([str(folder)], None) == []
+    assert tmpdir.join('UCSD', 'NDAR_INVA', 'merged',
+                       'minuteCaloriesNarrow.csv').read() == (
+        'ActivityMinute,Calories\n'
+        '11/1/2018 12:00:00 AM,1.23456789\n'
+        '11/1/2018 12:01:00 AM,1.1\n'
+        '11/1/2018 12:02:00 AM,12.3456789012\n')
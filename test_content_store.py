@@ -0,0 +1,33 @@
+"""
+Tests for the content-addressed store of extracted members.
+"""
+import io
+import os
+
+from content_store import ContentStore
+
+
+def test_identical_members_are_stored_once(tmpdir):
+    store = ContentStore(str(tmpdir.join('.objects')))
+    a = str(tmpdir.join('a.csv'))
+    b = str(tmpdir.join('b.csv'))
+    c = str(tmpdir.join('c.csv'))
+
+    digest_a, new_a = store.put(io.BytesIO(b'Time,Value\n1,2\n'), a)
+    digest_b, new_b = store.put(io.BytesIO(b'Time,Value\n1,2\n'), b)
+    digest_c, new_c = store.put(io.BytesIO(b'Time,Value\n'), c)
+    assert (new_a, new_b, new_c) == (True, False, True)
+    assert digest_a == digest_b != digest_c
+    assert os.path.samefile(a, b)
+    assert open(b, 'rb').read() == b'Time,Value\n1,2\n'
+
+    stats = store.report()
+    assert stats['objects'] == 2
+    assert stats['references'] == 3
+    assert stats['stored_bytes'] == 15 + 11
+    assert stats['saved_bytes'] == 15
+
+    # Replacing a file drops its reference; unreferenced objects are pruned
+    store.put(io.BytesIO(b'Time,Value\n1,2\n'), c)
+    assert store.prune() == 1
+    assert store.report()['references'] == 3
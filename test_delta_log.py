@@ -0,0 +1,43 @@
+"""
+Tests for the row-level deltas of nightly exports.
+"""
+import datetime
+import io
+
+from delta_log import HighWaterMarks, append_new_rows
+
+
+def export(*minutes):
+    return io.StringIO(u'Time,Value\n' + u''.join(
+        u'11/14/2018 11:%02d:00 PM,%d\n' % (minute, minute)
+        for minute in minutes))
+
+
+def test_only_rows_after_the_mark_are_appended(tmpdir):
+    marks_path = str(tmpdir.join('.high_water_marks.json'))
+    log_path = str(tmpdir.join('heartrate_1min.csv'))
+    lookback = datetime.timedelta(minutes=2)
+
+    marks = HighWaterMarks(marks_path)
+    assert marks.since('NDAR_INVA', 'heartrate_1min', lookback) is None
+    rows, first, last = append_new_rows(export(0, 1, 2, 3, 4),
+                                        'heartrate_1min', log_path)
+    assert (rows, first, last) == (5, datetime.datetime(2018, 11, 14, 23, 0),
+                                   datetime.datetime(2018, 11, 14, 23, 4))
+    marks.update('NDAR_INVA', 'heartrate_1min', last)
+    marks.save()
+
+    # The next night's export overlaps; only the look-back and new rows go in
+    marks = HighWaterMarks(marks_path)
+    since = marks.since('NDAR_INVA', 'heartrate_1min', lookback)
+    assert since == datetime.datetime(2018, 11, 14, 23, 2)
+    rows, first, last = append_new_rows(export(1, 2, 3, 4, 5, 6),
+                                        'heartrate_1min', log_path, since)
+    assert rows == 4
+    assert tmpdir.join('heartrate_1min.csv').read().splitlines() == [
+        'Time,Value',
+        '11/14/2018 11:00:00 PM,0', '11/14/2018 11:01:00 PM,1',
+        '11/14/2018 11:02:00 PM,2', '11/14/2018 11:03:00 PM,3',
+        '11/14/2018 11:04:00 PM,4',
+        '11/14/2018 11:03:00 PM,3', '11/14/2018 11:04:00 PM,4',
+        '11/14/2018 11:05:00 PM,5', '11/14/2018 11:06:00 PM,6']
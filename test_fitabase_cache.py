@@ -0,0 +1,81 @@
+"""
+Tests for the on-disk cache of slow-changing API responses.
+"""
+import json
+import os
+import time
+
+from fitabase import Project, ResponseCache
+from fitabase.transport import Response
+
+
+def age(cache, token, endpoint, seconds):
+    path = cache._path(token, endpoint)
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+def test_entries_expire(tmpdir):
+    cache = ResponseCache(str(tmpdir), ttl=60)
+    assert cache.get('token', 'Profiles/') is None
+    cache.set('token', 'Profiles/', [{'ProfileId': 'a'}])
+    assert cache.get('token', 'Profiles/') == [{'ProfileId': 'a'}]
+    age(cache, 'token', 'Profiles/', 61)
+    assert cache.get('token', 'Profiles/') is None
+
+
+def test_entries_are_per_token(tmpdir):
+    cache = ResponseCache(str(tmpdir))
+    cache.set('token-a', 'Profiles/', ['a'])
+    cache.set('token-b', 'Profiles/', ['b'])
+    assert cache.get('token-a', 'Profiles/') == ['a']
+    assert cache.get('token-b', 'Profiles/') == ['b']
+    assert cache.get('token-c', 'Profiles/') is None
+    # The tokens themselves are never written to disk
+    for name in os.listdir(str(tmpdir)):
+        content = tmpdir.join(name).read()
+        assert 'token-' not in name and 'token-' not in content
+
+
+def test_oldest_entries_are_evicted(tmpdir):
+    entry = ['x' * 1000]
+    size = len(json.dumps(entry))
+    cache = ResponseCache(str(tmpdir), max_bytes=3 * size)
+    for i in range(3):
+        cache.set('token', 'Endpoint/%d' % i, entry)
+        age(cache, 'token', 'Endpoint/%d' % i, 100 - i)
+    cache.set('token', 'Endpoint/3', entry)
+    assert cache.get('token', 'Endpoint/0') is None
+    assert all(cache.get('token', 'Endpoint/%d' % i) == entry
+               for i in range(1, 4))
+
+
+class ProfilesTransport(object):
+    """
+    Answers Profiles/ with a list that grows with every request.
+    """
+
+    def __init__(self):
+        self.requests = 0
+
+    def perform(self, request, write, on_head=None):
+        self.requests += 1
+        write(json.dumps([{'ProfileId': str(i), 'Name': 'n%d' % i}
+                          for i in range(self.requests)]).encode('utf-8'))
+        return Response(200, [], 0.0, 0, False)
+
+    def close(self):
+        pass
+
+
+def test_project_uses_the_cache_unless_refreshing(tmpdir):
+    transport = ProfilesTransport()
+    cache = ResponseCache(str(tmpdir))
+    with Project('token', cache=cache, transport=transport) as api:
+        assert len(api.get_device_ids()) == 1
+        assert len(api.get_device_ids()) == 1
+        assert transport.requests == 1
+        # refresh goes to the API, and updates the cache
+        assert len(api.get_device_ids(refresh=True)) == 2
+        assert len(api.get_device_ids()) == 2
+        assert transport.requests == 2
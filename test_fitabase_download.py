@@ -0,0 +1,170 @@
+"""
+Tests for the resumable, ranged batch download, against a local HTTP server
+that (optionally) honours Range requests.
+"""
+import io
+import os
+import pytest
+import re
+import threading
+import zipfile
+from zipfile import BadZipfile
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from fitabase import Project, RetryPolicy
+
+CHUNK_SIZE = 64 * 1024
+
+ERROR_BODY = b'Service Unavailable'
+
+
+def make_archive(n_members=20):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for i in range(n_members):
+            zf.writestr('NDAR_INV%08d_heartrate_20181101_20181114.csv' % i,
+                        os.urandom(20000))
+    return buf.getvalue()
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = server.body
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        with server.lock:
+            server.requests.append(self.headers.get('Range'))
+            fail = match and int(match.group(1)) in server.fail_offsets
+            if fail:
+                server.fail_offsets.remove(int(match.group(1)))
+        if fail:
+            self.send_response(503)
+            self.send_header('Content-Length', str(len(ERROR_BODY)))
+            self.end_headers()
+            self.wfile.write(ERROR_BODY)
+        elif match and server.ranges:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), len(body) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, len(body)))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            self.wfile.write(body[start:end + 1])
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RangeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    httpd = RangeServer(('127.0.0.1', 0), RangeHandler)
+    httpd.body = make_archive()
+    httpd.ranges = True
+    httpd.fail_offsets = set()
+    httpd.requests = []
+    httpd.lock = threading.Lock()
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def api(server):
+    with Project('test-token',
+                 url='http://127.0.0.1:%d/v1/' % server.server_port) as api:
+        yield api
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_parallel_ranged_download(api, server, tmpdir):
+    path = str(tmpdir.join('batch.zip'))
+    assert api.download_batch('abc', path, chunk_size=CHUNK_SIZE) == path
+    assert read(path) == server.body
+    assert len(server.requests) == -(-len(server.body) // CHUNK_SIZE)
+    assert not os.path.exists(path + '.part')
+    assert not os.path.exists(path + '.progress')
+
+
+def test_download_without_range_support(api, server, tmpdir):
+    server.ranges = False
+    path = str(tmpdir.join('batch.zip'))
+    api.download_batch('abc', path, chunk_size=CHUNK_SIZE)
+    assert read(path) == server.body
+    assert len(server.requests) == 1
+
+
+def test_failed_chunk_is_retried(api, server, tmpdir):
+    path = str(tmpdir.join('batch.zip'))
+    server.fail_offsets.update([0, 2 * CHUNK_SIZE])
+    api.download_batch('abc', path, chunk_size=CHUNK_SIZE)
+    assert read(path) == server.body
+    assert len(server.requests) == -(-len(server.body) // CHUNK_SIZE) + 2
+    endpoint = api.metrics.summary()['endpoints']['BatchExport/Download/abc']
+    assert endpoint['retries'] == 2
+
+
+def test_error_body_is_not_written(server, tmpdir):
+    path = str(tmpdir.join('batch.zip'))
+    server.fail_offsets.add(0)
+    with Project('test-token', retry=RetryPolicy(max_retries=0),
+                 url='http://127.0.0.1:%d/v1/' % server.server_port) as api:
+        with pytest.raises(IOError):
+            api.download_batch('abc', path, chunk_size=CHUNK_SIZE)
+    assert ERROR_BODY not in read(path + '.part')
+
+
+def test_interrupted_download_resumes(server, tmpdir):
+    path = str(tmpdir.join('batch.zip'))
+    server.fail_offsets.add(2 * CHUNK_SIZE)
+    with Project('test-token', retry=RetryPolicy(max_retries=0),
+                 url='http://127.0.0.1:%d/v1/' % server.server_port) as api:
+        with pytest.raises(IOError):
+            api.download_batch('abc', path, chunk_size=CHUNK_SIZE)
+        assert os.path.exists(path + '.part')
+        assert not os.path.exists(path)
+        assert ERROR_BODY not in read(path + '.part')
+
+        assert len(server.body) > 3 * CHUNK_SIZE
+        del server.requests[:]
+        api.download_batch('abc', path, chunk_size=CHUNK_SIZE)
+    assert read(path) == server.body
+    # Only the failed chunk had to be fetched again
+    assert server.requests == ['bytes=%d-%d' % (2 * CHUNK_SIZE,
+                                                3 * CHUNK_SIZE - 1)]
+
+
+def test_corrupt_archive_is_rejected(api, server, tmpdir):
+    body = bytearray(server.body)
+    # Flip bytes in the middle of the first member's compressed data
+    body[100:110] = b'\0' * 10
+    server.body = bytes(body)
+    path = str(tmpdir.join('batch.zip'))
+    with pytest.raises(BadZipfile):
+        api.download_batch('abc', path, chunk_size=CHUNK_SIZE)
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.part')
@@ -0,0 +1,97 @@
+"""
+Tests for the per-endpoint request metrics and their JSON and Prometheus
+output.
+"""
+import json
+import os
+import threading
+
+from fitabase.metrics import RequestMetrics, endpoint_template
+
+PROFILE_ID = '5822ade8-0bb2-4d4e-9f5b-2b4e8e3f4c11'
+
+
+def test_endpoint_template():
+    assert (endpoint_template('Sync/Latest/%s' % PROFILE_ID)
+            == 'Sync/Latest/{id}')
+    assert (endpoint_template('Activity/%s/2018-11-01/2018-11-14' % PROFILE_ID)
+            == 'Activity/{id}/{date}/{date}')
+    assert endpoint_template('Profiles/') == 'Profiles/'
+
+
+def test_summary():
+    metrics = RequestMetrics(buckets=(0.1, 1))
+    metrics.record('Sync/Latest/%s' % PROFILE_ID, 200, 0.05, 100)
+    metrics.record('Sync/Latest/%s' % PROFILE_ID, 200, 0.5, 50, retries=2)
+    metrics.record('Sync/Latest/%s' % PROFILE_ID, None, 5)
+    metrics.record_wait('backoff', 1.5)
+    metrics.record_wait('backoff', 0)
+    summary = metrics.summary()
+    endpoint = summary['endpoints']['Sync/Latest/{id}']
+    assert endpoint['requests'] == {'200': 2, 'error': 1}
+    assert endpoint['latency_seconds'] == {
+        'count': 3, 'sum': 5.55, 'buckets': {'0.1': 1, '1': 2}}
+    assert endpoint['bytes_received'] == 150
+    assert endpoint['retries'] == 2
+    assert summary['wait_seconds'] == {'backoff': 1.5}
+
+
+def test_concurrent_records_are_all_counted():
+    metrics = RequestMetrics()
+
+    def record():
+        for _ in range(1000):
+            metrics.record('Profiles/', 200, 0.01, 1)
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    endpoint = metrics.summary()['endpoints']['Profiles/']
+    assert endpoint['requests'] == {'200': 4000}
+    assert endpoint['bytes_received'] == 4000
+
+
+def test_prometheus_output(tmpdir):
+    metrics = RequestMetrics(buckets=(0.1, 1))
+    metrics.record('Profiles/', 200, 0.05, 10)
+    metrics.record('Profiles/', 503, 2, retries=1)
+    metrics.record_wait('rate_limit', 0.25)
+    lines = metrics.to_prometheus().splitlines()
+    for line in [
+            '# TYPE fitabase_requests_total counter',
+            'fitabase_requests_total{endpoint="Profiles/",status="200"} 1',
+            'fitabase_requests_total{endpoint="Profiles/",status="503"} 1',
+            '# TYPE fitabase_request_duration_seconds histogram',
+            'fitabase_request_duration_seconds_bucket'
+            '{endpoint="Profiles/",le="0.1"} 1',
+            'fitabase_request_duration_seconds_bucket'
+            '{endpoint="Profiles/",le="1"} 1',
+            'fitabase_request_duration_seconds_bucket'
+            '{endpoint="Profiles/",le="+Inf"} 2',
+            'fitabase_request_duration_seconds_sum{endpoint="Profiles/"} '
+            '2.050000',
+            'fitabase_request_duration_seconds_count{endpoint="Profiles/"} 2',
+            'fitabase_response_bytes_total{endpoint="Profiles/"} 10',
+            'fitabase_request_retries_total{endpoint="Profiles/"} 1',
+            'fitabase_wait_seconds_total{reason="rate_limit"} 0.250000']:
+        assert line in lines
+    # Every sample belongs to a declared metric
+    declared = set(line.split()[2] for line in lines
+                   if line.startswith('# TYPE'))
+    for line in lines:
+        if not line.startswith('#'):
+            name = line.split('{')[0]
+            assert any(name == metric or name.startswith(metric + '_')
+                       for metric in declared)
+
+    prom_path = str(tmpdir.join('fitabase.prom'))
+    metrics.dump(prom_path)
+    assert tmpdir.join('fitabase.prom').read() == metrics.to_prometheus()
+    json_path = str(tmpdir.join('fitabase.json'))
+    metrics.dump(json_path)
+    with open(json_path) as f:
+        assert json.load(f) == json.loads(json.dumps(metrics.summary()))
+    assert sorted(os.listdir(str(tmpdir))) == ['fitabase.json',
+                                               'fitabase.prom']
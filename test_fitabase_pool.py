@@ -0,0 +1,100 @@
+"""
+Tests for the pool of reusable curl handles, against a local HTTP server that
+records which client connection each request came in on.
+"""
+import io
+import threading
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import pycurl
+import pytest
+
+from fitabase.pool import CurlHandlePool
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.clients.append(self.client_address)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    httpd = KeepAliveServer(('127.0.0.1', 0), KeepAliveHandler)
+    httpd.clients = []
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def get(pool, url, broken=False):
+    ch = pool.acquire()
+    body = io.BytesIO()
+    ch.setopt(pycurl.URL, url)
+    ch.setopt(pycurl.WRITEFUNCTION, body.write)
+    ch.perform()
+    pool.release(ch, broken=broken)
+    return body.getvalue()
+
+
+def test_connection_is_reused(server):
+    url = 'http://127.0.0.1:%d/' % server.server_port
+    pool = CurlHandlePool()
+    try:
+        assert [get(pool, url) for _ in range(3)] == [b'ok'] * 3
+        # One keep-alive connection for all three requests
+        assert len(set(server.clients)) == 1
+        # A broken handle takes its connection with it
+        get(pool, url, broken=True)
+        get(pool, url)
+        assert len(set(server.clients)) == 2
+    finally:
+        pool.close()
+
+
+def test_idle_handles_are_reused_and_capped():
+    pool = CurlHandlePool(max_idle=2)
+    handles = [pool.acquire() for _ in range(3)]
+    for ch in handles:
+        pool.release(ch)
+    # Last in, first out; the third one over max_idle was closed
+    assert pool.acquire() is handles[1]
+    assert pool.acquire() is handles[0]
+    assert pool.acquire() not in handles
+    pool.close()
+
+
+def test_close():
+    pool = CurlHandlePool()
+    idle = pool.acquire()
+    checked_out = pool.acquire()
+    pool.release(idle)
+    pool.close()
+    pool.close()  # Closing twice is harmless
+    with pytest.raises(ValueError):
+        pool.acquire()
+    # Handles still out when the pool closed are closed on release
+    pool.release(checked_out)
+    with pytest.raises(pycurl.error):
+        checked_out.perform()
+    assert pool._idle.qsize() == 0
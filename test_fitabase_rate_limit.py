@@ -0,0 +1,83 @@
+"""
+Tests for the shared rate limiter, and for concurrent polling of tracker sync
+data keeping its results in input order.
+"""
+import json
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from fitabase import Project
+from fitabase.throttle import RateLimiter
+from fitabase.transport import Response
+
+
+def test_burst_then_rate():
+    limiter = RateLimiter(rate=20, burst=3)
+    start = time.time()
+    waits = [limiter.acquire() for _ in range(7)]
+    elapsed = time.time() - start
+    # The burst goes out at once; the other four wait 1/20 s each in turn
+    assert waits[:3] == [0, 0, 0]
+    assert all(wait > 0 for wait in waits[3:])
+    assert elapsed >= 4 / 20.0 - 0.01
+
+
+def test_rate_is_shared_by_threads():
+    limiter = RateLimiter(rate=50)
+
+    def take():
+        for _ in range(5):
+            limiter.acquire()
+
+    threads = [threading.Thread(target=take) for _ in range(4)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 20 tokens, the first one free
+    assert time.time() - start >= 19 / 50.0 - 0.01
+
+
+def test_from_interval():
+    assert RateLimiter.from_interval(0) is None
+    assert RateLimiter.from_interval(None) is None
+    assert RateLimiter.from_interval(0.5).rate == 2
+    with pytest.raises(ValueError):
+        RateLimiter(0)
+
+
+class SlowSyncTransport(object):
+    """
+    Answers Sync/Latest/<n> after a delay that shrinks with n, so that
+    concurrent requests complete in the reverse of the order they were made.
+    """
+
+    def __init__(self, n):
+        self.n = n
+
+    def perform(self, request, write, on_head=None):
+        number = int(request.url.rsplit('/', 1)[1])
+        time.sleep(0.01 * (self.n - number))
+        write(json.dumps({
+            'SyncDateTracker': '2018-11-%02dT10:00:00' % (number + 1),
+            'LatestBatteryLevelTracker': 'High'}).encode('utf-8'))
+        return Response(200, [], 0.0, 0, False)
+
+    def close(self):
+        pass
+
+
+def test_concurrent_results_keep_input_order():
+    n = 8
+    devices = pd.DataFrame({'ProfileId': [str(i) for i in range(n)]},
+                           index=['device%d' % i for i in range(n)])
+    with Project('token', transport=SlowSyncTransport(n)) as api:
+        sync = api.get_all_tracker_sync_data(devices, sleep_interval=0,
+                                             max_workers=n)
+    assert sync.index.equals(devices.index)
+    assert [date.day for date in sync['SyncDateTracker']] == list(
+        range(1, n + 1))
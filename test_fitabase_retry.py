@@ -0,0 +1,39 @@
+"""
+Tests for retry delays and for the concurrency limit of a Project.
+"""
+import pytest
+
+from fitabase import Project, RetryPolicy
+from fitabase.retry import parse_retry_after
+
+
+def test_retry_after_is_capped():
+    retry = RetryPolicy(backoff=1, max_backoff=30)
+    assert retry.delay(0, retry_after=5) == 5
+    assert retry.delay(0, retry_after=3600) == 30
+    assert all(0 <= retry.delay(attempt) <= min(30, 2 ** attempt)
+               for attempt in range(10))
+    assert parse_retry_after(['Content-Type: text/plain',
+                              'Retry-After: 120']) == 120
+
+
+class FailingTransport(object):
+    """
+    Raises something other than a TransportError, as a failing on_head
+    callback would.
+    """
+
+    def perform(self, request, write, on_head=None):
+        raise RuntimeError('callback failed')
+
+    def close(self):
+        pass
+
+
+def test_concurrency_slot_is_released_on_any_error():
+    with Project('token', max_concurrency=1,
+                 transport=FailingTransport()) as api:
+        for _ in range(3):
+            with pytest.raises(RuntimeError):
+                api.get_device_ids()
+        assert api.concurrency._active == 0
@@ -0,0 +1,123 @@
+"""
+Tests of fitabase.Project against the local stand-in API, so that the client
+code paths can be checked without a Fitabase token.
+"""
+import os
+import pytest
+import zipfile
+
+from fitabase import Project, RetryPolicy
+from fitabase.standin import StandInServer, make_certificate
+from fitabase.transport import (CurlTransport, RecordingTransport,
+                                ReplayTransport, RequestsTransport)
+
+
+@pytest.fixture
+def server():
+    with StandInServer(n_profiles=30, archive_members=5) as httpd:
+        yield httpd
+
+
+def test_get_device_ids(server):
+    with Project(server.token, url=server.url) as api:
+        devices = api.get_device_ids()
+    assert devices.shape[0] == 30
+    assert set(['ProfileId', 'Name', 'CreatedDate']) <= set(devices.columns)
+
+
+def test_get_all_tracker_sync_data(server):
+    with Project(server.token, url=server.url) as api:
+        devices = api.get_device_ids().set_index('Name')
+        sync = api.get_all_tracker_sync_data(devices, device_name='Charge 2',
+                sleep_interval=0, max_workers=4)
+    assert sync.index.equals(devices.index)
+    assert sync['SyncDateTracker'].notnull().all()
+    assert str(sync['SyncDateTracker'].dtype) == 'datetime64[ns]'
+
+
+def test_download_batch(server, tmpdir):
+    path = str(tmpdir.join('batch.zip'))
+    with Project(server.token, url=server.url) as api:
+        batch_id = api.get_last_batch_export_id()
+        api.download_batch(batch_id, path, chunk_size=16 * 1024)
+    with zipfile.ZipFile(path) as zf:
+        assert len(zf.namelist()) == 5
+    assert os.path.getsize(path) == len(server.data.archive)
+
+
+def test_failed_export_leaves_no_file(server, tmpdir):
+    path = str(tmpdir.join('batch.zip'))
+    with Project(server.token, url=server.url) as api:
+        with pytest.raises(IOError):
+            api.export_batch('no-such-batch', out_file=path)
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize('transport', [CurlTransport, RequestsTransport])
+def test_https(tmpdir, transport):
+    try:
+        certfile, keyfile = make_certificate(str(tmpdir))
+    except OSError:
+        pytest.skip('needs the openssl command')
+    with StandInServer(n_profiles=3, certfile=certfile,
+                       keyfile=keyfile) as server:
+        assert server.url.startswith('https://localhost:')
+        with Project(server.token, url=server.url,
+                     transport=transport(ca_file=certfile)) as api:
+            assert api.get_device_ids().shape[0] == 3
+            assert server.requests == 1
+        # Without the certificate, the server is not trusted
+        with Project(server.token, url=server.url, transport=transport(),
+                     retry=RetryPolicy(max_retries=0)) as api:
+            with pytest.raises(IOError):
+                api.get_device_ids()
+
+
+def test_throttled_requests_are_retried():
+    retry = RetryPolicy(max_retries=10, backoff=0.05, max_backoff=0.2)
+    with StandInServer(n_profiles=5, throttle_rate=5, throttle_burst=2) as server:
+        with Project(server.token, url=server.url, retry=retry) as api:
+            for profile in server.data.profiles:
+                api.get_tracker_sync_data(profile['ProfileId'])
+            summary = api.metrics.summary()
+        served = server.requests
+    endpoint = summary['endpoints']['Sync/Latest/{id}']
+    assert endpoint['requests'] == {'200': 5}
+    assert endpoint['retries'] == served - 5 > 0
+
+
+def test_requests_transport(server, tmpdir):
+    path = str(tmpdir.join('batch.zip'))
+    with Project(server.token, url=server.url,
+                 transport=RequestsTransport()) as api:
+        devices = api.get_device_ids().set_index('Name')
+        sync = api.get_all_tracker_sync_data(devices, sleep_interval=0,
+                max_workers=4)
+        api.download_batch(api.get_last_batch_export_id(), path,
+                chunk_size=16 * 1024)
+    assert sync['SyncDateTracker'].notnull().all()
+    assert os.path.getsize(path) == len(server.data.archive)
+
+
+def test_record_and_replay(server, tmpdir):
+    cassette = str(tmpdir.join('cassette.json'))
+    recorder = RecordingTransport(RequestsTransport(), cassette)
+    with Project(server.token, url=server.url, transport=recorder) as api:
+        devices = api.get_device_ids().set_index('Name')
+        recorded = api.get_all_tracker_sync_data(devices, sleep_interval=0)
+        api.download_batch(api.get_last_batch_export_id(),
+                str(tmpdir.join('recorded.zip')), chunk_size=16 * 1024)
+    with open(cassette) as f:
+        assert server.token not in f.read()
+
+    with Project('another-token', url='http://unreachable.invalid/v1/',
+                 transport=ReplayTransport(cassette)) as api:
+        devices = api.get_device_ids().set_index('Name')
+        replayed = api.get_all_tracker_sync_data(devices, sleep_interval=0)
+        api.download_batch(api.get_last_batch_export_id(),
+                str(tmpdir.join('replayed.zip')), chunk_size=16 * 1024)
+        with pytest.raises(IOError):
+            api.get_tracker_sync_data('not-recorded')
+    assert replayed.equals(recorded)
+    assert (tmpdir.join('replayed.zip').read_binary()
+            == tmpdir.join('recorded.zip').read_binary())
@@ -0,0 +1,78 @@
+"""
+Tests for the archive-handling helpers of ingest_latest_export.py.
+"""
+import datetime
+import os
+import subprocess
+import sys
+import zipfile
+
+from ingest_latest_export import (extract_members,
+                                  group_files_into_matched_directories)
+
+
+def test_grouping_does_not_depend_on_order():
+    files = ['NDAR_INVA_heartrate_1min_20181101_20181114.csv',
+             'NDAR_INVB_heartrate_1min_20181101_20181114.csv',
+             'README.txt',
+             'NDAR_INVA_heartrate_1min_20181115_20181128.csv',
+             'NDAR_INVA_minuteStepsNarrow_20181101_20181114.csv']
+    groups = group_files_into_matched_directories(files)
+    assert list(groups.items()) == [
+        (('NDAR_INVA', 'heartrate_1min'),
+         ['NDAR_INVA_heartrate_1min_20181101_20181114.csv',
+          'NDAR_INVA_heartrate_1min_20181115_20181128.csv']),
+        (('NDAR_INVB', 'heartrate_1min'),
+         ['NDAR_INVB_heartrate_1min_20181101_20181114.csv']),
+        (None, ['README.txt']),
+        (('NDAR_INVA', 'minuteStepsNarrow'),
+         ['NDAR_INVA_minuteStepsNarrow_20181101_20181114.csv'])]
+
+
+def test_extracting_without_store_leaves_stored_objects_alone(tmpdir):
+    name = 'NDAR_INVA_heartrate_1min_20181101_20181114.csv'
+    store_dir = str(tmpdir.join('.objects'))
+    for content, store in [('Time,Value\n1,2\n', store_dir),
+                           ('Time,Value\n1,3\n', None)]:
+        zip_path = str(tmpdir.join('batch.zip'))
+        with zipfile.ZipFile(zip_path, 'w') as zf:
+            zf.writestr(name, content)
+        extract_members(zip_path, [(name, str(tmpdir))], store_dir=store)
+
+    assert tmpdir.join(name).read() == 'Time,Value\n1,3\n'
+    # The object linked in by the first run still has its own content
+    objects = [os.path.join(root, f)
+               for root, _, files in os.walk(store_dir) for f in files]
+    assert [open(path).read() for path in objects] == ['Time,Value\n1,2\n']
+
+
+# Run in a fresh interpreter: only the first strptime imports _strptime, 
+# which is what two site threads can race on
+TWO_SITES = r'''
+import os, sys, zipfile
+from ingest_latest_export import append_deltas, member_time_range
+from site_runner import run_sites
+
+root = sys.argv[1]
+name = 'NDAR_INVA_heartrate_1min_20181114_20181114.csv'
+
+def process_site(site):
+    zip_path = os.path.join(root, site + '.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        zf.writestr(name, 'Time,Value\n11/14/2018 11:00:00 PM,1\n')
+    return (member_time_range(name),
+            append_deltas(zip_path, {('NDAR_INVA', 'heartrate_1min'): [name]},
+                          os.path.join(root, site), lookback=None)[0])
+
+results = run_sites(['A', 'B'], process_site, workers=2)
+print(sorted(results.items()))
+'''
+
+
+def test_two_sites_are_ingested_at_once(tmpdir):
+    output = subprocess.check_output(
+            [sys.executable, '-c', TWO_SITES, str(tmpdir)],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+    day = (datetime.datetime(2018, 11, 14),
+           datetime.datetime(2018, 11, 14, 23, 59, 59))
+    assert output.decode().strip() == repr([('A', (day, 1)), ('B', (day, 1))])
@@ -0,0 +1,60 @@
+"""
+Tests for the per-site record of ingested batches and extracted files.
+"""
+import os
+import zipfile
+
+from ingest_manifest import IngestManifest
+
+
+def write_archive(path, members):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, content in members.items():
+            zf.writestr(name, content)
+
+
+def extract_changed(zip_path, manifest, target_dir):
+    extracted = []
+    with zipfile.ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            dest = os.path.join(target_dir, info.filename)
+            if not manifest.unchanged(dest, info):
+                zf.extract(info, path=target_dir)
+                manifest.record_member(dest, info)
+                extracted.append(info.filename)
+    return sorted(extracted)
+
+
+def test_only_changed_members_are_extracted(tmpdir):
+    target_dir = str(tmpdir)
+    zip_path = str(tmpdir.join('batch.zip'))
+    manifest_path = str(tmpdir.join('.ingest_manifest_SITE.json'))
+
+    write_archive(zip_path, {'a.csv': 'Time,Value\n1,2\n', 'b.csv': 'x'})
+    manifest = IngestManifest(manifest_path)
+    assert extract_changed(zip_path, manifest, target_dir) == ['a.csv', 'b.csv']
+    manifest.record_batch('batch-1')
+    manifest.save()
+
+    write_archive(zip_path, {'a.csv': 'Time,Value\n1,2\n', 'b.csv': 'y',
+                             'c.csv': 'z'})
+    manifest = IngestManifest(manifest_path)
+    assert manifest.has_batch('batch-1')
+    assert not manifest.has_batch('batch-2')
+    assert extract_changed(zip_path, manifest, target_dir) == ['b.csv', 'c.csv']
+    assert tmpdir.join('b.csv').read() == 'y'
+
+    # A file removed from disk is extracted again
+    os.remove(os.path.join(target_dir, 'a.csv'))
+    assert extract_changed(zip_path, manifest, target_dir) == ['a.csv']
+
+
+def test_save_drops_missing_files(tmpdir):
+    zip_path = str(tmpdir.join('batch.zip'))
+    write_archive(zip_path, {'a.csv': 'a', 'b.csv': 'b'})
+    manifest = IngestManifest(str(tmpdir.join('manifest.json')))
+    extract_changed(zip_path, manifest, str(tmpdir))
+    os.remove(str(tmpdir.join('a.csv')))
+    manifest.save()
+    assert sorted(IngestManifest(str(tmpdir.join('manifest.json'))).members) \
+        == ['b.csv']
@@ -0,0 +1,72 @@
+"""
+Tests for the registry of measures and the typed reading of their CSVs.
+"""
+import pandas as pd
+import pytest
+
+import measures
+
+
+def test_measure_of_names():
+    assert measures.measure_of(
+        'NDAR_INVA_heartrate_1min_20181101_20181114.csv') == 'heartrate_1min'
+    assert measures.measure_of(
+        'NDAR_INVA_heartrate_20181101_20181114.csv.gz') == 'heartrate'
+    assert measures.measure_of('minuteStepsNarrow.csv') == 'minuteStepsNarrow'
+    assert measures.measure_of('NDAR_INVA_unknown_20181101_20181114.csv') is None
+    with pytest.raises(ValueError):
+        measures.get('unknown')
+
+
+def test_read_csv_is_typed(tmpdir):
+    path = tmpdir.join('NDAR_INVA_30secondSleepStages_20181101_20181114.csv')
+    path.write('LogId,Time,SleepStage\n'
+               '1,11/1/2018 11:00:00 PM,light\n'
+               '1,11/1/2018 11:00:30 PM,deep\n')
+    frame = measures.read_csv(str(path))
+    assert list(frame['Time']) == [pd.Timestamp('2018-11-01 23:00:00'),
+                                   pd.Timestamp('2018-11-01 23:00:30')]
+    assert frame['LogId'].dtype == 'int64'
+    assert frame['SleepStage'].dtype.name == 'category'
+
+    # A missing count can't be an integer
+    path = tmpdir.join('dailyActivity.csv')
+    path.write('ActivityDate,TotalSteps,SedentaryMinutes\n'
+               '11/1/2018,40000,\n11/2/2018,12,600\n')
+    frame = measures.read_csv(str(path))
+    assert list(frame['ActivityDate']) == [pd.Timestamp('2018-11-01'),
+                                           pd.Timestamp('2018-11-02')]
+    assert frame['TotalSteps'].dtype == 'float32'
+    assert list(frame['TotalSteps']) == [40000, 12]
+
+    # Written back in Fitabase's format
+    measures.write_csv(frame, str(tmpdir.join('out.csv')), 'dailyActivity')
+    assert tmpdir.join('out.csv').read().splitlines()[1].startswith(
+        '11/1/2018,')
+
+
+def test_times_are_written_as_fitabase_does(tmpdir):
+    times = ['11/1/2018 12:00:00 AM', '11/1/2018 1:02:00 PM',
+             '12/10/2018 10:00:05 AM', '1/21/2019 12:30:00 PM']
+    path = tmpdir.join('NDAR_INVA_heartrate_1min_20181101_20181114.csv')
+    path.write('Time,Value\n' + ''.join(t + ',60\n' for t in times))
+    frame = measures.read_csv(str(path))
+    out = tmpdir.join('heartrate_1min.csv')
+    measures.write_csv(frame, str(out), 'heartrate_1min')
+    assert out.read() == path.read()
+
+
+def test_values_out_of_range_are_kept(tmpdir):
+    path = tmpdir.join('NDAR_INVA_heartrate_1min_20181101_20181114.csv')
+    path.write('Time,Value\n11/1/2018 12:00:00 AM,300\n'
+               '11/1/2018 12:01:00 AM,-1\n')
+    assert list(measures.read_csv(str(path))['Value']) == [300, -1]
+
+    path = tmpdir.join('NDAR_INVA_minuteStepsNarrow_20181101_20181114.csv')
+    path.write('ActivityMinute,Steps\n11/1/2018 12:00:00 AM,40000\n'
+               '11/1/2018 12:01:00 AM,12\n')
+    assert list(measures.read_csv(str(path))['Steps']) == [40000, 12]
+
+    # Values that fit keep the narrow dtype
+    path.write('ActivityMinute,Steps\n11/1/2018 12:00:00 AM,400\n')
+    assert measures.read_csv(str(path))['Steps'].dtype == 'int16'
@@ -0,0 +1,96 @@
+"""
+Tests for deciding which Fitabase profiles are due for polling.
+"""
+import pandas as pd
+
+from poll_schedule import (BATTERY_COLUMN, SYNC_COLUMN, PollScheduler,
+                           collection_window_end)
+
+NOW = pd.Timestamp('2018-11-15 12:00')
+
+
+def polled(scheduler, sync, battery, when=NOW):
+    """Record one poll of profile 'p' that saw sync and battery."""
+    profile_ids = pd.Series(['p'])
+    results = pd.DataFrame({SYNC_COLUMN: [sync], BATTERY_COLUMN: [battery]})
+    scheduler.update(profile_ids, results, now=when)
+
+
+def is_due(scheduler, now, active_until=None):
+    return scheduler.due(pd.Series(['p']), active_until=active_until,
+                         now=now).iloc[0]
+
+
+def scheduler(tmpdir, **kwargs):
+    kwargs.setdefault('audit_fraction', 0)
+    return PollScheduler(str(tmpdir.join('state.json')), **kwargs)
+
+
+def test_update_and_save(tmpdir):
+    s = scheduler(tmpdir)
+    polled(s, pd.Timestamp('2018-11-15 10:00'), 'High')
+    assert s.state['p'] == {'sync': '2018-11-15T10:00:00', 'battery': 'High',
+                            'polled': NOW.isoformat()}
+    s.save()
+    assert PollScheduler(s.state_file).state == s.state
+    observed = s.last_observed(pd.Series(['p'], index=['device']))
+    assert observed.loc['device', SYNC_COLUMN] == pd.Timestamp('2018-11-15 10:00')
+    assert observed.loc['device', BATTERY_COLUMN] == 'High'
+
+    # A device that has never synced
+    polled(s, None, None)
+    assert s.state['p']['sync'] is None and s.state['p']['battery'] is None
+
+
+def test_unknown_profiles_are_always_due(tmpdir):
+    s = scheduler(tmpdir)
+    assert s.next_due('p') is None
+    assert is_due(s, NOW)
+    # Even past the collection window, since nothing is known to report
+    assert is_due(s, NOW, pd.Series([NOW - pd.Timedelta(days=1)]))
+
+
+def test_staleness_threshold(tmpdir):
+    s = scheduler(tmpdir, lead_time=pd.Timedelta(hours=2),
+                  max_poll_interval={'High': pd.Timedelta(days=10)})
+    polled(s, NOW - pd.Timedelta(days=1), 'High')
+    # Late once the sync is 3 days old; due 2 hours before that
+    assert s.next_due('p') == NOW + pd.Timedelta(days=2, hours=-2)
+    assert not is_due(s, NOW + pd.Timedelta(days=1))
+    assert is_due(s, NOW + pd.Timedelta(days=2, hours=-2))
+
+
+def test_default_lead_time_covers_a_nightly_run(tmpdir):
+    s = scheduler(tmpdir)
+    # Polled an hour ago; the sync turns 3 days old before the next night
+    polled(s, NOW - pd.Timedelta(days=2, hours=12), 'High',
+           when=NOW - pd.Timedelta(hours=1))
+    assert is_due(s, NOW)
+
+
+def test_battery_rules(tmpdir):
+    s = scheduler(tmpdir, lead_time=pd.Timedelta(0))
+    # A fresh sync: the battery's poll interval comes first
+    polled(s, NOW, 'High')
+    assert s.next_due('p') == NOW + pd.Timedelta(hours=24)
+    polled(s, NOW, 'Medium')
+    assert s.next_due('p') == NOW + pd.Timedelta(hours=12)
+    # Low, empty or unknown batteries are polled every run
+    for battery in ['Low', 'Empty', None]:
+        polled(s, NOW, battery)
+        assert s.next_due('p') is None
+        assert is_due(s, NOW)
+
+
+def test_collection_window(tmpdir):
+    s = scheduler(tmpdir)
+    polled(s, NOW, 'Low')
+    device_dte = pd.Series([NOW - pd.Timedelta(days=30)])
+    assert not is_due(s, NOW, collection_window_end(device_dte))
+    # An extension keeps the device in its window
+    assert is_due(s, NOW, collection_window_end(device_dte, pd.Series([10])))
+    # So does an unknown window
+    assert is_due(s, NOW, pd.Series([pd.NaT]))
+    # Devices out of their window are still sampled by the audit
+    s.audit_fraction = 1
+    assert is_due(s, NOW, collection_window_end(device_dte))
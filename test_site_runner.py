@@ -0,0 +1,46 @@
+"""
+Tests for running per-site processing concurrently.
+"""
+import logging
+import time
+
+from site_runner import run_sites
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def test_failures_are_isolated_and_logs_released_in_order():
+    logger = logging.getLogger('test_site_runner')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = ListHandler()
+    logger.handlers = [handler]
+
+    def process_site(site):
+        # Earlier sites take longer, so that they finish last
+        time.sleep({'A': 0.3, 'B': 0.2, 'C': 0}[site])
+        logger.info('%s: started', site)
+        if site == 'B':
+            raise ValueError('no token')
+        logger.info('%s: done', site)
+        return site.lower()
+
+    results = run_sites(['A', 'B', 'C'], process_site, workers=3,
+                        logger=logger)
+
+    assert results == {'A': 'a', 'C': 'c'}
+    assert [record.getMessage() for record in handler.records] == [
+        'A: started', 'A: done',
+        'B: started', 'B: Uncaught exception occurred.',
+        'C: started', 'C: done']
+    assert handler.records[3].levelno == logging.CRITICAL
+    assert handler.records[3].exc_info[0] is ValueError
+    # The logger's own handlers are back in place
+    assert logger.handlers == [handler]